@@ -17,10 +17,8 @@ import time
 import os
 
 from cloudify import ctx
-from cloudify import manager
 from cloudify.utils import exception_to_error_cause
 from cloudify.exceptions import NonRecoverableError
-from cloudify_rest_client.client import CloudifyClient
 from cloudify_rest_client.exceptions import CloudifyClientError
 from cloudify_common_sdk._compat import text_type, urlparse
 
@@ -41,18 +39,29 @@ from .constants import (
     NIP,
     NIP_TYPE,
     DEP_TYPE,
+    POLLING_CURSOR,
 )
 from .polling import (
     any_bp_by_id,
     any_dep_by_id,
+    forget_resource_by_id,
+    plugin_by_package,
+    remember_plugin,
+    forget_plugin,
+    backoff_interval,
     poll_with_timeout,
     poll_workflow_after_execute,
-    dep_system_workflows_finished
+    dep_system_workflows_finished,
+    dep_workflow_in_state_pollster
 )
 from .utils import (
     get_desired_value,
+    get_rest_client,
     update_attributes,
     get_local_path,
+    get_cached_wagon,
+    wagon_package_from_name,
+    wagon_package_from_file,
     zip_files
 )
 
@@ -81,10 +90,8 @@ class DeploymentProxyBase(object):
             ctx.node.properties
         )
 
-        if self.client_config:
-            self.client = CloudifyClient(**self.client_config)
-        else:
-            self.client = manager.get_rest_client()
+        # shared with other operations with same settings
+        self.client = get_rest_client(self.client_config)
 
         # plugins
         self.plugins = get_desired_value(
@@ -140,10 +147,26 @@ class DeploymentProxyBase(object):
         self.interval = operation_inputs.get('interval', POLLING_INTERVAL)
         self.state = operation_inputs.get('state', 'terminated')
         self.timeout = operation_inputs.get('timeout', EXECUTIONS_TIMEOUT)
+        self.backoff = \
+            operation_inputs.get('backoff') \
+            or self.config.get('backoff') \
+            or {}
+        self.non_blocking = \
+            operation_inputs.get('non_blocking') \
+            or self.config.get('non_blocking') \
+            or False
+
+        # Polling cursor saved by previous retry of the same operation
+        self.cursor = \
+            ctx.instance.runtime_properties.get(POLLING_CURSOR) or {}
+        if self.cursor.get('operation') != self.operation_name or \
+                self.cursor.get('execution') != ctx.execution_id:
+            self.cursor = {}
+        self.resume_stage = self.cursor.get('stage')
 
         # This ``execution_id`` will be set once execute workflow done
         # successfully
-        self.execution_id = None
+        self.execution_id = self.cursor.get('execution_id')
 
     def dp_get_client_response(self,
                                _client,
@@ -165,6 +188,99 @@ class DeploymentProxyBase(object):
         else:
             return response
 
+    def _resumed_at(self, stage):
+        # on retry, steps before the saved stage are already done
+        if self.resume_stage in (None, stage):
+            self.resume_stage = None
+            return True
+        return False
+
+    def _clear_cursor(self):
+        if POLLING_CURSOR in ctx.instance.runtime_properties:
+            del ctx.instance.runtime_properties[POLLING_CURSOR]
+
+    def _retry_stage(self, stage, message, retry_after):
+        # save polling cursor and release worker until next retry
+        if self.cursor.get('stage') != stage:
+            self.cursor = {
+                'operation': self.operation_name,
+                'execution': ctx.execution_id,
+                'stage': stage,
+                'started_at': time.time()
+            }
+        self.cursor['execution_id'] = self.execution_id
+        self.cursor['polls'] = self.cursor.get('polls', 0) + 1
+        ctx.instance.runtime_properties[POLLING_CURSOR] = self.cursor
+        return ctx.operation.retry(message, retry_after=retry_after)
+
+    def _wait_for(self, stage, pollster, pollster_args, expected_result):
+        """
+        Waits for pollster expected result.
+        In non-blocking mode pollster is checked only once and operation
+        is retried while result is different.
+        :return: True on success, False on timeout, None on retry.
+        """
+        if not self.non_blocking:
+            return poll_with_timeout(pollster,
+                                     timeout=self.timeout,
+                                     interval=self.interval,
+                                     pollster_args=pollster_args,
+                                     expected_result=expected_result,
+                                     backoff=self.backoff)
+
+        polls = 1
+        started_at = time.time()
+        if self.cursor.get('stage') == stage:
+            polls += self.cursor.get('polls', 0)
+            started_at = self.cursor.get('started_at', started_at)
+
+        if pollster(**pollster_args) == expected_result:
+            ctx.logger.debug(
+                'Polling succeeded after {0} polls!'.format(polls))
+            self._clear_cursor()
+            return True
+
+        if self.timeout != -1 and time.time() > started_at + self.timeout:
+            ctx.logger.error('Polling timed out after {0} polls!'
+                             .format(polls))
+            self._clear_cursor()
+            return False
+
+        self._retry_stage(stage, 'Waiting for {0}.'.format(stage),
+                          backoff_interval(polls - 1, self.interval,
+                                           self.backoff))
+        return None
+
+    def _delay(self, stage, seconds):
+        # sleep in place or retry the operation after the same delay
+        if not self.non_blocking:
+            time.sleep(seconds)
+            return True
+        if self.cursor.get('stage') == stage:
+            self._clear_cursor()
+            return True
+        self._retry_stage(stage, 'Waiting for {0}.'.format(stage), seconds)
+        return False
+
+    def _wait_execution(self):
+        if not self.non_blocking:
+            return self.verify_execution_successful()
+
+        pollster_args = {
+            '_client': self.client,
+            '_dep_id': self.deployment_id,
+            '_state': self.workflow_state,
+            '_workflow_id': self.workflow_id,
+            '_log_redirect': self.deployment_logs.get('redirect', True),
+            '_execution_id': self.execution_id,
+        }
+        result = self._wait_for('execution', dep_workflow_in_state_pollster,
+                                pollster_args, expected_result=True)
+        if result is False:
+            raise NonRecoverableError(
+                'Execution timeout: {0} seconds.'.format(self.timeout))
+        return result
+
     def upload_blueprint(self):
 
         if 'blueprint' not in ctx.instance.runtime_properties:
@@ -233,20 +349,37 @@ class DeploymentProxyBase(object):
                 raise NonRecoverableError(
                     'Wrong type in plugins: {}'.format(repr(self.plugins)))
             for plugin in plugins_list:
-                ctx.logger.info('Creating plugin zip archive..')
+                if not plugin.get('wagon_path') or \
+                        not plugin.get('plugin_yaml_path'):
+                    raise NonRecoverableError(
+                        'You should provide both values wagon_path: {}'
+                        ' and plugin_yaml_path: {}'
+                        .format(repr(plugin.get('wagon_path')),
+                                repr(plugin.get('plugin_yaml_path'))))
+                # check manager without download, if possible
                 wagon_path = None
+                wagon_temporary = False
+                package = wagon_package_from_name(plugin['wagon_path'])
+                if not package:
+                    wagon_path, wagon_temporary = \
+                        get_cached_wagon(plugin['wagon_path'])
+                    package = wagon_package_from_file(wagon_path)
+                if package and plugin_by_package(self.client, package):
+                    ctx.logger.info(
+                        'Plugin {0} {1} already exists, skip upload.'.format(
+                            package['package_name'],
+                            package['package_version']))
+                    if wagon_temporary:
+                        os.remove(wagon_path)
+                    continue
+
+                ctx.logger.info('Creating plugin zip archive..')
                 yaml_path = None
                 zip_path = None
                 try:
-                    if not plugin.get('wagon_path') or \
-                            not plugin.get('plugin_yaml_path'):
-                        raise NonRecoverableError(
-                            'You should provide both values wagon_path: {}'
-                            ' and plugin_yaml_path: {}'
-                            .format(repr(plugin.get('wagon_path')),
-                                    repr(plugin.get('plugin_yaml_path'))))
-                    wagon_path = get_local_path(plugin['wagon_path'],
-                                                create_temp=True)
+                    if not wagon_path:
+                        wagon_path, wagon_temporary = \
+                            get_cached_wagon(plugin['wagon_path'])
                     yaml_path = get_local_path(plugin['plugin_yaml_path'],
                                                create_temp=True)
                     zip_path = zip_files([wagon_path, yaml_path])
@@ -255,9 +388,12 @@ class DeploymentProxyBase(object):
                         'plugins', PLUGIN_UPLOAD, {'plugin_path': zip_path})
                     ctx.instance.runtime_properties['plugins'].append(
                         plugin.id)
+                    if package:
+                        remember_plugin(self.client, package, plugin.id)
                     ctx.logger.info('Uploaded {0}'.format(repr(plugin.id)))
                 finally:
-                    if wagon_path:
+                    # wagon from cache is kept for other operations
+                    if wagon_temporary:
                         os.remove(wagon_path)
                     if yaml_path:
                         os.remove(yaml_path)
@@ -276,6 +412,10 @@ class DeploymentProxyBase(object):
 
     def create_deployment(self):
 
+        # retry in non-blocking mode, deployment is already created
+        if self.resume_stage == 'execution':
+            return self._wait_execution()
+
         self._set_secrets()
         self._upload_plugins()
 
@@ -345,7 +485,7 @@ class DeploymentProxyBase(object):
                 ' {0}'.format(self.deployment_id)
             )
 
-        return self.verify_execution_successful()
+        return self._wait_execution()
 
     def _delete_plugins(self):
         # remove uploaded plugins
@@ -353,6 +493,7 @@ class DeploymentProxyBase(object):
             self.dp_get_client_response('plugins', PLUGIN_DELETE, {
                 'plugin_id': plugin_id
             })
+            forget_plugin(self.client, plugin_id)
             ctx.logger.info('Removed plugin {0}'.format(repr(plugin_id)))
 
     def _delete_secrets(self):
@@ -384,43 +525,54 @@ class DeploymentProxyBase(object):
 
         if not self.deployment.get(EXTERNAL_RESOURCE):
 
-            ctx.logger.info("Wait for stop deployment related executions.")
-
-            pollster_args = \
-                dict(_client=self.client,
-                     _check_all_in_deployment=self.deployment_id)
-
-            poll_with_timeout(
-                dep_system_workflows_finished,
-                timeout=self.timeout,
-                pollster_args=pollster_args,
-                expected_result=True)
-
-            ctx.logger.info("Delete deployment {0}".format(self.deployment_id))
-            self.dp_get_client_response('deployments', DEP_DELETE, client_args)
-
-            ctx.logger.info("Wait for deployment delete.")
-
+            if self._resumed_at('deployment_executions'):
+                ctx.logger.info("Wait for stop deployment related executions.")
+
+                pollster_args = \
+                    dict(_client=self.client,
+                         _check_all_in_deployment=self.deployment_id)
+
+                if self._wait_for('deployment_executions',
+                                  dep_system_workflows_finished,
+                                  pollster_args=pollster_args,
+                                  expected_result=True) is None:
+                    return
+
+                ctx.logger.info(
+                    "Delete deployment {0}".format(self.deployment_id))
+                self.dp_get_client_response('deployments', DEP_DELETE,
+                                            client_args)
+                forget_resource_by_id(self.client, self.deployment_id,
+                                      'deployments')
+
+            if self._resumed_at('deployment_delete'):
+                ctx.logger.info("Wait for deployment delete.")
+
+                pollster_args = \
+                    dict(_client=self.client,
+                         _dep_id=self.deployment_id)
+
+                poll_result = self._wait_for('deployment_delete',
+                                             any_dep_by_id,
+                                             pollster_args=pollster_args,
+                                             expected_result=False)
+                if poll_result is None:
+                    return
+
+        if self._resumed_at('internal_cleanup'):
+            ctx.logger.info("Little wait internal cleanup services.")
+            if not self._delay('internal_cleanup', POLLING_INTERVAL):
+                return
+
+        if self._resumed_at('system_workflows'):
+            ctx.logger.info("Wait for stop all system workflows.")
             pollster_args = \
-                dict(_client=self.client,
-                     _dep_id=self.deployment_id)
-
-            poll_result = poll_with_timeout(
-                any_dep_by_id,
-                timeout=self.timeout,
-                pollster_args=pollster_args,
-                expected_result=False)
-
-        ctx.logger.info("Little wait internal cleanup services.")
-        time.sleep(POLLING_INTERVAL)
-        ctx.logger.info("Wait for stop all system workflows.")
-        pollster_args = \
-            dict(_client=self.client)
-        poll_with_timeout(
-            dep_system_workflows_finished,
-            timeout=self.timeout,
-            pollster_args=pollster_args,
-            expected_result=True)
+                dict(_client=self.client)
+            if self._wait_for('system_workflows',
+                              dep_system_workflows_finished,
+                              pollster_args=pollster_args,
+                              expected_result=True) is None:
+                return
 
         if not self.blueprint.get(EXTERNAL_RESOURCE):
             ctx.logger.info("Delete blueprint {0}.".format(self.blueprint_id))
@@ -440,36 +592,48 @@ class DeploymentProxyBase(object):
 
         update_attributes('executions', 'workflow_id', self.workflow_id)
 
-        # Wait for the deployment to finish any executions
-        pollster_args = \
-            dict(_client=self.client,
-                 _check_all_in_deployment=self.deployment_id)
-
-        if not poll_with_timeout(dep_system_workflows_finished,
-                                 timeout=self.timeout,
-                                 pollster_args=pollster_args,
-                                 expected_result=True):
-            return ctx.operation.retry(
-                'The deployment is not ready for execution.')
-
-        # we must to run some execution
-        if not self.deployment.get(EXTERNAL_RESOURCE) or \
-                self.deployment.get(EXTERNAL_RESOURCE) and self.reexecute:
-
-            execution_args = self.config.get('executions_start_args', {})
-            client_args = \
-                dict(deployment_id=self.deployment_id,
-                     workflow_id=self.workflow_id,
-                     **execution_args)
-            response = self.dp_get_client_response('executions',
-                                                   EXEC_START, client_args)
-
-            # Set the execution_id for the last execution process created
-            self.execution_id = response['id']
-            ctx.logger.debug('Executions start response: {0}'.format(response))
+        if self._resumed_at('deployment_ready'):
+            # Wait for the deployment to finish any executions
+            pollster_args = \
+                dict(_client=self.client,
+                     _check_all_in_deployment=self.deployment_id)
 
+            ready = self._wait_for('deployment_ready',
+                                   dep_system_workflows_finished,
+                                   pollster_args=pollster_args,
+                                   expected_result=True)
+            if ready is None:
+                # retry is already scheduled
+                return
+            if not ready:
+                return ctx.operation.retry(
+                    'The deployment is not ready for execution.')
+
+            # we must to run some execution
+            if not self.deployment.get(EXTERNAL_RESOURCE) or \
+                    self.deployment.get(EXTERNAL_RESOURCE) and self.reexecute:
+
+                execution_args = self.config.get('executions_start_args', {})
+                client_args = \
+                    dict(deployment_id=self.deployment_id,
+                         workflow_id=self.workflow_id,
+                         **execution_args)
+                response = self.dp_get_client_response('executions',
+                                                       EXEC_START,
+                                                       client_args)
+
+                # Set the execution_id for the last execution process
+                # created
+                self.execution_id = response['id']
+                ctx.logger.debug(
+                    'Executions start response: {0}'.format(response))
+
+        if self.execution_id and self._resumed_at('execution'):
             # Poll for execution success.
-            if not self.verify_execution_successful():
+            result = self._wait_execution()
+            if result is None:
+                return
+            if not result:
                 ctx.logger.error('Deployment error.')
 
             ctx.logger.debug('Polling execution succeeded')
@@ -549,4 +713,5 @@ class DeploymentProxyBase(object):
             self.workflow_state,
             self.workflow_id,
             self.execution_id,
-            _log_redirect=self.deployment_logs.get('redirect', True))
+            _log_redirect=self.deployment_logs.get('redirect', True),
+            _backoff=self.backoff)
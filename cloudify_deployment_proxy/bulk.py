@@ -0,0 +1,308 @@
+# Copyright (c) 2017-2018 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+from multiprocessing.pool import ThreadPool
+
+from cloudify import ctx
+from cloudify.exceptions import NonRecoverableError
+from cloudify_rest_client.exceptions import CloudifyClientError
+from cloudify_common_sdk._compat import text_type
+
+from . import DeploymentProxyBase
+from .constants import (
+    EXTERNAL_RESOURCE,
+    BULK_MAX_WORKERS,
+    BULK_LIST_BATCH,
+    BP_DELETE,
+    FINISHED_EXECUTION_STATES,
+    POLLING_INTERVAL,
+)
+from .polling import (
+    backoff_interval,
+    resource_by_id,
+    forget_resource_by_id,
+    poll_with_timeout,
+    execution_watcher,
+    dep_system_workflows_finished,
+    _active_executions
+)
+
+# runtime property with outcome of each child deployment
+BULK_DEPLOYMENTS = 'deployments'
+
+
+def _chunks(items, chunk_size=BULK_LIST_BATCH):
+    for offset in range(0, len(items), chunk_size):
+        yield items[offset:offset + chunk_size]
+
+
+class BulkDeploymentProxy(DeploymentProxyBase):
+    """
+    Many child deployments of one blueprint in one node instance.
+    REST requests run in a bounded pool of threads and executions of all
+    children are polled together by the shared execution watcher.
+    """
+
+    def __init__(self, operation_inputs):
+        super(BulkDeploymentProxy, self).__init__(operation_inputs)
+        self.max_workers = \
+            self.config.get('max_workers') or BULK_MAX_WORKERS
+        self.deployment_specs = []
+        for index, spec in enumerate(self.config.get('deployments', [])):
+            spec = dict(spec)
+            spec['id'] = spec.get('id') or \
+                '{0}-{1}'.format(ctx.instance.id, index)
+            self.deployment_specs.append(spec)
+        self.deployment_ids = [spec['id'] for spec in self.deployment_specs]
+
+    def _run(self, function, items):
+        # ctx is not available in pool threads, so function must only
+        # call REST client and return results for log in this thread
+        if not items:
+            return []
+        pool = ThreadPool(max(1, min(self.max_workers, len(items))))
+        try:
+            return pool.map(function, items)
+        finally:
+            pool.close()
+            pool.join()
+
+    def _update_outcomes(self, results, status_key='status'):
+        # results is list of (deployment_id, status, error)
+        outcomes = dict(
+            ctx.instance.runtime_properties.get(BULK_DEPLOYMENTS) or {})
+        failed = []
+        for deployment_id, status, error in results:
+            outcome = {status_key: status}
+            if error:
+                outcome['error'] = error
+                failed.append(deployment_id)
+                ctx.logger.error('Deployment {0}: {1}'.format(
+                    deployment_id, error))
+            outcomes[deployment_id] = outcome
+        ctx.instance.runtime_properties[BULK_DEPLOYMENTS] = outcomes
+        return failed
+
+    def _raise_on_failures(self, failed, action):
+        if failed:
+            raise NonRecoverableError(
+                '{0} of {1} deployments failed on {2}: {3}'.format(
+                    len(failed), len(self.deployment_ids), action,
+                    ', '.join(failed)))
+
+    def _create_deployment(self, spec):
+        deployment_id = spec['id']
+        try:
+            if resource_by_id(self.client, deployment_id, 'deployments'):
+                return deployment_id, None, None
+            self.client.deployments.create(
+                blueprint_id=self.blueprint_id,
+                deployment_id=deployment_id,
+                inputs=spec.get('inputs', {}))
+            _execs = self.client.executions.list(
+                deployment_id=deployment_id,
+                _include=['id', 'workflow_id', 'deployment_id'])
+        except (CloudifyClientError, NonRecoverableError) as ex:
+            return deployment_id, None, text_type(ex)
+        for _exec in _execs:
+            if _exec.get('workflow_id') == 'create_deployment_environment':
+                return deployment_id, _exec.get('id'), None
+        return deployment_id, None, 'No execution id found'
+
+    def _start_execution(self, deployment_id):
+        execution_args = self.config.get('executions_start_args', {})
+        try:
+            response = self.client.executions.start(
+                deployment_id=deployment_id,
+                workflow_id=self.workflow_id,
+                **execution_args)
+        except CloudifyClientError as ex:
+            return deployment_id, None, text_type(ex)
+        return deployment_id, response['id'], None
+
+    def _delete_deployment(self, deployment_id):
+        try:
+            self.client.deployments.delete(deployment_id=deployment_id)
+        except CloudifyClientError as ex:
+            if ex.status_code != 404:
+                return deployment_id, None, text_type(ex)
+        return deployment_id, 'deleted', None
+
+    def _deployments_ready(self, deployment_ids):
+        for chunk in _chunks(deployment_ids):
+            for _exec in _active_executions(self.client,
+                                            deployment_id=chunk):
+                if _exec.get('deployment_id') in chunk:
+                    return False
+        return True
+
+    def _deployments_deleted(self, deployment_ids):
+        for chunk in _chunks(deployment_ids):
+            try:
+                _deps = self.client.deployments.list(id=chunk,
+                                                     _include=['id'])
+            except CloudifyClientError as ex:
+                raise NonRecoverableError(
+                    'Deployments list failed {0}.'.format(text_type(ex)))
+            if any(_dep.get('id') in chunk for _dep in _deps):
+                return False
+        return True
+
+    def _wait_executions(self, executions):
+        """
+        Waits for all executions together.
+        :param executions: dict of deployment id to execution id.
+        :return: list of (deployment_id, status, error).
+        """
+        results = []
+        pending = dict(executions)
+        timeout = float('infinity') if self.timeout == -1 else self.timeout
+        started = time.time()
+        polls = 0
+        try:
+            execution_watcher.watch(self.client, list(pending.values()))
+            while pending:
+                polls += 1
+                for deployment_id, execution_id in list(pending.items()):
+                    status = execution_watcher.get(
+                        self.client, execution_id).get('status')
+                    if status not in FINISHED_EXECUTION_STATES:
+                        continue
+                    execution_watcher.forget(self.client, execution_id)
+                    del pending[deployment_id]
+                    error = None
+                    if status != self.workflow_state:
+                        error = 'Execution {0} is {1}.'.format(
+                            execution_id, status)
+                    results.append((deployment_id, status, error))
+                if not pending:
+                    break
+                if time.time() - started > timeout:
+                    for deployment_id, execution_id in pending.items():
+                        execution_watcher.forget(self.client, execution_id)
+                        results.append((
+                            deployment_id, 'timeout',
+                            'Execution timeout: {0} seconds.'.format(
+                                self.timeout)))
+                    break
+                ctx.logger.debug('Waiting for {0} executions...'.format(
+                    len(pending)))
+                time.sleep(backoff_interval(polls - 1, self.interval,
+                                            self.backoff))
+        except CloudifyClientError as ex:
+            raise NonRecoverableError(
+                'Executions get failed {0}.'.format(text_type(ex)))
+        ctx.logger.info(
+            'Executions finished: {0}, polls: {1}, time: {2:.1f}s.'.format(
+                len(results), polls, time.time() - started))
+        return results
+
+    def _run_executions(self, started_results, action):
+        # started_results is list of (deployment_id, execution_id, error)
+        failed = self._update_outcomes(
+            [(deployment_id, 'failed', error)
+             for deployment_id, _, error in started_results if error])
+        executions = dict(
+            (deployment_id, execution_id)
+            for deployment_id, execution_id, error in started_results
+            if execution_id)
+        failed += self._update_outcomes(self._wait_executions(executions))
+        self._raise_on_failures(failed, action)
+        return True
+
+    def create_deployments(self):
+
+        self._set_secrets()
+        self._upload_plugins()
+
+        ctx.logger.info('Create {0} deployments.'.format(
+            len(self.deployment_specs)))
+        results = self._run(self._create_deployment, self.deployment_specs)
+        existing = []
+        for deployment_id, execution_id, error in results:
+            if not execution_id and not error:
+                ctx.logger.warn(
+                    'Deployment ID {0} exists. Will use.'.format(
+                        deployment_id))
+                existing.append((deployment_id, 'exists', None))
+        self._update_outcomes(existing)
+        return self._run_executions(results, 'create')
+
+    def execute_workflows(self):
+
+        pollster_args = dict(deployment_ids=self.deployment_ids)
+        if not poll_with_timeout(self._deployments_ready,
+                                 timeout=self.timeout,
+                                 interval=self.interval,
+                                 pollster_args=pollster_args,
+                                 expected_result=True,
+                                 backoff=self.backoff):
+            return ctx.operation.retry(
+                'The deployments are not ready for execution.')
+
+        ctx.logger.info('Start {0} on {1} deployments.'.format(
+            self.workflow_id, len(self.deployment_ids)))
+        results = self._run(self._start_execution, self.deployment_ids)
+        return self._run_executions(results, self.workflow_id)
+
+    def delete_deployments(self):
+
+        ctx.logger.info("Wait for stop deployments related executions.")
+        pollster_args = dict(deployment_ids=self.deployment_ids)
+        poll_with_timeout(self._deployments_ready,
+                          timeout=self.timeout,
+                          interval=self.interval,
+                          pollster_args=pollster_args,
+                          expected_result=True,
+                          backoff=self.backoff)
+
+        ctx.logger.info('Delete {0} deployments.'.format(
+            len(self.deployment_ids)))
+        failed = self._update_outcomes(
+            self._run(self._delete_deployment, self.deployment_ids))
+        self._raise_on_failures(failed, 'delete')
+        for deployment_id in self.deployment_ids:
+            forget_resource_by_id(self.client, deployment_id, 'deployments')
+
+        ctx.logger.info("Wait for deployments delete.")
+        poll_result = poll_with_timeout(self._deployments_deleted,
+                                        timeout=self.timeout,
+                                        interval=self.interval,
+                                        pollster_args=pollster_args,
+                                        expected_result=True,
+                                        backoff=self.backoff)
+
+        ctx.logger.info("Little wait internal cleanup services.")
+        time.sleep(POLLING_INTERVAL)
+        ctx.logger.info("Wait for stop all system workflows.")
+        poll_with_timeout(dep_system_workflows_finished,
+                          timeout=self.timeout,
+                          interval=self.interval,
+                          pollster_args=dict(_client=self.client),
+                          expected_result=True,
+                          backoff=self.backoff)
+
+        if not self.blueprint.get(EXTERNAL_RESOURCE):
+            ctx.logger.info("Delete blueprint {0}.".format(self.blueprint_id))
+            client_args = dict(blueprint_id=self.blueprint_id)
+            self.dp_get_client_response('blueprints', BP_DELETE, client_args)
+
+        self._delete_plugins()
+        self._delete_secrets()
+        self._delete_properties()
+        if BULK_DEPLOYMENTS in ctx.instance.runtime_properties:
+            del ctx.instance.runtime_properties[BULK_DEPLOYMENTS]
+
+        return poll_result
@@ -15,7 +15,53 @@
 DEPLOYMENTS_TIMEOUT = 120
 EXECUTIONS_TIMEOUT = 1800
 POLLING_INTERVAL = 10
+# polling schedule: delay before the first repeat, growth factor and random
+# jitter part of delay, delay grows up to polling interval (max_interval)
+POLLING_BACKOFF = {
+    'first_interval': 1,
+    'factor': 2,
+    'jitter': 0.1,
+}
+# seconds for cache blueprint/deployment existence, 0 - without cache
+EXISTENCE_CACHE_TTL = 0
+ACTIVE_EXECUTION_STATES = ['pending', 'started', 'cancelling',
+                           'force_cancelling', 'kill_cancelling', 'queued',
+                           'scheduled']
+FINISHED_EXECUTION_STATES = ['terminated', 'completed', 'failed', 'cancelled']
+# first and maximal page size for redirected events, page is doubled
+# while manager returns full pages
+LOGS_PAGE_SIZE = 100
+LOGS_MAX_PAGE_SIZE = 1000
+# seconds between shared executions list requests to the same manager
+EXECUTIONS_WATCHER_INTERVAL = 1
+# executions ids in one shared list request
+EXECUTIONS_WATCHER_BATCH = 100
+# seconds without requests before execution is removed from watcher
+EXECUTIONS_WATCHER_FORGET = 600
+# seconds for cache of manager plugins list in process
+PLUGINS_LIST_TTL = 300
+# bytes of downloaded wagons kept in local cache
+PLUGINS_CACHE_SIZE = 1024 ** 3
+# bytes read from network at once on download
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# repeats of interrupted download, resumed by range request if supported
+DOWNLOAD_RETRIES = 3
+# seconds for connect and for wait of data on download
+DOWNLOAD_TIMEOUT = 60
+# bytes of downloaded files kept in local cache
+DOWNLOADS_CACHE_SIZE = 1024 ** 3
+# deflate level for files in created zip archives
+ZIP_COMPRESSION_LEVEL = 6
+# already compressed files, stored in zip archives without compression
+ZIP_STORED_EXTENSIONS = ('.wgn', '.zip', '.gz', '.tgz', '.bz2', '.tbz2',
+                         '.xz', '.txz', '.tar')
+# connections kept to one manager by shared rest client
+REST_CLIENT_POOL_SIZE = 10
+# rest clients with different settings kept by process
+REST_CLIENTS_MAX = 32
 EXTERNAL_RESOURCE = 'external_resource'
+# runtime property with saved stage of non-blocking operation
+POLLING_CURSOR = '_polling_cursor'
 
 PLUGIN_UPLOAD = 'upload'
 PLUGIN_DELETE = 'delete'
@@ -28,6 +74,11 @@ DEP_DELETE = 'delete'
 EXEC_START = 'start'
 EXEC_LIST = 'list'
 
+# threads for REST requests of bulk deployment proxy
+BULK_MAX_WORKERS = 10
+# deployments ids in one filtered list request
+BULK_LIST_BATCH = 100
+
 NIP = 'NodeInstanceProxy'
 NIP_TYPE = 'cloudify.nodes.NodeInstanceProxy'
 DEP_TYPE = 'cloudify.nodes.DeploymentProxy'
@@ -14,7 +14,9 @@
 
 from os import getenv
 import time
+import random
 import logging
+import threading
 
 from cloudify_common_sdk._compat import text_type
 
@@ -22,126 +24,342 @@ from cloudify import ctx
 from cloudify.exceptions import NonRecoverableError
 from cloudify_rest_client.exceptions import CloudifyClientError
 
-from .constants import POLLING_INTERVAL
-
-
-def any_bp_by_id(_client, _bp_id):
+from .constants import (
+    POLLING_INTERVAL,
+    POLLING_BACKOFF,
+    EXISTENCE_CACHE_TTL,
+    ACTIVE_EXECUTION_STATES,
+    FINISHED_EXECUTION_STATES,
+    EXECUTIONS_WATCHER_INTERVAL,
+    EXECUTIONS_WATCHER_BATCH,
+    EXECUTIONS_WATCHER_FORGET,
+    LOGS_PAGE_SIZE,
+    LOGS_MAX_PAGE_SIZE,
+    PLUGINS_LIST_TTL)
+
+# runtime property with count of redirected events by execution id
+COUNT_EVENTS = "received_events"
+
+# (client id, resource type, resource id) -> (expire time, resource exists)
+_existence_cache = {}
+
+
+def _client_key(_client):
+    # clients to the same manager with the same credentials share state
+    _rest = getattr(_client, '_client', None)
+    if not hasattr(_rest, 'host'):
+        return id(_client)
+    return (_rest.host, _rest.port, _rest.protocol,
+            tuple(sorted((_rest.headers or {}).items())))
+
+
+class ExecutionWatcher(object):
+    """
+    Process-local statuses of watched executions. All operations waiting
+    for executions on the same manager share one executions list request
+    per EXECUTIONS_WATCHER_INTERVAL.
+    """
+
+    fields = ['id', 'status', 'workflow_id', 'created_at', 'deployment_id']
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # client key -> lock, watched ids with last request time,
+        # executions from last list and time of last list
+        self._managers = {}
+
+    def _manager(self, _client):
+        with self._lock:
+            return self._managers.setdefault(_client_key(_client), {
+                'lock': threading.Lock(),
+                'watched': {},
+                'executions': {},
+                'checked_at': 0,
+            })
+
+    def _refresh(self, _client, manager):
+        now = time.time()
+        for execution_id, requested_at in list(manager['watched'].items()):
+            if now - requested_at > EXECUTIONS_WATCHER_FORGET:
+                del manager['watched'][execution_id]
+
+        execution_ids = list(manager['watched'])
+        executions = {}
+        for offset in range(0, len(execution_ids), EXECUTIONS_WATCHER_BATCH):
+            _execs = _client.executions.list(
+                id=execution_ids[offset:offset + EXECUTIONS_WATCHER_BATCH],
+                include_system_workflows=True,
+                _include=self.fields,
+                _size=EXECUTIONS_WATCHER_BATCH)
+            for _exec in _execs:
+                executions[_exec.get('id')] = _exec
+        manager['executions'] = executions
+        manager['checked_at'] = time.time()
+
+    def get(self, _client, execution_id):
+        manager = self._manager(_client)
+        with manager['lock']:
+            manager['watched'][execution_id] = time.time()
+            # other operations could already get fresh state
+            if execution_id not in manager['executions'] or \
+                    time.time() - manager['checked_at'] >= \
+                    EXECUTIONS_WATCHER_INTERVAL:
+                self._refresh(_client, manager)
+            _exec = manager['executions'].get(execution_id)
+        if _exec is None:
+            # manager has not returned execution by filter
+            _exec = _client.executions.get(execution_id=execution_id,
+                                           _include=self.fields)
+        return _exec
+
+    def watch(self, _client, execution_ids):
+        # start watch for many executions with one shared refresh
+        manager = self._manager(_client)
+        with manager['lock']:
+            now = time.time()
+            for execution_id in execution_ids:
+                manager['watched'][execution_id] = now
+            self._refresh(_client, manager)
+
+    def forget(self, _client, execution_id):
+        manager = self._manager(_client)
+        with manager['lock']:
+            manager['watched'].pop(execution_id, None)
+            manager['executions'].pop(execution_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._managers = {}
+
+
+execution_watcher = ExecutionWatcher()
+
+
+def any_bp_by_id(_client, _bp_id, _cache_ttl=EXISTENCE_CACHE_TTL):
     resource_type = 'blueprints'
-    return any_resource_by_id(_client, _bp_id, resource_type)
+    return any_resource_by_id(_client, _bp_id, resource_type, _cache_ttl)
 
 
-def any_dep_by_id(_client, _dep_id):
+def any_dep_by_id(_client, _dep_id, _cache_ttl=EXISTENCE_CACHE_TTL):
     resource_type = 'deployments'
-    return any_resource_by_id(_client, _dep_id, resource_type)
+    return any_resource_by_id(_client, _dep_id, resource_type, _cache_ttl)
 
 
-def any_resource_by_id(_client, _resource_id, _resource_type):
-    return any(resource_by_id(_client, _resource_id, _resource_type))
+def any_resource_by_id(_client, _resource_id, _resource_type,
+                       _cache_ttl=EXISTENCE_CACHE_TTL):
+    return any(resource_by_id(_client, _resource_id, _resource_type,
+                              _cache_ttl))
 
 
-def all_deps_by_id(_client, _dep_id):
+def all_deps_by_id(_client, _dep_id, _cache_ttl=EXISTENCE_CACHE_TTL):
     resource_type = 'deployments'
-    return all_resource_by_id(_client, _dep_id, resource_type)
+    return all_resource_by_id(_client, _dep_id, resource_type, _cache_ttl)
 
 
-def all_resource_by_id(_client, _resource_id, _resource_type):
-    output = resource_by_id(_client, _resource_id, _resource_type)
+def all_resource_by_id(_client, _resource_id, _resource_type,
+                       _cache_ttl=EXISTENCE_CACHE_TTL):
+    output = resource_by_id(_client, _resource_id, _resource_type,
+                            _cache_ttl)
     if not output:
         return False
     return all(output)
 
 
-def resource_by_id(_client, _id, _type):
+def forget_resource_by_id(_client, _id, _type):
+    # drop cached state, e.g. after create or delete of resource
+    _existence_cache.pop((_client_key(_client), _type, _id), None)
+
+
+def resource_by_id(_client, _id, _type, _cache_ttl=EXISTENCE_CACHE_TTL):
+    # returns [True] if resource exists, [] otherwise
+    cache_key = (_client_key(_client), _type, _id)
+    if _cache_ttl:
+        expire, exists = _existence_cache.get(cache_key, (0, False))
+        if expire > time.time():
+            return [True] if exists else []
+
     _resources_client = getattr(_client, _type)
     try:
-        _resources = _resources_client.list(_include=['id'])
+        _resources_client.get(_id, _include=['id'])
     except CloudifyClientError as ex:
-        raise NonRecoverableError(
-            '{0} list failed {1}.'.format(_type, text_type(ex)))
+        if ex.status_code != 404:
+            raise NonRecoverableError(
+                '{0} get failed {1}.'.format(_type, text_type(ex)))
+        exists = False
     else:
-        return [text_type(_r['id']) == _id for _r in _resources]
+        exists = True
+
+    if _cache_ttl:
+        _existence_cache[cache_key] = (time.time() + _cache_ttl, exists)
+    return [True] if exists else []
+
+
+# client key -> (expire time, {plugin package key: plugin id})
+_plugins_cache = {}
+
+
+def _package_key(package):
+    # wagon file names use "_" instead of "-" in package name
+    return ((package.get('package_name') or '').replace('-', '_').lower(),
+            package.get('package_version'),
+            package.get('supported_platform') or 'any')
+
+
+def plugin_by_package(_client, package, _cache_ttl=PLUGINS_LIST_TTL):
+    # returns id of plugin with the same package on manager or None
+    cache_key = _client_key(_client)
+    expire, plugins = _plugins_cache.get(cache_key, (0, None))
+    if plugins is None or expire <= time.time():
+        plugins = {}
+        _offset = int(getenv('_PAGINATION_OFFSET', 0))
+        _size = int(getenv('_PAGINATION_SIZE', 1000))
+        while True:
+            try:
+                _plugins = _client.plugins.list(
+                    _include=['id', 'package_name', 'package_version',
+                              'supported_platform'],
+                    _offset=_offset,
+                    _size=_size)
+            except CloudifyClientError as ex:
+                raise NonRecoverableError(
+                    'Plugins list failed {0}.'.format(text_type(ex)))
+            for _plugin in _plugins:
+                plugins[_package_key(_plugin)] = _plugin.get('id')
+            if len(_plugins) < _size:
+                break
+            _offset = _offset + _size
+        _plugins_cache[cache_key] = (time.time() + _cache_ttl, plugins)
+    return plugins.get(_package_key(package))
+
+
+def remember_plugin(_client, package, plugin_id):
+    # add uploaded plugin to cached list
+    _, plugins = _plugins_cache.get(_client_key(_client), (0, None))
+    if plugins is not None:
+        plugins[_package_key(package)] = plugin_id
+
+
+def forget_plugin(_client, plugin_id):
+    # drop removed plugin from cached list
+    _, plugins = _plugins_cache.get(_client_key(_client), (0, None))
+    for key, _id in list((plugins or {}).items()):
+        if _id == plugin_id:
+            del plugins[key]
+
+
+def backoff_interval(attempt, interval=POLLING_INTERVAL, backoff=None):
+    """
+    Delay before the next poll.
+    :param attempt: count of already failed polls, from 0.
+    :param interval: maximal delay, used without max_interval in backoff.
+    :param backoff: overwrites for POLLING_BACKOFF settings.
+    """
+    settings = dict(POLLING_BACKOFF)
+    settings.update(backoff or {})
+    max_interval = settings.get('max_interval') or interval or \
+        POLLING_INTERVAL
+    # limit power, there is no reason to grow after max_interval
+    delay = min(settings['first_interval'] *
+                settings['factor'] ** min(attempt, 64),
+                max_interval)
+    jitter = settings.get('jitter')
+    if jitter:
+        delay += delay * random.uniform(-jitter, jitter)
+    return max(delay, 0)
 
 
 def poll_with_timeout(pollster,
                       timeout,
                       interval=POLLING_INTERVAL,
                       pollster_args=None,
-                      expected_result=True):
+                      expected_result=True,
+                      backoff=None):
 
     pollster_args = pollster_args or dict()
     # Check if timeout value is -1 that allows infinite timeout
     # If timeout value is not -1 then it is a finite timeout
     timeout = float('infinity') if timeout == -1 else timeout
     current_time = time.time()
+    deadline = current_time + timeout
+    polls = 0
 
     ctx.logger.debug('Timeout value is {0}'.format(timeout))
 
-    while time.time() <= current_time + timeout:
+    while time.time() <= deadline:
+        polls += 1
         if pollster(**pollster_args) != expected_result:
-            ctx.logger.debug('Polling...')
-            time.sleep(interval)
+            # never sleep after deadline
+            delay = min(backoff_interval(polls - 1, interval, backoff),
+                        max(deadline - time.time(), 0))
+            ctx.logger.debug('Polling... next in {0:.1f}s'.format(delay))
+            time.sleep(delay)
         else:
-            ctx.logger.debug('Polling succeeded!')
+            ctx.logger.debug(
+                'Polling succeeded after {0} polls in {1:.1f}s!'.format(
+                    polls, time.time() - current_time))
             return True
 
-    ctx.logger.error('Polling timed out!')
+    ctx.logger.error('Polling timed out after {0} polls!'.format(polls))
     return False
 
 
-def dep_logs_redirect(_client, execution_id):
-    COUNT_EVENTS = "received_events"
+def _event_message(event):
+    instance_prompt = event.get('node_instance_id', "")
+    if instance_prompt:
+        if event.get('operation'):
+            instance_prompt += (
+                "." + event.get('operation').split('.')[-1]
+            )
 
-    if not ctx.instance.runtime_properties.get(COUNT_EVENTS):
-        ctx.instance.runtime_properties[COUNT_EVENTS] = {}
+    if instance_prompt:
+        instance_prompt = "[" + instance_prompt + "] "
 
-    last_event = int(ctx.instance.runtime_properties[COUNT_EVENTS].get(
-        execution_id, 0
-    ))
+    message = "%s %s%s" % (
+        event.get('reported_timestamp', ""),
+        instance_prompt if instance_prompt else "",
+        event.get('message', "")
+    )
+    return text_type(message)
 
-    full_count = last_event + 100
 
-    while full_count > last_event:
-        events, full_count = _client.events.get(execution_id, last_event,
-                                                250, True)
-        for event in events:
-            ctx.logger.debug(
-                'Event {0} for execution_id {1}'.format(event, execution_id))
-            instance_prompt = event.get('node_instance_id', "")
-            if instance_prompt:
-                if event.get('operation'):
-                    instance_prompt += (
-                        "." + event.get('operation').split('.')[-1]
-                    )
-
-            if instance_prompt:
-                instance_prompt = "[" + instance_prompt + "] "
-
-            message = "%s %s%s" % (
-                event.get('reported_timestamp', ""),
-                instance_prompt if instance_prompt else "",
-                event.get('message', "")
-            )
-            message = text_type(message)
+def _event_level(event):
+    level = event.get('level', logging.INFO)
 
-            ctx.logger.debug(
-                'Message {0} for Event {1} for execution_id {1}'.format(
-                    message, event))
+    # If the event dict had a 'level' key, then the value is
+    # a string. In that case, convert it to uppercase and get
+    # the matching Python logging constant.
+    if isinstance(level, text_type):
+        level = logging.getLevelName(level.upper())
+
+    # In the (very) odd case that the level is still not an int
+    # (can happen if the original level value wasn't recognized
+    # by Python's logging library), then use 'INFO'.
+    if not isinstance(level, int):
+        level = logging.INFO
+    return level
 
-            level = event.get('level', logging.INFO)
 
-            # If the event dict had a 'level' key, then the value is
-            # a string. In that case, convert it to uppercase and get
-            # the matching Python logging constant.
-            if isinstance(level, text_type):
-                level = logging.getLevelName(level.upper())
+def dep_logs_redirect(_client, execution_id):
+    received_events = ctx.instance.runtime_properties.get(COUNT_EVENTS) or {}
+
+    last_event = int(received_events.get(execution_id, 0))
+    saved_event = last_event
+    page_size = LOGS_PAGE_SIZE
 
-            # In the (very) odd case that the level is still not an int
-            # (can happen if the original level value wasn't recognized
-            # by Python's logging library), then use 'INFO'.
-            if not isinstance(level, int):
-                level = logging.INFO
+    full_count = last_event + 100
+
+    while full_count > last_event:
+        events, full_count = _client.events.get(execution_id, last_event,
+                                                page_size, True)
+        ctx.logger.debug(
+            'Received {0} events for execution_id {1}'.format(
+                len(events), execution_id))
 
-            ctx.logger.log(level, message)
+        # one message per page with the highest level of page events
+        if events:
+            ctx.logger.log(
+                max(_event_level(event) for event in events),
+                "\n".join(_event_message(event) for event in events))
 
         last_event += len(events)
         # returned infinite count
@@ -152,12 +370,30 @@ def dep_logs_redirect(_client, execution_id):
             ctx.logger.log(20, "Waiting for log messages "
                                "(execution: {0})...".format(execution_id))
             break
-
-    ctx.instance.runtime_properties[COUNT_EVENTS][execution_id] = last_event
+        # full page, probably there are more events
+        if len(events) >= page_size:
+            page_size = min(page_size * 2, LOGS_MAX_PAGE_SIZE)
+
+    # update runtime properties only on changes
+    if last_event != saved_event:
+        received_events[execution_id] = last_event
+        ctx.instance.runtime_properties[COUNT_EVENTS] = received_events
+
+
+def forget_logs_redirect(execution_id):
+    # drop events count of finished execution
+    received_events = ctx.instance.runtime_properties.get(COUNT_EVENTS)
+    if not received_events or execution_id not in received_events:
+        return
+    del received_events[execution_id]
+    if received_events:
+        ctx.instance.runtime_properties[COUNT_EVENTS] = received_events
+    else:
+        del ctx.instance.runtime_properties[COUNT_EVENTS]
 
 
-def dep_system_workflows_finished(_client, _check_all_in_deployment=False):
-
+def _active_executions(_client, **filters):
+    # generator over not finished executions, filtered by manager
     _offset = int(getenv('_PAGINATION_OFFSET', 0))
     _size = int(getenv('_PAGINATION_SIZE', 1000))
 
@@ -166,35 +402,42 @@ def dep_system_workflows_finished(_client, _check_all_in_deployment=False):
         try:
             _execs = _client.executions.list(
                 include_system_workflows=True,
+                status=ACTIVE_EXECUTION_STATES,
+                _include=['id', 'status', 'deployment_id',
+                          'is_system_workflow'],
                 _offset=_offset,
-                _size=_size)
+                _size=_size,
+                **filters)
         except CloudifyClientError as ex:
             raise NonRecoverableError(
                 'Executions list failed {0}.'.format(text_type(ex)))
 
         for _exec in _execs:
-
-            if _exec.get('is_system_workflow'):
-                if _exec.get('status') not in ('terminated',
-                                               'completed',
-                                               'failed',
-                                               'cancelled'):
-                    return False
-
-            if _check_all_in_deployment:
-                if _check_all_in_deployment == _exec.get('deployment_id'):
-                    if _exec.get('status') not in ('terminated',
-                                                   'completed',
-                                                   'failed',
-                                                   'cancelled'):
-                        return False
+            # older managers can ignore status filter
+            if _exec.get('status') not in FINISHED_EXECUTION_STATES:
+                yield _exec
 
         if _execs.metadata.pagination.total <= \
-                _execs.metadata.pagination.offset:
+                _execs.metadata.pagination.offset + len(_execs) or \
+                not len(_execs):
             break
 
         _offset = _offset + _size
 
+
+def dep_system_workflows_finished(_client, _check_all_in_deployment=False):
+
+    for _exec in _active_executions(_client, is_system_workflow=True):
+        if _exec.get('is_system_workflow'):
+            return False
+
+    if _check_all_in_deployment:
+        for _exec in _active_executions(
+            _client, deployment_id=_check_all_in_deployment
+        ):
+            if _check_all_in_deployment == _exec.get('deployment_id'):
+                return False
+
     return True
 
 
@@ -205,13 +448,8 @@ def dep_workflow_in_state_pollster(_client,
                                    _log_redirect=False,
                                    _execution_id=None):
 
-    exec_get_fields = \
-        ['status', 'workflow_id', 'created_at', 'id']
-
     try:
-        _exec = \
-            _client.executions.get(execution_id=_execution_id,
-                                   _include=exec_get_fields)
+        _exec = execution_watcher.get(_client, _execution_id)
 
         ctx.logger.debug(
             'The exec get response form {0} is {1}'.format(_dep_id, _exec))
@@ -225,6 +463,13 @@ def dep_workflow_in_state_pollster(_client,
             '_exec info for _log_redirect is {0}'.format(_exec))
         dep_logs_redirect(_client, _exec.get('id'))
 
+    if _exec.get('status') == _state or \
+            _exec.get('status') in FINISHED_EXECUTION_STATES:
+        # cancelled executions also never change
+        execution_watcher.forget(_client, _execution_id)
+        if _log_redirect:
+            forget_logs_redirect(_exec.get('id'))
+
     if _exec.get('status') == _state:
         ctx.logger.debug(
             'The status for _exec info id'
@@ -245,7 +490,8 @@ def poll_workflow_after_execute(_timeout,
                                 _state,
                                 _workflow_id,
                                 _execution_id,
-                                _log_redirect=False):
+                                _log_redirect=False,
+                                _backoff=None):
 
     pollster_args = {
         '_client': _client,
@@ -263,7 +509,8 @@ def poll_workflow_after_execute(_timeout,
             dep_workflow_in_state_pollster,
             timeout=_timeout,
             interval=_interval,
-            pollster_args=pollster_args)
+            pollster_args=pollster_args,
+            backoff=_backoff)
 
     if not success:
         raise NonRecoverableError(
@@ -17,6 +17,7 @@ from cloudify.decorators import operation
 
 from . import utils
 from . import DeploymentProxyBase
+from .bulk import BulkDeploymentProxy
 
 
 @operation(resumable=True)
@@ -41,3 +42,21 @@ def delete_deployment(operation, **_):
 @utils.proxy_operation('execute_workflow')
 def execute_start(operation, **_):
     return getattr(DeploymentProxyBase(_), operation)()
+
+
+@operation(resumable=True)
+@utils.proxy_operation('create_deployments')
+def bulk_create_deployments(operation, **_):
+    return getattr(BulkDeploymentProxy(_), operation)()
+
+
+@operation(resumable=True)
+@utils.proxy_operation('delete_deployments')
+def bulk_delete_deployments(operation, **_):
+    return getattr(BulkDeploymentProxy(_), operation)()
+
+
+@operation(resumable=True)
+@utils.proxy_operation('execute_workflows')
+def bulk_execute_start(operation, **_):
+    return getattr(BulkDeploymentProxy(_), operation)()
@@ -20,6 +20,11 @@ from cloudify.state import current_ctx
 from cloudify.mocks import MockCloudifyContext
 from cloudify_rest_client.exceptions import CloudifyClientError
 
+from ..polling import (execution_watcher,
+                       _plugins_cache,
+                       _existence_cache)
+from ..utils import rest_clients
+
 REST_CLIENT_EXCEPTION = \
     mock.MagicMock(side_effect=CloudifyClientError('Mistake'))
 
@@ -47,6 +52,10 @@ class DeploymentProxyTestBase(testtools.TestCase):
 
     def tearDown(self):
         current_ctx.clear()
+        execution_watcher.clear()
+        _plugins_cache.clear()
+        _existence_cache.clear()
+        rest_clients.clear()
         super(DeploymentProxyTestBase, self).tearDown()
 
     def get_mock_ctx(self,
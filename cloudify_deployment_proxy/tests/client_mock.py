@@ -16,6 +16,7 @@ import datetime
 from mock import MagicMock
 
 from cloudify_rest_client.responses import ListResponse
+from cloudify_rest_client.exceptions import CloudifyClientError
 
 
 class BaseMockClient(object):
@@ -36,9 +37,20 @@ class BaseMockClient(object):
     def list(self, *args, **kwargs):
         return self.base_list_return(args, kwargs)
 
+    def base_get_from_list(self, resource_id, **_):
+        # search in list, so tests can replace only list response
+        for resource in self.list():
+            if resource['id'] == resource_id:
+                return resource
+        raise CloudifyClientError('{0} not found'.format(resource_id),
+                                  status_code=404)
+
 
 class MockBlueprintsClient(BaseMockClient):
 
+    def get(self, *args, **kwargs):
+        return self.base_get_from_list(*args, **kwargs)
+
     def _upload(self, *args, **_):
         del args
         return MagicMock(return_value={'id': 'test'})
@@ -59,6 +71,9 @@ class MockDeploymentsClient(BaseMockClient):
     def __init__(self):
         self.outputs = MockDeploymentsOutputsClient()
 
+    def get(self, *args, **kwargs):
+        return self.base_get_from_list(*args, **kwargs)
+
     def create(self, *args, **_):
         _return_value = \
             {
@@ -0,0 +1,165 @@
+# Copyright (c) 2017-2018 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import mock
+
+from cloudify.state import current_ctx
+from cloudify.exceptions import NonRecoverableError
+from cloudify_rest_client.responses import ListResponse
+from cloudify_rest_client.exceptions import CloudifyClientError
+
+from .base import DeploymentProxyTestBase
+from .client_mock import MockCloudifyRestClient
+from ..tasks import (bulk_create_deployments,
+                     bulk_delete_deployments,
+                     bulk_execute_start)
+
+from cloudify_common_sdk._compat import text_type
+
+BULK_PROXY_PROPS = {
+    'resource_config': {
+        'blueprint': {
+            'id': 'bulk_blueprint',
+            'blueprint_archive': 'URL',
+            'main_file_name': 'blueprint.yaml'
+        },
+        'deployments': [
+            {'id': 'dep-0'},
+            {'id': 'dep-1', 'inputs': {'a': 'b'}},
+            {'id': 'dep-2'},
+        ]
+    }
+}
+
+
+class TestBulk(DeploymentProxyTestBase):
+
+    sleep_mock = None
+
+    def setUp(self):
+        super(TestBulk, self).setUp()
+        mock_sleep = mock.MagicMock()
+        self.sleep_mock = mock.patch('time.sleep', mock_sleep)
+        self.sleep_mock.start()
+
+    def tearDown(self):
+        if self.sleep_mock:
+            self.sleep_mock.stop()
+            self.sleep_mock = None
+        super(TestBulk, self).tearDown()
+
+    @staticmethod
+    def _executions_list(statuses):
+        def mock_list(*_, **kwargs):
+            if 'id' in kwargs:
+                # shared watcher request
+                return [{'id': _id, 'status': statuses[_id]}
+                        for _id in kwargs['id']]
+            if 'status' in kwargs:
+                # active executions
+                return ListResponse([], metadata={'pagination': {
+                    'total': 0, 'offset': 0, 'size': 0}})
+            return [{'id': 'exec-' + kwargs['deployment_id'],
+                     'workflow_id': 'create_deployment_environment'}]
+        return mock.Mock(side_effect=mock_list)
+
+    def test_bulk_create_deployments(self):
+        test_name = 'test_bulk_create_deployments'
+        _ctx = self.get_mock_ctx(test_name, test_properties=BULK_PROXY_PROPS)
+        current_ctx.set(_ctx)
+
+        def mock_get(_id, **_):
+            if _id == 'dep-0':
+                return {'id': _id}
+            raise CloudifyClientError('Not found', status_code=404)
+
+        with mock.patch('cloudify.manager.get_rest_client') as mock_client:
+            cfy_mock_client = MockCloudifyRestClient()
+            cfy_mock_client.deployments.get = mock.Mock(side_effect=mock_get)
+            cfy_mock_client.deployments.create = mock.Mock()
+            cfy_mock_client.executions.list = self._executions_list({
+                'exec-dep-1': 'terminated',
+                'exec-dep-2': 'failed'})
+            mock_client.return_value = cfy_mock_client
+
+            error = self.assertRaises(NonRecoverableError,
+                                      bulk_create_deployments,
+                                      operation='create_deployments')
+            self.assertIn('1 of 3 deployments failed on create: dep-2',
+                          text_type(error))
+
+            self.assertEqual(cfy_mock_client.deployments.create.call_count, 2)
+            cfy_mock_client.deployments.create.assert_any_call(
+                blueprint_id='bulk_blueprint', deployment_id='dep-1',
+                inputs={'a': 'b'})
+            outcomes = _ctx.instance.runtime_properties['deployments']
+            self.assertEqual(outcomes['dep-0'], {'status': 'exists'})
+            self.assertEqual(outcomes['dep-1'], {'status': 'terminated'})
+            self.assertEqual(outcomes['dep-2']['status'], 'failed')
+            self.assertIn('exec-dep-2', outcomes['dep-2']['error'])
+
+    def test_bulk_execute_start(self):
+        test_name = 'test_bulk_execute_start'
+        _ctx = self.get_mock_ctx(test_name, test_properties=BULK_PROXY_PROPS)
+        current_ctx.set(_ctx)
+
+        with mock.patch('cloudify.manager.get_rest_client') as mock_client:
+            cfy_mock_client = MockCloudifyRestClient()
+            cfy_mock_client.executions.start = mock.Mock(
+                side_effect=lambda deployment_id, **_: {
+                    'id': 'exec-' + deployment_id})
+            cfy_mock_client.executions.list = self._executions_list({
+                'exec-dep-0': 'terminated',
+                'exec-dep-1': 'terminated',
+                'exec-dep-2': 'terminated'})
+            mock_client.return_value = cfy_mock_client
+
+            output = bulk_execute_start(operation='execute_workflows',
+                                        workflow_id='install')
+            self.assertTrue(output)
+            self.assertEqual(cfy_mock_client.executions.start.call_count, 3)
+            # statuses of all executions by one request
+            watcher_calls = [
+                call for call in cfy_mock_client.executions.list.call_args_list
+                if 'id' in call[1]]
+            self.assertEqual(len(watcher_calls), 1)
+            self.assertEqual(
+                _ctx.instance.runtime_properties['deployments'],
+                {'dep-0': {'status': 'terminated'},
+                 'dep-1': {'status': 'terminated'},
+                 'dep-2': {'status': 'terminated'}})
+
+    def test_bulk_delete_deployments(self):
+        test_name = 'test_bulk_delete_deployments'
+        _ctx = self.get_mock_ctx(test_name, test_properties=BULK_PROXY_PROPS)
+        current_ctx.set(_ctx)
+        _ctx.instance.runtime_properties['deployments'] = {
+            'dep-0': {'status': 'terminated'}}
+
+        with mock.patch('cloudify.manager.get_rest_client') as mock_client:
+            cfy_mock_client = MockCloudifyRestClient()
+            cfy_mock_client.deployments.delete = mock.Mock(side_effect=[
+                None, None,
+                CloudifyClientError('Not found', status_code=404)])
+            cfy_mock_client.deployments.list = mock.Mock(return_value=[])
+            cfy_mock_client.blueprints.delete = mock.Mock()
+            cfy_mock_client.executions.list = self._executions_list({})
+            mock_client.return_value = cfy_mock_client
+
+            output = bulk_delete_deployments(operation='delete_deployments')
+            self.assertTrue(output)
+            self.assertEqual(cfy_mock_client.deployments.delete.call_count, 3)
+            cfy_mock_client.blueprints.delete.assert_called_with(
+                blueprint_id='bulk_blueprint')
+            self.assertNotIn('deployments', _ctx.instance.runtime_properties)
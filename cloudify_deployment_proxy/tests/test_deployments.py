@@ -22,6 +22,7 @@ from .. import DeploymentProxyBase
 from .base import DeploymentProxyTestBase
 from .client_mock import MockCloudifyRestClient
 from ..tasks import create_deployment, delete_deployment
+from ..constants import POLLING_CURSOR
 
 from cloudify_common_sdk._compat import text_type
 REST_CLIENT_EXCEPTION = \
@@ -87,8 +88,11 @@ class TestDeployment(DeploymentProxyTestBase):
         current_ctx.set(_ctx)
 
         get_local_path = mock.Mock(return_value="some_path")
+        get_cached_wagon = mock.Mock(return_value=("some_wagon", False))
 
-        with mock.patch('cloudify.manager.get_rest_client') as mock_client:
+        with mock.patch('cloudify.manager.get_rest_client') as mock_client, \
+                mock.patch('cloudify_deployment_proxy.get_cached_wagon',
+                           get_cached_wagon):
             plugin = mock.Mock()
             plugin.id = "CustomPlugin"
 
@@ -118,14 +122,28 @@ class TestDeployment(DeploymentProxyTestBase):
                     os_mock = mock.Mock()
                     with mock.patch('cloudify_deployment_proxy.os', os_mock):
                         deployment._upload_plugins()
-                    zip_files.assert_called_with(["some_path", "some_path"])
+                    zip_files.assert_called_with(["some_wagon", "some_path"])
+                    get_cached_wagon.assert_called_with('_wagon_path')
                     get_local_path.assert_has_calls([
-                        mock.call('_wagon_path', create_temp=True),
                         mock.call('_plugin_yaml_path', create_temp=True)])
+                    # cached wagon is not removed
                     os_mock.remove.assert_has_calls([
                         mock.call('some_path'),
+                        mock.call('_zip')])
+                    self.assertEqual(os_mock.remove.call_count, 2)
+
+                    # temporary wagon is removed
+                    get_cached_wagon.return_value = ("tmp_wagon", True)
+                    os_mock = mock.Mock()
+                    with mock.patch('cloudify_deployment_proxy.os', os_mock):
+                        deployment._upload_plugins()
+                    zip_files.assert_called_with(["tmp_wagon", "some_path"])
+                    os_mock.remove.assert_has_calls([
+                        mock.call('tmp_wagon'),
                         mock.call('some_path'),
                         mock.call('_zip')])
+                    self.assertEqual(os_mock.remove.call_count, 3)
+                    get_cached_wagon.return_value = ("some_wagon", False)
 
             get_local_path = mock.Mock(return_value="some_path")
             # zip_files = mock.Mock(return_value="_zip")
@@ -145,14 +163,15 @@ class TestDeployment(DeploymentProxyTestBase):
                     os_mock = mock.Mock()
                     with mock.patch('cloudify_deployment_proxy.os', os_mock):
                         deployment._upload_plugins()
-                    zip_files.assert_called_with(["some_path", "some_path"])
+                    zip_files.assert_called_with(["some_wagon", "some_path"])
+                    get_cached_wagon.assert_called_with('_wagon_path')
                     get_local_path.assert_has_calls([
-                        mock.call('_wagon_path', create_temp=True),
                         mock.call('_plugin_yaml_path', create_temp=True)])
+                    # cached wagon is not removed
                     os_mock.remove.assert_has_calls([
-                        mock.call('some_path'),
                         mock.call('some_path'),
                         mock.call('_zip')])
+                    self.assertEqual(os_mock.remove.call_count, 2)
 
             # raise error if wrong plugins list
             deployment = DeploymentProxyBase({'plugins': True})
@@ -170,6 +189,55 @@ class TestDeployment(DeploymentProxyTestBase):
             self.assertIn("You should provide both values wagon_path: '' "
                           "and plugin_yaml_path: ''", text_type(error))
 
+    def test_upload_plugins_exists(self):
+        # Tests that existing plugins are not downloaded and uploaded
+
+        test_name = 'test_upload_plugins_exists'
+        _ctx = self.get_mock_ctx(test_name)
+        current_ctx.set(_ctx)
+
+        wagon_url = 'https://example.com/cloudify_utilities_plugin-1.9.0-' \
+                    'py27-none-linux_x86_64-centos-Core.wgn'
+        with mock.patch('cloudify.manager.get_rest_client') as mock_client, \
+                mock.patch('cloudify_deployment_proxy.get_cached_wagon') \
+                as get_cached_wagon:
+            cfy_mock_client = MockCloudifyRestClient()
+            cfy_mock_client.plugins.list = mock.Mock(return_value=[{
+                'id': 'plugin_id',
+                'package_name': 'cloudify-utilities-plugin',
+                'package_version': '1.9.0',
+                'supported_platform': 'linux_x86_64'}])
+            mock_client.return_value = cfy_mock_client
+
+            for _ in range(2):
+                deployment = DeploymentProxyBase({'plugins': [{
+                    'wagon_path': wagon_url,
+                    'plugin_yaml_path': '_plugin_yaml_path'}]})
+                deployment._upload_plugins()
+
+            get_cached_wagon.assert_not_called()
+            cfy_mock_client.plugins.upload.assert_not_called()
+            # manager list is requested once
+            self.assertEqual(cfy_mock_client.plugins.list.call_count, 1)
+            self.assertEqual(_ctx.instance.runtime_properties['plugins'], [])
+
+            # wagon downloaded only to read package is removed
+            get_cached_wagon.return_value = ('/tmp/x/plugin.wgn', True)
+            deployment = DeploymentProxyBase({'plugins': [{
+                'wagon_path': 'https://example.com/plugin.wgn',
+                'plugin_yaml_path': '_plugin_yaml_path'}]})
+            os_mock = mock.Mock()
+            with mock.patch('cloudify_deployment_proxy.os', os_mock), \
+                    mock.patch(
+                        'cloudify_deployment_proxy.wagon_package_from_file',
+                        mock.Mock(return_value={
+                            'package_name': 'cloudify-utilities-plugin',
+                            'package_version': '1.9.0',
+                            'supported_platform': 'linux_x86_64'})):
+                deployment._upload_plugins()
+            os_mock.remove.assert_called_once_with('/tmp/x/plugin.wgn')
+            cfy_mock_client.plugins.upload.assert_not_called()
+
     def test_delete_deployment_success(self):
         # Tests that deployments delete succeeds
 
@@ -220,6 +288,47 @@ class TestDeployment(DeploymentProxyTestBase):
                 timeout=.01)
             self.assertTrue(output)
 
+    def test_delete_deployment_non_blocking(self):
+        # Tests that non-blocking delete retries instead of wait
+        test_name = 'test_delete_deployment_non_blocking'
+        _ctx = self.get_mock_ctx(test_name)
+        current_ctx.set(_ctx)
+
+        _ctx.instance.runtime_properties['deployment'] = {}
+        _ctx.instance.runtime_properties['deployment']['id'] = test_name
+        with mock.patch('cloudify.manager.get_rest_client') as mock_client:
+            cfy_mock_client = MockCloudifyRestClient()
+            cfy_mock_client.deployments.delete = mock.Mock()
+            cfy_mock_client.blueprints.delete = mock.Mock()
+            cfy_mock_client.deployments.get = mock.Mock(side_effect=[
+                {'id': test_name},
+                CloudifyClientError('Not found', status_code=404)])
+            mock_client.return_value = cfy_mock_client
+
+            # deployment is not removed yet
+            output = delete_deployment(operation='delete_deployment',
+                                       non_blocking=True)
+            self.assertIsNone(output)
+            self.assertEqual(
+                _ctx.instance.runtime_properties[POLLING_CURSOR]['stage'],
+                'deployment_delete')
+            self.assertIsNotNone(_ctx.operation._operation_retry)
+
+            # wait for internal cleanup by retry
+            output = delete_deployment(operation='delete_deployment',
+                                       non_blocking=True)
+            self.assertIsNone(output)
+            self.assertEqual(
+                _ctx.instance.runtime_properties[POLLING_CURSOR]['stage'],
+                'internal_cleanup')
+
+            output = delete_deployment(operation='delete_deployment',
+                                       non_blocking=True)
+            self.assertTrue(output)
+            self.assertNotIn(POLLING_CURSOR, _ctx.instance.runtime_properties)
+            self.assertEqual(cfy_mock_client.deployments.delete.call_count, 1)
+            self.assertEqual(cfy_mock_client.blueprints.delete.call_count, 1)
+
     def test_create_deployment_rest_client_error(self):
         # Tests that deployments create fails on rest client error
 
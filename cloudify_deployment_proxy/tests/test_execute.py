@@ -22,7 +22,8 @@ from ..tasks import execute_start
 from .. import DeploymentProxyBase
 from .base import DeploymentProxyTestBase
 from .client_mock import MockCloudifyRestClient
-from ..constants import EXTERNAL_RESOURCE, NIP_TYPE, DEP_TYPE
+from ..constants import (
+    EXTERNAL_RESOURCE, NIP_TYPE, DEP_TYPE, POLLING_CURSOR)
 
 from cloudify_common_sdk._compat import text_type
 
@@ -168,6 +169,67 @@ class TestExecute(DeploymentProxyTestBase):
                 self.assertTrue(output)
         del _ctx, mock_client
 
+    def test_execute_start_non_blocking(self):
+        # Tests that execute start saves cursor and retries until finish
+
+        test_name = 'test_execute_start_non_blocking'
+        _ctx = self.get_mock_ctx(test_name)
+        current_ctx.set(_ctx)
+        _ctx.instance.runtime_properties['deployment'] = {}
+
+        with mock.patch('cloudify.manager.get_rest_client') as mock_client:
+            cfy_mock_client = MockCloudifyRestClient()
+            cfy_mock_client.executions.start = mock.Mock(
+                return_value={'id': 'exec_id'})
+            cfy_mock_client.executions.get = mock.Mock(side_effect=[
+                {'id': 'exec_id', 'status': 'started'},
+                {'id': 'exec_id', 'status': 'terminated'}])
+            mock_client.return_value = cfy_mock_client
+
+            output = execute_start(operation='execute_workflow',
+                                   workflow_id='install',
+                                   non_blocking=True)
+            self.assertIsNone(output)
+            self.assertIsNotNone(_ctx.operation._operation_retry)
+            cursor = _ctx.instance.runtime_properties[POLLING_CURSOR]
+            self.assertEqual(cursor['stage'], 'execution')
+            self.assertEqual(cursor['execution_id'], 'exec_id')
+
+            output = execute_start(operation='execute_workflow',
+                                   workflow_id='install',
+                                   non_blocking=True)
+            self.assertTrue(output)
+            self.assertNotIn(POLLING_CURSOR, _ctx.instance.runtime_properties)
+            cfy_mock_client.executions.start.assert_called_once_with(
+                deployment_id=test_name, workflow_id='install')
+        del _ctx, mock_client
+
+    def test_execute_start_non_blocking_not_ready(self):
+        # Tests that retry of not ready deployment keeps stage backoff
+
+        test_name = 'test_execute_start_non_blocking_not_ready'
+        _ctx = self.get_mock_ctx(test_name)
+        current_ctx.set(_ctx)
+        _ctx.instance.runtime_properties['deployment'] = {}
+
+        with mock.patch('cloudify.manager.get_rest_client') as mock_client, \
+                mock.patch('cloudify_deployment_proxy.'
+                           'dep_system_workflows_finished',
+                           mock.Mock(return_value=False)), \
+                mock.patch.object(_ctx.operation, 'retry') as retry:
+            mock_client.return_value = MockCloudifyRestClient()
+            output = execute_start(operation='execute_workflow',
+                                   workflow_id='install',
+                                   non_blocking=True)
+            self.assertIsNone(output)
+            # only retry from stage with backoff
+            self.assertEqual(retry.call_count, 1)
+            self.assertEqual(retry.call_args[0],
+                             ('Waiting for deployment_ready.',))
+            cursor = _ctx.instance.runtime_properties[POLLING_CURSOR]
+            self.assertEqual(cursor['stage'], 'deployment_ready')
+        del _ctx, mock_client
+
     def test_execute_start_succeeds_node_instance_proxy(self):
         # Tests that execute start succeeds
 
@@ -234,7 +296,7 @@ class TestExecute(DeploymentProxyTestBase):
             'verify_execution_successful'
 
         with mock.patch(
-            'cloudify_deployment_proxy.CloudifyClient'
+            'cloudify_deployment_proxy.utils.CloudifyClient'
         ) as mock_local_client:
             mock_local_client.return_value = cfy_mock_client
 
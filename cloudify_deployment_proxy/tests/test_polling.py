@@ -13,6 +13,7 @@
 # limitations under the License.
 
 import json
+import time
 import mock
 
 from cloudify.state import current_ctx
@@ -26,12 +27,18 @@ from ..polling import (
     any_dep_by_id,
     all_deps_by_id,
     resource_by_id,
+    forget_resource_by_id,
+    backoff_interval,
     poll_with_timeout,
     dep_logs_redirect,
+    forget_logs_redirect,
     dep_workflow_in_state_pollster,
     dep_system_workflows_finished,
-    poll_workflow_after_execute)
+    poll_workflow_after_execute,
+    execution_watcher,
+    COUNT_EVENTS)
 
+from ..constants import ACTIVE_EXECUTION_STATES
 from cloudify_common_sdk._compat import text_type
 
 
@@ -60,7 +67,7 @@ class TestPolling(DeploymentProxyTestBase):
         with mock.patch('cloudify.manager.get_rest_client') as mock_client:
             cfy_mock_client = MockCloudifyRestClient()
             mock_client.return_value = cfy_mock_client
-            output = any_bp_by_id(mock_client, test_name)
+            output = any_bp_by_id(cfy_mock_client, test_name)
             self.assertFalse(output)
 
     # test that any bp by id returns True if there are matching
@@ -92,7 +99,7 @@ class TestPolling(DeploymentProxyTestBase):
         with mock.patch('cloudify.manager.get_rest_client') as mock_client:
             cfy_mock_client = MockCloudifyRestClient()
             mock_client.return_value = cfy_mock_client
-            output = any_dep_by_id(mock_client, test_name)
+            output = any_dep_by_id(cfy_mock_client, test_name)
             self.assertFalse(output)
 
     # test that any dep by id returns True if there are matching
@@ -124,7 +131,7 @@ class TestPolling(DeploymentProxyTestBase):
         with mock.patch('cloudify.manager.get_rest_client') as mock_client:
             cfy_mock_client = MockCloudifyRestClient()
             mock_client.return_value = cfy_mock_client
-            output = all_deps_by_id(mock_client, test_name)
+            output = all_deps_by_id(cfy_mock_client, test_name)
             self.assertFalse(output)
 
     # test that all dep by id returns True if there are matching
@@ -170,6 +177,48 @@ class TestPolling(DeploymentProxyTestBase):
                     'deployments')
             self.assertIn('failed', text_type(output))
 
+    # test that resource existence is checked by direct get and cached
+    def test_resource_by_id_cache(self):
+        test_name = 'test_resource_by_id_cache'
+        _ctx = self.get_mock_ctx(test_name)
+        current_ctx.set(_ctx)
+
+        cfy_mock_client = MockCloudifyRestClient()
+        cfy_mock_client.deployments.get = mock.Mock(
+            return_value={'id': test_name})
+        self.assertEqual(
+            resource_by_id(cfy_mock_client, test_name, 'deployments'),
+            [True])
+        cfy_mock_client.deployments.get.assert_called_with(
+            test_name, _include=['id'])
+        # without cache each check calls manager
+        any_dep_by_id(cfy_mock_client, test_name)
+        self.assertEqual(cfy_mock_client.deployments.get.call_count, 2)
+        # shared cache
+        self.assertTrue(any_dep_by_id(cfy_mock_client, test_name, 60))
+        self.assertTrue(all_deps_by_id(cfy_mock_client, test_name, 60))
+        self.assertEqual(cfy_mock_client.deployments.get.call_count, 3)
+        # cache is dropped after delete
+        cfy_mock_client.deployments.get.side_effect = CloudifyClientError(
+            'Not found', status_code=404)
+        forget_resource_by_id(cfy_mock_client, test_name, 'deployments')
+        self.assertFalse(any_dep_by_id(cfy_mock_client, test_name, 60))
+        self.assertFalse(any_dep_by_id(cfy_mock_client, test_name, 60))
+        self.assertEqual(cfy_mock_client.deployments.get.call_count, 4)
+
+        # clients with the same settings share cache
+        clients = []
+        for _ in range(2):
+            client = MockCloudifyRestClient()
+            client._client = mock.Mock(host='localhost', port=80,
+                                       protocol='http', headers={})
+            client.deployments.get = mock.Mock(
+                return_value={'id': test_name})
+            clients.append(client)
+        self.assertTrue(any_dep_by_id(clients[0], test_name, 60))
+        self.assertTrue(any_dep_by_id(clients[1], test_name, 60))
+        clients[1].deployments.get.assert_not_called()
+
     # Test that failed polling raises an error
     def test_poll_with_timeout_timeout(self):
         test_name = 'test_poll_with_timeout'
@@ -187,6 +236,35 @@ class TestPolling(DeploymentProxyTestBase):
                 mock_interval)
         self.assertFalse(output)
 
+    # Test that polling delay grows up to interval
+    def test_poll_with_timeout_backoff(self):
+        test_name = 'test_poll_with_timeout_backoff'
+        _ctx = self.get_mock_ctx(test_name)
+        current_ctx.set(_ctx)
+
+        self.assertEqual(
+            [backoff_interval(attempt, 10, {'jitter': 0})
+             for attempt in range(6)],
+            [1, 2, 4, 8, 10, 10])
+        self.assertEqual(
+            backoff_interval(100, 10, {'max_interval': 30, 'jitter': 0}),
+            30)
+        for _ in range(10):
+            delay = backoff_interval(0, 10, {'first_interval': 5})
+            self.assertTrue(4.5 <= delay <= 5.5)
+
+        mock_pollster = mock.Mock(side_effect=[False, False, False, True])
+        with mock.patch('time.sleep') as mock_sleep:
+            output = \
+                poll_with_timeout(
+                    mock_pollster,
+                    -1,
+                    3,
+                    backoff={'jitter': 0})
+        self.assertTrue(output)
+        self.assertEqual(mock_sleep.call_args_list,
+                         [mock.call(1), mock.call(2), mock.call(3)])
+
     # Test that failed polling raises an error
     def test_poll_with_timeout_expected(self):
         test_name = 'test_poll_with_timeout_expected'
@@ -257,6 +335,39 @@ class TestPolling(DeploymentProxyTestBase):
                     cfy_mock_client)
             self.assertTrue(output)
 
+    # Test that only active executions are requested from manager
+    def test_dep_system_workflows_finished_filters(self):
+        test_name = 'test_dep_system_workflows_finished_filters'
+        _ctx = self.get_mock_ctx(test_name)
+        current_ctx.set(_ctx)
+
+        with mock.patch('cloudify.manager.get_rest_client') as mock_client:
+            cfy_mock_client = MockCloudifyRestClient()
+            list_response = cfy_mock_client.blueprints.list()
+            list_response[0]['id'] = test_name
+            list_response[0]['deployment_id'] = 'other'
+            list_response[0]['is_system_workflow'] = False
+            list_response[0]['status'] = 'started'
+            calls = []
+
+            def mock_return(*args, **kwargs):
+                del args
+                calls.append(kwargs)
+                return list_response
+
+            cfy_mock_client.executions.list = mock_return
+            mock_client.return_value = cfy_mock_client
+            output = \
+                dep_system_workflows_finished(
+                    cfy_mock_client, _check_all_in_deployment=test_name)
+            self.assertTrue(output)
+            self.assertEqual(len(calls), 2)
+            for call in calls:
+                self.assertEqual(call['status'], ACTIVE_EXECUTION_STATES)
+                self.assertTrue(call['include_system_workflows'])
+            self.assertTrue(calls[0]['is_system_workflow'])
+            self.assertEqual(calls[1]['deployment_id'], test_name)
+
     # test that raises Exception is handled.
     def test_dep_system_workflows_finished_raises(self):
         test_name = 'test_dep_system_workflows_finished_raises'
@@ -301,6 +412,47 @@ class TestPolling(DeploymentProxyTestBase):
                     0)
             self.assertFalse(output)
 
+    # Test that watcher shares one list request between executions
+    def test_execution_watcher_shared_list(self):
+        test_name = 'test_execution_watcher_shared_list'
+        _ctx = self.get_mock_ctx(test_name)
+        current_ctx.set(_ctx)
+
+        cfy_mock_client = MockCloudifyRestClient()
+        statuses = {'a': 'started', 'b': 'started', 'c': 'terminated'}
+
+        def mock_list(*args, **kwargs):
+            del args
+            return [{'id': _id, 'status': statuses[_id]}
+                    for _id in kwargs['id']]
+
+        cfy_mock_client.executions.list = mock.Mock(side_effect=mock_list)
+        cfy_mock_client.executions.get = mock.Mock()
+
+        # new executions are requested at once
+        for _id in ['a', 'b', 'c']:
+            self.assertEqual(
+                execution_watcher.get(cfy_mock_client, _id)['status'],
+                statuses[_id])
+        self.assertEqual(cfy_mock_client.executions.list.call_count, 3)
+        # known executions reuse last response
+        for _id in ['a', 'b', 'c']:
+            execution_watcher.get(cfy_mock_client, _id)
+        self.assertEqual(cfy_mock_client.executions.list.call_count, 3)
+        # finished execution is not requested again
+        self.assertTrue(
+            dep_workflow_in_state_pollster(
+                cfy_mock_client, test_name, 'terminated',
+                _execution_id='c'))
+        with mock.patch('cloudify_deployment_proxy.polling.time.time',
+                        return_value=time.time() + 60):
+            execution_watcher.get(cfy_mock_client, 'a')
+        self.assertEqual(cfy_mock_client.executions.list.call_count, 4)
+        self.assertEqual(
+            sorted(cfy_mock_client.executions.list.call_args[1]['id']),
+            ['a', 'b'])
+        cfy_mock_client.executions.get.assert_not_called()
+
     # Test that matching executions returns True
     def test_dep_workflow_in_state_pollster_matching_executions(self):
         test_name = 'test_dep_workflow_in_state_pollster_matching_executions'
@@ -358,6 +510,22 @@ class TestPolling(DeploymentProxyTestBase):
                     True)
             self.assertTrue(output)
 
+    def test_dep_workflow_in_state_pollster_cancelled_logs(self):
+        test_name = 'test_dep_workflow_in_state_pollster_cancelled_logs'
+        _ctx = self.get_mock_ctx(test_name)
+        current_ctx.set(_ctx)
+        _ctx.instance.runtime_properties[COUNT_EVENTS] = {test_name: 3}
+
+        cfy_mock_client = MockCloudifyRestClient()
+        cfy_mock_client.events._set([])
+        cfy_mock_client.executions.list = mock.Mock(
+            return_value=[{'id': test_name, 'status': 'cancelled'}])
+        self.assertFalse(dep_workflow_in_state_pollster(
+            cfy_mock_client, test_name, 'terminated',
+            _log_redirect=True, _execution_id=test_name))
+        # events cursor of finished execution is dropped
+        self.assertNotIn(COUNT_EVENTS, _ctx.instance.runtime_properties)
+
     # Test that matching executions returns True
     def test_dep_workflow_in_state_pollster_matching_state(self):
         test_name = 'test_dep_workflow_in_state_pollster_matching_executions'
@@ -506,6 +674,52 @@ class TestPolling(DeploymentProxyTestBase):
             "2017-03-22T11:42:00.083Z [vm_ke9e2d.create] Task succeeded "
             "'cloudify_agent.installer.operations.create'")
 
+    def test_dep_logs_redirect_batches(self):
+        test_name = "dep_logs_redirect_batches"
+        _ctx = self.get_mock_ctx(test_name)
+        _ctx.logger.log = mock.MagicMock(return_value=None)
+        current_ctx.set(_ctx)
+
+        cfy_mock_client = MockCloudifyRestClient()
+        events = [{"message": "message {0}".format(i),
+                   "level": "error" if i == 10 else "info"}
+                  for i in range(350)]
+
+        def mock_get(execution_id, offset, size, *_):
+            del execution_id
+            return events[offset:offset + size], len(events)
+
+        cfy_mock_client.events.get = mock.Mock(side_effect=mock_get)
+
+        dep_logs_redirect(cfy_mock_client, 'some_execution_id')
+        self.assertEqual(
+            [call[0][2] for call in
+             cfy_mock_client.events.get.call_args_list],
+            [100, 200, 400])
+        self.assertEqual(_ctx.logger.log.call_count, 3)
+        level, message = _ctx.logger.log.call_args_list[0][0]
+        self.assertEqual(level, 40)
+        self.assertEqual(len(message.split("\n")), 100)
+        self.assertEqual(
+            _ctx.instance.runtime_properties['received_events'],
+            {'some_execution_id': 350})
+
+        # nothing new, only waiting message
+        _ctx.instance.runtime_properties['received_events'][
+            'other_execution_id'] = 1
+        dep_logs_redirect(cfy_mock_client, 'some_execution_id')
+        _ctx.logger.log.assert_called_with(
+            20,
+            "Waiting for log messages (execution: some_execution_id)...")
+        self.assertEqual(_ctx.logger.log.call_count, 4)
+
+        forget_logs_redirect('some_execution_id')
+        self.assertEqual(
+            _ctx.instance.runtime_properties['received_events'],
+            {'other_execution_id': 1})
+        forget_logs_redirect('other_execution_id')
+        self.assertNotIn('received_events', _ctx.instance.runtime_properties)
+
     def test_dep_logs_empty_infinity(self):
         test_name = "dep_logs_redirect_predefined_level"
         _ctx = self.get_mock_ctx(test_name)
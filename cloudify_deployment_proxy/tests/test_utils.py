@@ -13,9 +13,18 @@
 # limitations under the License.
 
 import tempfile
+import tarfile
+import zipfile
+import shutil
+import json
+import mock
 import os
 
+import requests
+
 from cloudify.state import current_ctx
+from cloudify.exceptions import NonRecoverableError
+from cloudify_common_sdk._compat import text_type
 from .base import DeploymentProxyTestBase
 import cloudify_deployment_proxy.utils as utils
 
@@ -32,6 +41,86 @@ class TestUtils(DeploymentProxyTestBase):
         os.remove(zip_file)
         os.remove(destination)
 
+    def test_private_dir(self):
+        _ctx = self.get_mock_ctx(__name__)
+        current_ctx.set(_ctx)
+        folder = tempfile.mkdtemp()
+        try:
+            cache_dir = os.path.join(folder, 'cache')
+            self.assertEqual(utils._private_dir(cache_dir), cache_dir)
+            self.assertEqual(os.stat(cache_dir).st_mode & 0o777, 0o700)
+            # other users can write
+            os.chmod(cache_dir, 0o777)
+            self.assertIsNone(utils._private_dir(cache_dir))
+            # file or link instead of directory
+            os.rmdir(cache_dir)
+            os.symlink(folder, cache_dir)
+            self.assertIsNone(utils._private_dir(cache_dir))
+        finally:
+            shutil.rmtree(folder)
+
+    def test_get_rest_client(self):
+        _ctx = self.get_mock_ctx(__name__)
+        current_ctx.set(_ctx)
+        client = utils.get_rest_client({'host': 'localhost',
+                                        'pool_size': 3})
+        # same settings share client and connections
+        self.assertIs(client, utils.get_rest_client({'pool_size': 3,
+                                                     'host': 'localhost'}))
+        self.assertIsNot(client, utils.get_rest_client({
+            'host': 'localhost', 'tenant': 'other'}))
+        self.assertEqual(client._client.host, 'localhost')
+
+        # manager client by current credentials
+        with mock.patch('cloudify.manager.get_rest_client') as mock_client:
+            mock_client.side_effect = lambda: mock.Mock()
+            manager_client = utils.get_rest_client()
+            self.assertIs(manager_client, utils.get_rest_client({}))
+            self.assertEqual(mock_client.call_count, 1)
+
+            # cloudify-common without execution token is not shared
+            with mock.patch('cloudify_deployment_proxy.utils.cloudify_utils.'
+                            'get_execution_token',
+                            mock.Mock(side_effect=AttributeError)):
+                self.assertIsNot(utils.get_rest_client(),
+                                 utils.get_rest_client())
+            self.assertEqual(mock_client.call_count, 3)
+
+        # limited count of kept clients
+        pool = utils.RestClientsPool(max_clients=1)
+        client = pool.get({'host': 'localhost'})
+        pool.get({'host': 'other'})
+        self.assertIsNot(client, pool.get({'host': 'localhost'}))
+
+    def test_zip_files_names(self):
+        _ctx = self.get_mock_ctx(__name__)
+        current_ctx.set(_ctx)
+        folder = tempfile.mkdtemp()
+        try:
+            paths = []
+            for name in ['plugin.yaml', 'plugin.wgn']:
+                paths.append(os.path.join(folder, name))
+                with open(paths[-1], 'w') as f:
+                    f.write('content ' * 100)
+            zip_path = utils.zip_files(paths)
+            with zipfile.ZipFile(zip_path) as zip_file:
+                infos = dict((info.filename, info.compress_type)
+                             for info in zip_file.infolist())
+                self.assertEqual(zip_file.read('plugin.yaml'),
+                                 b'content ' * 100)
+            self.assertEqual(infos, {'plugin.yaml': zipfile.ZIP_DEFLATED,
+                                     'plugin.wgn': zipfile.ZIP_STORED})
+            os.remove(zip_path)
+
+            zip_path = utils.zip_files(paths, compression_level=0)
+            with zipfile.ZipFile(zip_path) as zip_file:
+                self.assertEqual(
+                    [info.compress_type for info in zip_file.infolist()],
+                    [zipfile.ZIP_STORED, zipfile.ZIP_STORED])
+            os.remove(zip_path)
+        finally:
+            shutil.rmtree(folder)
+
     def test_get_local_path_local(self):
         _ctx = self.get_mock_ctx(__name__)
         current_ctx.set(_ctx)
@@ -50,3 +139,207 @@ class TestUtils(DeploymentProxyTestBase):
             create_temp=True)
         self.assertTrue(copy_file)
         os.remove(copy_file)
+
+    def test_wagon_package(self):
+        _ctx = self.get_mock_ctx(__name__)
+        current_ctx.set(_ctx)
+        self.assertEqual(
+            utils.wagon_package_from_name(
+                'https://example.com/1.9.0/cloudify_utilities_plugin-1.9.0-'
+                'py27-none-linux_x86_64-centos-Core.wgn'),
+            {'package_name': 'cloudify_utilities_plugin',
+             'package_version': '1.9.0',
+             'supported_platform': 'linux_x86_64'})
+        self.assertIsNone(utils.wagon_package_from_name('plugin.zip'))
+
+        folder = tempfile.mkdtemp()
+        try:
+            package_dir = os.path.join(folder, 'cloudify-utilities-plugin')
+            os.mkdir(package_dir)
+            with open(os.path.join(package_dir, 'package.json'), 'w') as f:
+                json.dump({'package_name': 'cloudify-utilities-plugin',
+                           'package_version': '1.9.0',
+                           'supported_platform': 'any'}, f)
+            wagon_path = os.path.join(folder, 'plugin.wgn')
+            with tarfile.open(wagon_path, 'w:gz') as wagon:
+                wagon.add(package_dir, 'cloudify-utilities-plugin')
+            self.assertEqual(
+                utils.wagon_package_from_file(wagon_path),
+                {'package_name': 'cloudify-utilities-plugin',
+                 'package_version': '1.9.0',
+                 'supported_platform': 'any'})
+            self.assertIsNone(utils.wagon_package_from_file(
+                os.path.join(package_dir, 'package.json')))
+        finally:
+            shutil.rmtree(folder)
+
+    def test_get_cached_wagon(self):
+        _ctx = self.get_mock_ctx(__name__)
+        current_ctx.set(_ctx)
+        cache_dir = tempfile.mkdtemp()
+        url_a = 'http://example.com/a.wgn'
+
+        try:
+            responses = [
+                self._response(200, [b'a' * 10], headers={'ETag': '"a1"'}),
+                self._response(304, []),
+                self._response(200, [b'A' * 10], headers={'ETag': '"a2"'}),
+                self._response(200, [b'b' * 10], headers={'ETag': '"b1"'}),
+                self._response(200, [b'c' * 10], headers={'ETag': '"c1"'}),
+                self._response(200, [b'd' * 10])]
+            with mock.patch('requests.get',
+                            mock.Mock(side_effect=responses)) as get:
+                first, temporary = utils.get_cached_wagon(url_a, cache_dir,
+                                                          25)
+                self.assertTrue(first.endswith('-a.wgn'))
+                self.assertFalse(temporary)
+                # not modified
+                self.assertEqual(
+                    utils.get_cached_wagon(url_a, cache_dir, 25),
+                    (first, False))
+                self.assertEqual(get.call_args[1]['headers'],
+                                 {'If-None-Match': '"a1"'})
+                # changed on server
+                self.assertEqual(
+                    utils.get_cached_wagon(url_a, cache_dir, 25),
+                    (first, False))
+                with open(first, 'rb') as f:
+                    self.assertEqual(f.read(), b'A' * 10)
+                second, _ = utils.get_cached_wagon(
+                    'http://example.com/b.wgn', cache_dir, 25)
+                # the least recently used wagon is removed over cache size
+                os.utime(first, (0, 0))
+                utils.get_cached_wagon('http://example.com/c.wgn',
+                                       cache_dir, 25)
+                self.assertFalse(os.path.isfile(first))
+                self.assertTrue(os.path.isfile(second))
+                # without validators wagon is temporary copy
+                path, temporary = utils.get_cached_wagon(
+                    'http://example.com/d.wgn', cache_dir, 25)
+                self.assertTrue(temporary)
+                self.assertFalse(path.startswith(cache_dir))
+                self.assertEqual(os.path.basename(path), 'd.wgn')
+                shutil.rmtree(os.path.dirname(path))
+            self.assertEqual(
+                len([name for name in os.listdir(cache_dir)
+                     if name.endswith('.wgn')]), 2)
+
+            # local wagon is used as is
+            self.assertEqual(utils.get_cached_wagon(second, cache_dir),
+                             (second, False))
+
+            # cache of other user is not used
+            os.chmod(cache_dir, 0o777)
+            with mock.patch('cloudify_deployment_proxy.utils.download_file',
+                            mock.Mock(return_value='/tmp/x/e.wgn')) as dl:
+                self.assertEqual(
+                    utils.get_cached_wagon('http://example.com/e.wgn',
+                                           cache_dir), ('/tmp/x/e.wgn', True))
+                dl.assert_called_with('http://example.com/e.wgn',
+                                      keep_name=True, checksum=None,
+                                      use_cache=False)
+        finally:
+            shutil.rmtree(cache_dir)
+
+    @staticmethod
+    def _response(status_code, chunks, headers=None, error=None):
+        response = mock.Mock()
+        response.status_code = status_code
+        response.url = 'http://example.com/file'
+        response.headers = headers or {}
+
+        def iter_content(_):
+            for chunk in chunks:
+                yield chunk
+            if error:
+                raise error
+        response.iter_content = iter_content
+        return response
+
+    def test_download_file_resume(self):
+        _ctx = self.get_mock_ctx(__name__)
+        current_ctx.set(_ctx)
+        fd, destination = tempfile.mkstemp()
+        os.close(fd)
+        interrupted = self._response(
+            200, [b'abc'], headers={'ETag': '"v1"'},
+            error=requests.exceptions.ChunkedEncodingError('broken'))
+        resumed = self._response(206, [b'def'], headers={
+            'ETag': '"v1"', 'Content-Range': 'bytes 3-5/6'})
+        try:
+            with mock.patch('requests.get',
+                            mock.Mock(side_effect=[interrupted, resumed])
+                            ) as get:
+                utils.download_file('http://example.com/file', destination,
+                                    checksum='md5:e80b5017098950fc58aad83c8c'
+                                             '14978e',
+                                    use_cache=False)
+            with open(destination, 'rb') as f:
+                self.assertEqual(f.read(), b'abcdef')
+            self.assertEqual(get.call_args[1]['headers'],
+                             {'Range': 'bytes=3-', 'If-Range': '"v1"'})
+
+            # file changed, server returns full new version
+            interrupted = self._response(
+                200, [b'abc'], headers={'ETag': '"v1"'},
+                error=requests.exceptions.ChunkedEncodingError('broken'))
+            changed = self._response(200, [b'ghijkl'],
+                                     headers={'ETag': '"v2"'})
+            with mock.patch('requests.get',
+                            mock.Mock(side_effect=[interrupted, changed])):
+                utils.download_file('http://example.com/file', destination,
+                                    use_cache=False)
+            with open(destination, 'rb') as f:
+                self.assertEqual(f.read(), b'ghijkl')
+
+            # without validators download is restarted
+            interrupted = self._response(
+                200, [b'abc'],
+                error=requests.exceptions.ChunkedEncodingError('broken'))
+            with mock.patch('requests.get', mock.Mock(side_effect=[
+                    interrupted, self._response(200, [b'abcdef'])])) as get:
+                utils.download_file('http://example.com/file', destination,
+                                    use_cache=False)
+            self.assertEqual(get.call_args[1]['headers'], {})
+            with open(destination, 'rb') as f:
+                self.assertEqual(f.read(), b'abcdef')
+
+            # wrong checksum
+            with mock.patch('requests.get', mock.Mock(
+                    return_value=self._response(200, [b'abc']))):
+                error = self.assertRaises(
+                    NonRecoverableError, utils.download_file,
+                    'http://example.com/file', destination,
+                    checksum='0' * 64, use_cache=False)
+                self.assertIn('checksum', text_type(error))
+        finally:
+            os.remove(destination)
+
+    def test_download_file_cache(self):
+        _ctx = self.get_mock_ctx(__name__)
+        current_ctx.set(_ctx)
+        cache_dir = tempfile.mkdtemp()
+        first = self._response(200, [b'content'], headers={'ETag': '"v1"'})
+        not_modified = self._response(304, [])
+        try:
+            with mock.patch('cloudify_deployment_proxy.utils.'
+                            'DOWNLOADS_CACHE_DIR', cache_dir), \
+                    mock.patch('requests.get', mock.Mock(
+                        side_effect=[first, not_modified])) as get:
+                path = utils.download_file('http://example.com/file')
+                os.remove(path)
+                path = utils.download_file('http://example.com/file')
+            self.assertEqual(get.call_args[1]['headers'],
+                             {'If-None-Match': '"v1"'})
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), b'content')
+            # rewrite of downloaded file does not change cache
+            with open(path, 'wb') as f:
+                f.write(b'changed')
+            cached = [name for name in os.listdir(cache_dir)
+                      if name.endswith('.data')]
+            with open(os.path.join(cache_dir, cached[0]), 'rb') as f:
+                self.assertEqual(f.read(), b'content')
+            os.remove(path)
+        finally:
+            shutil.rmtree(cache_dir)
@@ -14,20 +14,143 @@
 
 import os
 import sys
+import json
 import shutil
+import getpass
+import hashlib
+import tarfile
 import zipfile
+import stat
 import tempfile
-from shutil import copy
+import threading
+from collections import OrderedDict
 
 import requests
 
 from cloudify import ctx
+from cloudify import manager
+from cloudify import utils as cloudify_utils
 from cloudify.exceptions import NonRecoverableError
 from cloudify.exceptions import OperationRetry
 from cloudify.utils import exception_to_error_cause
+from cloudify_rest_client.client import CloudifyClient
 
 from cloudify_common_sdk._compat import urlparse, text_type
 
+from .constants import (
+    PLUGINS_CACHE_SIZE,
+    DOWNLOAD_CHUNK_SIZE,
+    DOWNLOAD_RETRIES,
+    DOWNLOAD_TIMEOUT,
+    DOWNLOADS_CACHE_SIZE,
+    ZIP_COMPRESSION_LEVEL,
+    ZIP_STORED_EXTENSIONS,
+    REST_CLIENT_POOL_SIZE,
+    REST_CLIENTS_MAX,
+)
+
+# cache directories are separate for each user of host
+_CACHE_USER = text_type(os.getuid()) if hasattr(os, 'getuid') \
+    else getpass.getuser()
+# directory with downloaded wagons, shared by all operations on host
+PLUGINS_CACHE_DIR = os.path.join(
+    tempfile.gettempdir(),
+    'cloudify_deployment_proxy_wagons_{0}'.format(_CACHE_USER))
+# directory with downloaded files validated by ETag/Last-Modified
+DOWNLOADS_CACHE_DIR = os.path.join(
+    tempfile.gettempdir(),
+    'cloudify_deployment_proxy_downloads_{0}'.format(_CACHE_USER))
+
+
+class RestClientsPool(object):
+    """
+    Process-local rest clients shared by operations and threads with the
+    same connection settings and credentials, so http sessions and
+    keep-alive connections to the manager are reused.
+    """
+
+    def __init__(self, max_clients=REST_CLIENTS_MAX):
+        self._lock = threading.Lock()
+        self._max_clients = max_clients
+        # settings key -> client, last used at the end
+        self._clients = OrderedDict()
+
+    @staticmethod
+    def _session(pool_size):
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size,
+                                                pool_maxsize=pool_size)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def _client(self, client_config):
+        client_config = dict(client_config)
+        pool_size = client_config.pop('pool_size', None) or \
+            REST_CLIENT_POOL_SIZE
+        try:
+            return CloudifyClient(session=self._session(pool_size),
+                                  **client_config)
+        except TypeError:
+            # rest client without session argument
+            return CloudifyClient(**client_config)
+
+    @staticmethod
+    def _manager_key():
+        # credentials of current context, token changes per execution
+        try:
+            return {
+                'host': cloudify_utils.get_manager_rest_service_host(),
+                'port': cloudify_utils.get_manager_rest_service_port(),
+                'tenant': cloudify_utils.get_tenant_name(),
+                'token': cloudify_utils.get_rest_token(),
+                'execution_token': cloudify_utils.get_execution_token(),
+                'bypass_maintenance':
+                    cloudify_utils.get_is_bypass_maintenance(),
+            }
+        except (RuntimeError, AttributeError):
+            # no context, or cloudify-common without execution token
+            # helpers, client is not shared
+            return None
+
+    def get(self, client_config=None):
+        if client_config:
+            key = {'client_config': client_config}
+        else:
+            key = self._manager_key()
+            if key is None:
+                return manager.get_rest_client()
+        key = json.dumps(key, sort_keys=True, default=text_type)
+        with self._lock:
+            client = self._clients.pop(key, None)
+            if client is None:
+                if client_config:
+                    client = self._client(client_config)
+                else:
+                    client = manager.get_rest_client()
+            self._clients[key] = client
+            while len(self._clients) > self._max_clients:
+                self._clients.popitem(last=False)
+        return client
+
+    def clear(self):
+        with self._lock:
+            self._clients.clear()
+
+
+# rest clients shared by all operations in process
+rest_clients = RestClientsPool()
+
+
+def get_rest_client(client_config=None):
+    """
+    Returns shared rest client for manager from client_config or for
+    current manager if client_config is empty.
+    :param client_config: CloudifyClient arguments, optional pool_size
+        is count of kept connections.
+    """
+    return rest_clients.get(client_config)
+
 
 def generate_traceback_exception():
     _, exc_value, exc_traceback = sys.exc_info()
@@ -81,7 +204,168 @@ def proxy_operation(operation):
     return decorator
 
 
-def download_file(url, destination=None, keep_name=False):
+def _private_dir(path):
+    # cache directory writable only by current user, None if entries
+    # there can't be trusted
+    try:
+        os.makedirs(path, 0o700)
+    except OSError:
+        # created before
+        pass
+    try:
+        path_stat = os.lstat(path)
+    except OSError:
+        return None
+    if not stat.S_ISDIR(path_stat.st_mode) or \
+            (hasattr(os, 'getuid') and
+             (path_stat.st_uid != os.getuid() or
+              path_stat.st_mode & 0o077)):
+        ctx.logger.warn('Cache directory {0} is not private, '
+                        'cache is not used.'.format(path))
+        return None
+    return path
+
+
+def _cache_paths(url, cache_dir, suffix='.data'):
+    key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+    return (os.path.join(cache_dir, key + '.json'),
+            os.path.join(cache_dir, key + suffix))
+
+
+def _get_cached_download(url, cache_dir, suffix='.data'):
+    # cached validators and file for url or None
+    meta_path, data_path = _cache_paths(url, cache_dir, suffix)
+    try:
+        with open(meta_path) as meta_file:
+            meta = json.load(meta_file)
+    except (IOError, OSError, ValueError):
+        return None
+    if meta.get('url') != url or not os.path.isfile(data_path):
+        return None
+    meta['path'] = data_path
+    return meta
+
+
+def _set_cached_download(url, cache_dir, path, response, suffix='.data',
+                         cache_size=DOWNLOADS_CACHE_SIZE):
+    # only responses with validators can be checked on next download,
+    # returns cached file or None
+    etag = response.headers.get('ETag')
+    last_modified = response.headers.get('Last-Modified')
+    if not etag and not last_modified:
+        return None
+    meta_path, data_path = _cache_paths(url, cache_dir, suffix)
+    fd, temp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    os.close(fd)
+    try:
+        # copy, caller can rewrite own file later
+        shutil.copyfile(path, temp_path)
+        os.rename(temp_path, data_path)
+        with open(temp_path, 'w') as meta_file:
+            json.dump({'url': url,
+                       'etag': etag,
+                       'last_modified': last_modified}, meta_file)
+        os.rename(temp_path, meta_path)
+    finally:
+        if os.path.isfile(temp_path):
+            os.remove(temp_path)
+    _evict_cache(cache_dir, cache_size, data_path)
+    return data_path
+
+
+def _conditional_get(url, cached):
+    # request only changed file, if we have cached version
+    headers = {}
+    if cached and cached.get('etag'):
+        headers['If-None-Match'] = cached['etag']
+    if cached and cached.get('last_modified'):
+        headers['If-Modified-Since'] = cached['last_modified']
+
+    try:
+        response = requests.get(url, stream=True, headers=headers,
+                                timeout=DOWNLOAD_TIMEOUT)
+        if response.status_code != 304:
+            response.raise_for_status()
+    except requests.exceptions.RequestException as ex:
+        raise NonRecoverableError(
+            'Failed to download {0}. ({1})'.format(url, text_type(ex)))
+
+    final_url = response.url
+    if final_url != url:
+        ctx.logger.debug('Redirected to {0}'.format(final_url))
+    return response
+
+
+def _verify_checksum(url, path, checksum):
+    # checksum is "<algorithm>:<hex digest>" or sha256 hex digest
+    algorithm, _, expected = checksum.rpartition(':')
+    digest = hashlib.new(algorithm or 'sha256')
+    with open(path, 'rb') as checked_file:
+        for chunk in iter(lambda: checked_file.read(DOWNLOAD_CHUNK_SIZE),
+                          b''):
+            digest.update(chunk)
+    if digest.hexdigest() != expected.lower():
+        raise NonRecoverableError(
+            'Failed to download {0}. (checksum {1} is not {2})'.format(
+                url, digest.hexdigest(), expected))
+
+
+def _range_validator(response):
+    # If-Range accepts only strong ETag or Last-Modified
+    etag = response.headers.get('ETag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return response.headers.get('Last-Modified')
+
+
+def _resumed_from(response, written):
+    # server returned requested range of the same file version
+    if response.status_code != 206:
+        return False
+    content_range = response.headers.get('Content-Range') or ''
+    return content_range.startswith('bytes {0}-'.format(written))
+
+
+def _stream_to_file(url, response, path):
+    # resume interrupted download from written size, if server supports
+    # ranges and file is not changed, returns response with file version
+    written = 0
+    validator = _range_validator(response)
+    with open(path, 'wb') as destination_file:
+        for attempt in range(DOWNLOAD_RETRIES + 1):
+            try:
+                if attempt:
+                    ctx.logger.warn(
+                        'Download of {0} interrupted after {1} bytes, '
+                        'resume ({2}/{3}).'.format(
+                            url, written, attempt, DOWNLOAD_RETRIES))
+                    headers = {}
+                    if validator and written:
+                        headers = {'Range': 'bytes={0}-'.format(written),
+                                   'If-Range': validator}
+                    response = requests.get(
+                        url, stream=True, timeout=DOWNLOAD_TIMEOUT,
+                        headers=headers)
+                    response.raise_for_status()
+                    if not _resumed_from(response, written):
+                        # range is not supported or file changed,
+                        # start from beginning
+                        destination_file.seek(0)
+                        destination_file.truncate()
+                        written = 0
+                        validator = _range_validator(response)
+                for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                    destination_file.write(chunk)
+                    written += len(chunk)
+                return response
+            except requests.exceptions.RequestException as ex:
+                error = ex
+    raise NonRecoverableError(
+        'Failed to download {0}. ({1})'.format(url, text_type(error)))
+
+
+def download_file(url, destination=None, keep_name=False, checksum=None,
+                  use_cache=True):
     """Download file.
 
     :param url: Location of the file to download
@@ -90,12 +374,13 @@ def download_file(url, destination=None, keep_name=False):
         Location where the file should be saved (autogenerated by default)
     :param keep_name: use the filename from the url as destination filename
     :type destination: str | None
+    :param checksum: Optional, "<algorithm>:<hex digest>" or sha256 digest
+    :param use_cache: reuse file downloaded before, if server confirms
+        that ETag/Last-Modified are same
     :returns: Location where the file was saved
     :rtype: str
 
     """
-    CHUNK_SIZE = 1024
-
     if not destination:
         if keep_name:
             path = urlparse(url).path
@@ -107,24 +392,28 @@ def download_file(url, destination=None, keep_name=False):
 
     ctx.logger.info('Downloading {0} to {1}...'.format(url, destination))
 
-    try:
-        response = requests.get(url, stream=True)
-    except requests.exceptions.RequestException as ex:
-        raise NonRecoverableError(
-            'Failed to download {0}. ({1})'.format(url, text_type(ex)))
-
-    final_url = response.url
-    if final_url != url:
-        ctx.logger.debug('Redirected to {0}'.format(final_url))
+    cache_dir = _private_dir(DOWNLOADS_CACHE_DIR) if use_cache else None
+    cached = _get_cached_download(url, cache_dir) if cache_dir else None
+    response = _conditional_get(url, cached)
 
     try:
-        with open(destination, 'wb') as destination_file:
-            for chunk in response.iter_content(CHUNK_SIZE):
-                destination_file.write(chunk)
-    except IOError as ex:
+        if cached and response.status_code == 304:
+            ctx.logger.debug('Not modified, used cached {0}'.format(
+                cached['path']))
+            # mark as recently used
+            os.utime(cached['path'], None)
+            shutil.copyfile(cached['path'], destination)
+        else:
+            response = _stream_to_file(url, response, destination)
+            if cache_dir:
+                _set_cached_download(url, cache_dir, destination, response)
+    except (IOError, OSError) as ex:
         raise NonRecoverableError(
             'Failed to download {0}. ({1})'.format(url, text_type(ex)))
 
+    if checksum:
+        _verify_checksum(url, destination, checksum)
+
     return destination
 
 
@@ -148,6 +437,141 @@ def get_local_path(source, destination=None, create_temp=False):
             'using one of the allowed schemes: {0}'.format(allowed_schemes))
 
 
+def wagon_package_from_name(source):
+    """Package description from wagon file name.
+
+    Wagon file name is {name}-{version}-{python}-none-{platform}[-...].wgn
+
+    :returns: dict with package_name, package_version, supported_platform
+        or None for other names
+    """
+    name = os.path.basename(urlparse(source).path)
+    if not name.endswith('.wgn'):
+        return None
+    parts = name[:-len('.wgn')].split('-')
+    if len(parts) < 5:
+        return None
+    return {
+        'package_name': parts[0],
+        'package_version': parts[1],
+        'supported_platform': parts[4],
+    }
+
+
+def wagon_package_from_file(path):
+    """Package description from package.json in wagon archive.
+
+    :returns: dict with package_name, package_version, supported_platform
+        or None if archive can't be read
+    """
+    try:
+        with tarfile.open(path, 'r:gz') as wagon:
+            for member in wagon.getmembers():
+                # {package folder}/package.json
+                if member.name.count('/') == 1 and \
+                        member.name.endswith('/package.json'):
+                    metadata = json.loads(
+                        wagon.extractfile(member).read().decode('utf-8'))
+                    return {
+                        'package_name': metadata['package_name'],
+                        'package_version': metadata['package_version'],
+                        'supported_platform':
+                            metadata.get('supported_platform'),
+                    }
+    except (IOError, OSError, KeyError, ValueError, tarfile.TarError):
+        return None
+    return None
+
+
+def _evict_cache(cache_dir, cache_size, keep):
+    # remove least recently used files over cache size, with validators
+    files = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if name.endswith(('.tmp', '.json')) or path == keep:
+            continue
+        try:
+            path_stat = os.stat(path)
+        except OSError:
+            continue
+        files.append((path_stat.st_mtime, path_stat.st_size, path))
+    total = sum(size for _, size, _ in files) + os.path.getsize(keep)
+    for _, size, path in sorted(files):
+        if total <= cache_size:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        # cached file name starts with sha256 of url as validators file
+        meta_path = os.path.join(cache_dir,
+                                 os.path.basename(path)[:64] + '.json')
+        if os.path.isfile(meta_path):
+            os.remove(meta_path)
+        total -= size
+        ctx.logger.debug('Removed cached {0}'.format(path))
+
+
+def get_cached_wagon(source, cache_dir=None, cache_size=PLUGINS_CACHE_SIZE,
+                     checksum=None):
+    """Local path of wagon, downloaded wagons are kept in cache and
+    revalidated by ETag/Last-Modified on each use.
+
+    :param source: Url or local path of wagon
+    :param cache_dir: Cache directory, by default PLUGINS_CACHE_DIR
+    :param cache_size: Size of cache in bytes, least recently used
+        wagons are removed over it
+    :param checksum: Optional, checksum of wagon
+    :returns: Location of wagon and whether it is a temporary copy, only
+        temporary copies should be removed by caller
+    :rtype: tuple
+    """
+    if urlparse(source).scheme not in ['http', 'https']:
+        return get_local_path(source), False
+
+    cache_dir = _private_dir(cache_dir or PLUGINS_CACHE_DIR)
+    if not cache_dir:
+        return download_file(source, keep_name=True, checksum=checksum,
+                             use_cache=False), True
+
+    name = os.path.basename(urlparse(source).path)
+    suffix = '-' + name
+    cached = _get_cached_download(source, cache_dir, suffix)
+    response = _conditional_get(source, cached)
+    if cached and response.status_code == 304:
+        path = cached['path']
+        # mark as recently used
+        os.utime(path, None)
+        ctx.logger.debug('Used cached {0} for {1}'.format(path, source))
+        if checksum:
+            _verify_checksum(source, path, checksum)
+        return path, False
+
+    ctx.logger.info('Downloading {0}...'.format(source))
+    fd, temp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    os.close(fd)
+    try:
+        try:
+            response = _stream_to_file(source, response, temp_path)
+        except (IOError, OSError) as ex:
+            raise NonRecoverableError(
+                'Failed to download {0}. ({1})'.format(source,
+                                                       text_type(ex)))
+        if checksum:
+            _verify_checksum(source, temp_path, checksum)
+        path = _set_cached_download(source, cache_dir, temp_path, response,
+                                    suffix, cache_size)
+        if path:
+            return path, False
+        # can't be checked on next use, so is not cached
+        path = os.path.join(tempfile.mkdtemp(), name)
+        shutil.copyfile(temp_path, path)
+        return path, True
+    finally:
+        if os.path.isfile(temp_path):
+            os.remove(temp_path)
+
+
 def zip_folder(source, destination, include_folder=True):
     ctx.logger.debug('Creating zip archive: {0}...'.format(destination))
     with zipfile.ZipFile(destination, 'w') as zip_file:
@@ -161,11 +585,34 @@ def zip_folder(source, destination, include_folder=True):
     return destination
 
 
-def zip_files(files):
-    source_folder = tempfile.mkdtemp()
-    destination_zip = source_folder + '.zip'
+def zip_files(files, compression_level=ZIP_COMPRESSION_LEVEL):
+    """Create zip archive with files in root of archive.
+
+    Files are written directly to archive, without copies. Already
+    compressed files (e.g. wagons) are stored without compression.
+
+    :param files: Paths of files, file name is used as name in archive
+    :param compression_level: deflate level for other files, 0 - store
+    :returns: Location of created archive
+    :rtype: str
+    """
+    fd, destination_zip = tempfile.mkstemp(suffix='.zip')
+    os.close(fd)
+    # the last file with the same name is used
+    names = {}
     for path in files:
-        copy(path, source_folder)
-    zip_folder(source_folder, destination_zip, include_folder=False)
-    shutil.rmtree(source_folder)
+        names[os.path.basename(path)] = path
+    ctx.logger.debug('Creating zip archive: {0}...'.format(destination_zip))
+    with zipfile.ZipFile(destination_zip, 'w', allowZip64=True) as zip_file:
+        for name, path in sorted(names.items()):
+            if not compression_level or \
+                    name.lower().endswith(ZIP_STORED_EXTENSIONS):
+                zip_file.write(path, name, compress_type=zipfile.ZIP_STORED)
+            elif sys.version_info >= (3, 7):
+                zip_file.write(path, name,
+                               compress_type=zipfile.ZIP_DEFLATED,
+                               compresslevel=compression_level)
+            else:
+                zip_file.write(path, name,
+                               compress_type=zipfile.ZIP_DEFLATED)
     return destination_zip
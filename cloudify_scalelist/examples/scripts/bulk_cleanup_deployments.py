@@ -0,0 +1,157 @@
+#!/opt/manager/env/bin/python
+# Bulk version of cleanup_deployments.py: instances are removed and updated
+# by bulk statements with commit after each chunk of rows.
+import sys
+import time
+import argparse
+
+from manager_rest.flask_utils import setup_flask_app
+from manager_rest.storage import get_storage_manager, models, db
+from manager_rest.manager_exceptions import NotFoundError
+
+from cleanup_deployments import (classify_instances,
+                                 alive_relationships,
+                                 recount_scaling_groups)
+
+DEFAULT_CHUNK_SIZE = 1000
+
+
+def _chunks(items, chunk_size):
+    for offset in range(0, len(items), chunk_size):
+        yield items[offset:offset + chunk_size]
+
+
+def _progress(action, done, total, started):
+    sys.stderr.write("{}: {}/{} ({:.1f}s)\n"
+                     .format(action, done, total, time.time() - started))
+
+
+def _list_instances(deployment):
+    # only required columns, without load of full models
+    return db.session.query(
+        models.NodeInstance._storage_id.label('storage_id'),
+        models.NodeInstance.id.label('id'),
+        models.NodeInstance.state.label('state'),
+        models.NodeInstance.relationships.label('relationships'),
+        models.Node.id.label('node_id'),
+    ).join(
+        models.Node, models.NodeInstance._node_fk == models.Node._storage_id
+    ).filter(
+        models.Node._deployment_fk == deployment._storage_id
+    ).all()
+
+
+def bulk_cleanup_deployment(depl_id, chunk_size=DEFAULT_CHUNK_SIZE,
+                            dry_run=False):
+    with setup_flask_app().app_context():
+        sm = get_storage_manager()
+        deployment = sm.get(models.Deployment, depl_id)
+
+        started = time.time()
+        instances = _list_instances(deployment)
+        alive_instances, delete_instances, count_instances = \
+            classify_instances(instances)
+        alive_ids = set(alive_instances)
+        sys.stderr.write("Instances: {}, for save as alive: {}, for delete "
+                         "as uninitialized: {} ({:.1f}s)\n"
+                         .format(len(instances), len(alive_instances),
+                                 len(delete_instances),
+                                 time.time() - started))
+
+        # relationships to removed instances
+        relationships_updates = []
+        for instance in instances:
+            if instance.id not in alive_ids or not instance.relationships:
+                continue
+            relationships = alive_relationships(instance.relationships,
+                                                alive_ids)
+            if len(relationships) != len(instance.relationships):
+                relationships_updates.append({
+                    '_storage_id': instance.storage_id,
+                    'relationships': relationships})
+        sys.stderr.write("Instances with relationships for cleanup: {}\n"
+                         .format(len(relationships_updates)))
+
+        scaling_groups = recount_scaling_groups(deployment.scaling_groups,
+                                                count_instances)
+        sys.stderr.write("Count instances after cleanup: {}\n"
+                         .format(repr(count_instances)))
+        sys.stderr.write("Scaling groups before: {}\n"
+                         .format(repr(deployment.scaling_groups)))
+        sys.stderr.write("Scaling groups after: {}\n"
+                         .format(repr(scaling_groups)))
+
+        if dry_run:
+            sys.stderr.write("Dry run, nothing changed.\n")
+            db.session.rollback()
+            return
+
+        # update relationships before delete targets
+        started = time.time()
+        done = 0
+        for chunk in _chunks(relationships_updates, chunk_size):
+            db.session.bulk_update_mappings(models.NodeInstance, chunk)
+            db.session.commit()
+            done += len(chunk)
+            _progress("Relationships updated", done,
+                      len(relationships_updates), started)
+
+        storage_ids = [instance.storage_id for instance in instances
+                       if instance.id not in alive_ids]
+        started = time.time()
+        done = 0
+        for chunk in _chunks(storage_ids, chunk_size):
+            db.session.query(models.NodeInstance).filter(
+                models.NodeInstance._storage_id.in_(chunk)
+            ).delete(synchronize_session=False)
+            db.session.commit()
+            done += len(chunk)
+            _progress("Instances deleted", done, len(storage_ids), started)
+
+        # cleanup nodes
+        for node_id, count in count_instances.items():
+            db.session.query(models.Node).filter(
+                models.Node._deployment_fk == deployment._storage_id,
+                models.Node.id == node_id
+            ).update({'number_of_instances': count},
+                     synchronize_session=False)
+        db.session.commit()
+
+        # deployemnts update
+        deployment.scaling_groups = scaling_groups
+        sm.update(deployment)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Remove uninitialized and deleted instances of '
+                    'deployment with bulk statements.')
+    parser.add_argument('deployment_id')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+                        help='rows changed in one transaction')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='only show changes')
+    args = parser.parse_args()
+
+    try:
+        bulk_cleanup_deployment(args.deployment_id,
+                                chunk_size=args.chunk_size,
+                                dry_run=args.dry_run)
+    except NotFoundError:
+        sys.stderr.write(
+            'Could not find deployment: {depl_id}\n'.format(
+                depl_id=args.deployment_id,
+            )
+        )
+        sys.exit(2)
+    except Exception as ex:
+        sys.stderr.write(
+            'Aborting! '
+            "Can't cleanup deployment: {depl_id}\nError: {error}".format(
+                depl_id=args.deployment_id, error=repr(ex)
+            )
+        )
+        sys.exit(3)
+    print('Successfully cleaned up deployment: {depl_id}'.format(
+        depl_id=args.deployment_id,
+    ))
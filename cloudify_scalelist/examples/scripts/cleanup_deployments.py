@@ -8,6 +8,43 @@ from manager_rest.manager_exceptions import NotFoundError
 from manager_rest.resource_manager import ResourceManager
 
 
+def classify_instances(instances):
+    # instances in uninitialized/deleted state are removed, count of alive
+    # instances is saved for each node
+    alive_instances = []
+    delete_instances = []
+    count_instances = {}
+    for instance in instances:
+        if instance.node_id not in count_instances:
+            count_instances[instance.node_id] = 0
+        if instance.state not in ('uninitialized', 'deleted'):
+            alive_instances.append(instance.id)
+            # update count of instances internaly
+            count_instances[instance.node_id] += 1
+        else:
+            delete_instances.append(instance.id)
+    return alive_instances, delete_instances, count_instances
+
+
+def alive_relationships(relationships, alive_instances):
+    # alive_instances - set of alive instance ids
+    return [relationship for relationship in relationships
+            if relationship['target_id'] in alive_instances]
+
+
+def recount_scaling_groups(scaling_groups, count_instances):
+    scaling_groups = deepcopy(scaling_groups)
+    for scaling_group_name in scaling_groups:
+        scaling_group = scaling_groups[scaling_group_name]
+        instances_count = 0
+        for node in scaling_group['members']:
+            if instances_count < count_instances.get(node, 0):
+                instances_count = count_instances[node]
+        scaling_group['properties']['planned_instances'] = instances_count
+        scaling_group['properties']['current_instances'] = instances_count
+    return scaling_groups
+
+
 def cleanup_deployment(depl_id, get_all):
     with setup_flask_app().app_context():
         sm = get_storage_manager()
@@ -23,18 +60,11 @@ def cleanup_deployment(depl_id, get_all):
         instances = get_storage_manager().list(
             models.NodeInstance, **list_kwargs
         ).items
-        alive_instances = []
-        delete_instances = []
-        count_instances = {}
+        alive_instances, delete_instances, count_instances = \
+            classify_instances(instances)
+        alive_ids = set(alive_instances)
         for instance in instances:
-            if instance.node_id not in count_instances:
-                count_instances[instance.node_id] = 0
-            if instance.state not in ('uninitialized', 'deleted'):
-                alive_instances.append(instance.id)
-                # update count of instances internaly
-                count_instances[instance.node_id] += 1
-            else:
-                delete_instances.append(instance.id)
+            if instance.id not in alive_ids:
                 sm.delete(instance)
         sys.stderr.write("For save as alive: {}\n"
                          .format(repr(alive_instances)))
@@ -42,14 +72,11 @@ def cleanup_deployment(depl_id, get_all):
                          .format(repr(delete_instances)))
         # cleanup instances relationships
         for instance in instances:
-            if instance.id in alive_instances:
+            if instance.id in alive_ids:
                 sys.stderr.write("{}:Before relationships{}\n".format(
                     instance.id, repr(instance.relationships)))
-                relationships = []
-                for relationship in instance.relationships:
-                    if relationship['target_id'] in alive_instances:
-                        relationships.append(relationship)
-                instance.relationships = relationships
+                instance.relationships = alive_relationships(
+                    instance.relationships, alive_ids)
                 sys.stderr.write("{}:After relationships{}\n".format(
                     instance.id, repr(instance.relationships)))
                 sm.update(instance)
@@ -68,15 +95,8 @@ def cleanup_deployment(depl_id, get_all):
         )
         sys.stderr.write("Scaling groups before: {}\n"
                          .format(repr(deployment.scaling_groups)))
-        scaling_groups = deepcopy(deployment.scaling_groups)
-        for scaling_group_name in scaling_groups:
-            scaling_group = scaling_groups[scaling_group_name]
-            instances_count = 0
-            for node in scaling_group['members']:
-                if instances_count < count_instances.get(node, 0):
-                    instances_count = count_instances[node]
-            scaling_group['properties']['planned_instances'] = instances_count
-            scaling_group['properties']['current_instances'] = instances_count
+        scaling_groups = recount_scaling_groups(deployment.scaling_groups,
+                                                count_instances)
         deployment.scaling_groups = scaling_groups
         sm.update(deployment)
         sys.stderr.write("Scaling groups after: {}\n"
@@ -0,0 +1,535 @@
+# Copyright (c) 2018 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Benchmark of scalelist workflows on synthetic deployments.
+#
+# Workflows run against in-process fake workflow context and rest client,
+# cloudify lifecycle subgraphs are replaced by empty subgraphs, so results
+# show cost of planning (instances lookup, scale settings, runtime properties
+# updates) and graph building code in cloudify_scalelist.workflows.
+#
+# python -m cloudify_scalelist.tests.benchmark --instances 1000 10000 100000
+
+import os
+import gc
+import json
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+from collections import Counter
+
+from mock import patch
+
+import cloudify_scalelist.workflows as workflows
+
+try:
+    import tracemalloc
+except ImportError:
+    # python 2
+    tracemalloc = None
+
+TRANSACTION_FIELD = '_transaction'
+OPERATION = 'cloudify.interfaces.lifecycle.update'
+SCENARIOS = ['scaleuplist', 'scaleuplist_dry_run', 'scaledownlist',
+             'execute_operation']
+
+
+class FakeRelationship(object):
+
+    def __init__(self, target_id):
+        self.target_id = target_id
+        self.source_operations = {}
+        self.target_operations = {}
+
+    def is_derived_from(self, type_name):
+        return type_name == 'cloudify.relationships.contained_in'
+
+
+class FakeNode(object):
+
+    def __init__(self, node_id, target_id=None):
+        self.id = node_id
+        self.host_node = None
+        self.type_hierarchy = ['cloudify.nodes.Root', 'benchmark.Node']
+        self.operations = dict((operation, {}) for operation in (
+            workflows.PLAN_INSTALL_OPERATIONS +
+            workflows.PLAN_UNINSTALL_OPERATIONS + [OPERATION]))
+        self.relationships = []
+        if target_id:
+            self.relationships.append(FakeRelationship(target_id))
+        self.instances = []
+
+    @property
+    def number_of_instances(self):
+        return len(self.instances)
+
+
+class FakeRestInstance(object):
+    # node instance as returned by rest client
+
+    def __init__(self, instance_id, node_id, runtime_properties):
+        self.id = instance_id
+        self.node_id = node_id
+        self.runtime_properties = runtime_properties
+        self.version = 1
+        self.state = 'started'
+
+
+class FakeNodeInstance(object):
+    # node instance as provided by workflow context
+
+    def __init__(self, node, rest_instance, target_id=None,
+                 modification=None):
+        self.id = rest_instance.id
+        self.node = node
+        self._node_instance = rest_instance
+        self.modification = modification
+        self.relationships = []
+        if target_id:
+            self.relationships.append(FakeRelationship(target_id))
+
+    def send_event(self, message):
+        return None
+
+    def execute_operation(self, **kwargs):
+        return None
+
+
+class FakeSubgraph(object):
+
+    def __init__(self, name):
+        self.id = name
+        self.name = name
+        self.on_failure = None
+
+    def sequence(self):
+        return self
+
+    def add(self, *tasks):
+        pass
+
+
+class FakeGraph(object):
+    # counts subgraphs and dependencies, execute does nothing
+
+    def __init__(self):
+        self.tasks = {}
+        self.subgraphs = 0
+        self.dependencies = 0
+        self.executions = 0
+
+    def subgraph(self, name):
+        subgraph = FakeSubgraph(name)
+        self.tasks[id(subgraph)] = subgraph
+        self.subgraphs += 1
+        return subgraph
+
+    def add_dependency(self, src_task, dst_task):
+        self.dependencies += 1
+
+    def tasks_iter(self):
+        return iter(list(self.tasks.values()))
+
+    def remove_task(self, task):
+        self.tasks.pop(id(task), None)
+
+    def execute(self):
+        self.executions += 1
+
+
+class FakeModification(object):
+
+    def __init__(self, added, removed):
+        self.id = 'modification_{}'.format(int(time.time() * 1000))
+        self.added = FakeModificationNodes(added)
+        self.removed = FakeModificationNodes(removed)
+
+    def finish(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+class FakeModificationNodes(object):
+
+    def __init__(self, node_instances):
+        self.node_instances = node_instances
+
+
+class FakeDeployment(object):
+
+    def __init__(self, deployment):
+        self.id = 'benchmark'
+        self._deployment = deployment
+        self.scaling_groups = dict(
+            (group_id, {'members': [nodes[0].id],
+                        'properties': {
+                            'current_instances': len(nodes[0].instances)}})
+            for group_id, nodes in deployment.groups.items())
+
+    def start_modification(self, scale_settings):
+        added = []
+        removed = []
+        for scale_id, settings in scale_settings.items():
+            if scale_id in self._deployment.groups:
+                nodes = self._deployment.groups[scale_id]
+            else:
+                nodes = [self._deployment.nodes[scale_id]]
+            current = len(nodes[0].instances)
+            if settings['instances'] > current:
+                added += self._deployment.new_instances(
+                    nodes, settings['instances'] - current)
+            else:
+                hints = set(settings.get('removed_ids_include_hint', []))
+                for node in nodes:
+                    for instance in node.instances:
+                        if instance.id in hints:
+                            instance.modification = 'removed'
+                            removed.append(instance)
+        return FakeModification(added, removed)
+
+
+class FakeContext(object):
+
+    def __init__(self, deployment):
+        self._deployment = deployment
+        self.deployment = FakeDeployment(deployment)
+        self.logger = logging.getLogger('scalelist.benchmark')
+        self.graph = FakeGraph()
+
+    @property
+    def nodes(self):
+        return list(self._deployment.nodes.values())
+
+    @property
+    def node_instances(self):
+        return [instance for node in self._deployment.nodes.values()
+                for instance in node.instances]
+
+    def get_node(self, node_id):
+        return self._deployment.nodes.get(node_id)
+
+    def graph_mode(self):
+        return self.graph
+
+    def refresh_node_instances(self):
+        pass
+
+
+class FakeRestClient(object):
+    # in-process rest client, all calls are counted in calls
+
+    def __init__(self, deployment):
+        self.calls = Counter()
+        self.node_instances = FakeNodeInstancesClient(self, deployment)
+        self.deployments = FakeDeploymentsClient(self, deployment)
+        self.events = FakeEventsClient(self)
+
+
+class FakeNodeInstancesClient(object):
+
+    def __init__(self, client, deployment):
+        self._client = client
+        self._deployment = deployment
+
+    def list(self, deployment_id=None, _include=None, _offset=None,
+             _size=None, **kwargs):
+        self._client.calls['node_instances.list'] += 1
+        instances = self._deployment.rest_instances
+        if _size is not None:
+            return instances[_offset or 0:(_offset or 0) + _size]
+        return instances
+
+    def get(self, node_instance_id, **kwargs):
+        self._client.calls['node_instances.get'] += 1
+        return self._deployment.rest_index[node_instance_id]
+
+    def update(self, node_instance_id, **kwargs):
+        self._client.calls['node_instances.update'] += 1
+        instance = self._deployment.rest_index[node_instance_id]
+        if 'runtime_properties' in kwargs:
+            instance.runtime_properties = kwargs['runtime_properties']
+        instance.version += 1
+        return instance
+
+
+class FakeDeploymentsClient(object):
+
+    def __init__(self, client, deployment):
+        self._client = client
+        self._deployment = deployment
+
+    def get(self, deployment_id, **kwargs):
+        self._client.calls['deployments.get'] += 1
+        return {'groups': dict(
+            (group_id, {'members': [nodes[0].id]})
+            for group_id, nodes in self._deployment.groups.items())}
+
+
+class FakeEventsClient(object):
+
+    def __init__(self, client):
+        self._client = client
+
+    def list(self, **kwargs):
+        self._client.calls['events.list'] += 1
+        return []
+
+
+class SyntheticDeployment(object):
+    # groups of nodes chains, each node contained in previous node of chain,
+    # instances of one chain position ("unit") share transaction
+
+    def __init__(self, instances, groups=4, depth=3):
+        self.nodes = {}
+        self.groups = {}
+        self.rest_instances = []
+        self.rest_index = {}
+        self._created = 0
+        units = max(1, instances // (groups * depth))
+        for group in range(groups):
+            group_id = 'group{}'.format(group)
+            nodes = []
+            for level in range(depth):
+                node = FakeNode('{}_node{}'.format(group_id, level),
+                                nodes[-1].id if nodes else None)
+                self.nodes[node.id] = node
+                nodes.append(node)
+            self.groups[group_id] = nodes
+            self.new_instances(nodes, units, existing=True)
+
+    def new_instances(self, nodes, count, existing=False):
+        created = []
+        for _ in range(count):
+            unit = self._created
+            self._created += 1
+            target_id = None
+            for node in nodes:
+                rest_instance = FakeRestInstance(
+                    '{}_{}'.format(node.id, unit), node.id,
+                    {TRANSACTION_FIELD: 'transaction_{}'.format(unit),
+                     'name': 'unit_{}'.format(unit)})
+                instance = FakeNodeInstance(
+                    node, rest_instance, target_id,
+                    None if existing else 'added')
+                if existing:
+                    node.instances.append(instance)
+                self.rest_instances.append(rest_instance)
+                self.rest_index[rest_instance.id] = rest_instance
+                created.append(instance)
+                target_id = instance.id
+        return created
+
+    @property
+    def instances_count(self):
+        return len(self.rest_instances)
+
+
+def _fake_subgraph(instance, graph, ignore_failure=False):
+    return graph.subgraph(instance.id)
+
+
+def _fake_lifecycle(graph, node_instances, related_nodes=None,
+                    ignore_failure=False):
+    # subgraph for each instance and dependency for each relationship
+    subgraphs = dict((instance.id, graph.subgraph(instance.id))
+                     for instance in node_instances)
+    for instance in node_instances:
+        for rel in instance.relationships:
+            if rel.target_id in subgraphs:
+                graph.add_dependency(subgraphs[instance.id],
+                                     subgraphs[rel.target_id])
+    graph.execute()
+
+
+class FakeLimitedLifecycleProcessor(object):
+
+    def __init__(self, graph, node_instances, max_in_flight,
+                 related_nodes=None, ignore_failure=False):
+        self.graph = graph
+        self.node_instances = node_instances
+        self.max_in_flight = max_in_flight
+
+    def _run(self):
+        subgraphs = dict((instance.id, self.graph.subgraph(instance.id))
+                         for instance in self.node_instances)
+        workflows._add_lane_dependencies(
+            self.graph, subgraphs,
+            [instance.id for instance in self.node_instances],
+            self.max_in_flight)
+        self.graph.execute()
+
+    install = _run
+    uninstall = _run
+
+
+def _scenario_kwargs(deployment, scenario, scale, node_sequence,
+                     batch_size, max_in_flight):
+    first_nodes = [nodes[0].id for nodes in deployment.groups.values()]
+    sequence = None
+    if node_sequence:
+        sequence = [node.id for level in zip(*deployment.groups.values())
+                    for node in level]
+    if scenario in ('scaleuplist', 'scaleuplist_dry_run'):
+        return {
+            'scalable_entity_properties': dict(
+                (node_id, [{'name': 'new'} for _ in range(scale)])
+                for node_id in first_nodes),
+            'scale_transaction_field': TRANSACTION_FIELD,
+            'node_sequence': sequence,
+            'batch_size': batch_size,
+            'max_in_flight': max_in_flight,
+            'dry_run': scenario == 'scaleuplist_dry_run',
+        }
+    if scenario == 'scaledownlist':
+        return {
+            'scale_transaction_field': TRANSACTION_FIELD,
+            'scale_node_name': first_nodes,
+            'scale_node_field': 'name',
+            'scale_node_field_value': ['unit_{}'.format(unit)
+                                       for unit in range(scale)],
+            'all_results': True,
+            'node_sequence': sequence,
+            'batch_size': batch_size,
+            'max_in_flight': max_in_flight,
+        }
+    return {
+        'operation': OPERATION,
+        'operation_kwargs': {},
+        'allow_kwargs_override': None,
+        'run_by_dependency_order': True,
+        'type_names': ['benchmark.Node'],
+        'node_ids': [],
+        'node_instance_ids': [],
+        'node_field': ['name'],
+        'node_field_value': ['unit_{}'.format(unit)
+                             for unit in range(scale)],
+        'max_concurrency': max_in_flight,
+        'batch_size': batch_size,
+    }
+
+
+def run_benchmark(instances, scenario, groups=4, depth=3, scale=10,
+                  node_sequence=True, batch_size=0, max_in_flight=0):
+    """Run one workflow on synthetic deployment, returns measurements"""
+    deployment = SyntheticDeployment(instances, groups=groups, depth=depth)
+    instances = deployment.instances_count
+    ctx = FakeContext(deployment)
+    client = FakeRestClient(deployment)
+    kwargs = _scenario_kwargs(deployment, scenario, scale, node_sequence,
+                              batch_size, max_in_flight)
+    timings_dir = tempfile.mkdtemp()
+    if scenario != 'execute_operation':
+        kwargs['timings_file'] = os.path.join(timings_dir, 'timings.json')
+    func = getattr(workflows, scenario.replace('_dry_run', ''))
+
+    gc.collect()
+    if tracemalloc:
+        tracemalloc.start()
+    started = time.time()
+    try:
+        with patch('cloudify_scalelist.workflows.get_rest_client',
+                   return_value=client), \
+                patch.object(workflows.lifecycle,
+                             'install_node_instances', _fake_lifecycle), \
+                patch.object(workflows.lifecycle,
+                             'uninstall_node_instances', _fake_lifecycle), \
+                patch.object(workflows.lifecycle,
+                             'install_node_instance_subgraph',
+                             _fake_subgraph), \
+                patch.object(workflows.lifecycle,
+                             'uninstall_node_instance_subgraph',
+                             _fake_subgraph), \
+                patch.object(workflows, '_LimitedLifecycleProcessor',
+                             FakeLimitedLifecycleProcessor):
+            func(ctx=ctx, **kwargs)
+        duration = time.time() - started
+        peak_memory = None
+        if tracemalloc:
+            peak_memory = tracemalloc.get_traced_memory()[1]
+        phases = None
+        if kwargs.get('timings_file') and os.path.isfile(
+            kwargs['timings_file']
+        ):
+            with open(kwargs['timings_file']) as timings:
+                phases = json.load(timings)['phases']
+    finally:
+        if tracemalloc:
+            tracemalloc.stop()
+        shutil.rmtree(timings_dir)
+
+    return {
+        'scenario': scenario,
+        'instances': instances,
+        'groups': groups,
+        'depth': depth,
+        'scale': scale,
+        'duration': round(duration, 3),
+        'peak_memory': peak_memory,
+        'rest_calls': dict(client.calls),
+        'subgraphs': ctx.graph.subgraphs,
+        'dependencies': ctx.graph.dependencies,
+        'phases': phases,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark scalelist workflows on synthetic deployments.')
+    parser.add_argument('--instances', type=int, nargs='+',
+                        default=[1000, 10000])
+    parser.add_argument('--scenarios', nargs='+', default=SCENARIOS,
+                        choices=SCENARIOS)
+    parser.add_argument('--groups', type=int, default=4,
+                        help='count of scaling groups')
+    parser.add_argument('--depth', type=int, default=3,
+                        help='count of contained nodes in each group')
+    parser.add_argument('--scale', type=int, default=10,
+                        help='scale delta (units) for each group')
+    parser.add_argument('--without-node-sequence', action='store_true')
+    parser.add_argument('--batch-size', type=int, default=0)
+    parser.add_argument('--max-in-flight', type=int, default=0)
+    parser.add_argument('--output', help='save results as json')
+    args = parser.parse_args()
+
+    # workflows log each dependency, skip formatting cost of log records
+    logging.getLogger('scalelist.benchmark').setLevel(logging.WARNING)
+
+    results = []
+    for instances in args.instances:
+        for scenario in args.scenarios:
+            result = run_benchmark(
+                instances, scenario, groups=args.groups, depth=args.depth,
+                scale=args.scale,
+                node_sequence=not args.without_node_sequence,
+                batch_size=args.batch_size,
+                max_in_flight=args.max_in_flight)
+            results.append(result)
+            print('{scenario:20} {instances:>7} instances: {duration:8.3f}s '
+                  '{memory:>10} peak, {rest} rest calls, {subgraphs} '
+                  'subgraphs, {dependencies} dependencies'.format(
+                      memory=result['peak_memory'],
+                      rest=sum(result['rest_calls'].values()),
+                      **result))
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
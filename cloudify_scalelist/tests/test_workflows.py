@@ -12,15 +12,23 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
 import json
+import shutil
+import tempfile
 import unittest
-from mock import Mock, patch, call
+import threading
+from mock import ANY, Mock, patch, call
 
 from cloudify.state import current_ctx
 from cloudify.mocks import MockCloudifyContext
+from cloudify.exceptions import NonRecoverableError
+from cloudify.workflows.tasks import HandlerResult
+from cloudify.workflows.tasks_graph import TaskDependencyGraph
 from cloudify.workflows.workflow_api import ExecutionCancelled
 
 import cloudify_scalelist.workflows as workflows
+import cloudify_scalelist.tests.benchmark as benchmark
 
 # add filter check
 import cloudify_common_sdk.filters as filters
@@ -165,6 +173,60 @@ class TestScaleList(unittest.TestCase):
             version=2)
         client.node_instances.get.assert_called_with('target')
 
+    def test_update_runtime_properties_conflict(self):
+        client = self._gen_rest_client()
+        conflict = workflows.CloudifyClientError('conflict', status_code=409)
+        client.node_instances.update = Mock(side_effect=[conflict, None])
+        with patch(
+            "cloudify_scalelist.workflows.get_rest_client",
+            Mock(return_value=client)
+        ):
+            workflows._update_runtime_properties(
+                self._gen_ctx(),
+                'target',
+                json.loads(json.dumps({'a': 'c'}))
+            )
+        self.assertEqual(client.node_instances.update.call_count, 2)
+        # no verify get without debug
+        self.assertEqual(client.node_instances.get.call_count, 2)
+
+        # other errors are raised
+        client = self._gen_rest_client()
+        client.node_instances.update = Mock(
+            side_effect=workflows.CloudifyClientError('error',
+                                                      status_code=500))
+        with patch(
+            "cloudify_scalelist.workflows.get_rest_client",
+            Mock(return_value=client)
+        ):
+            with self.assertRaises(workflows.CloudifyClientError):
+                workflows._update_runtime_properties(
+                    self._gen_ctx(), 'target', {'a': 'c'})
+        self.assertEqual(client.node_instances.update.call_count, 1)
+
+    def test_update_runtime_properties_bulk(self):
+        client = self._gen_rest_client()
+        with patch(
+            "cloudify_scalelist.workflows.get_rest_client",
+            Mock(return_value=client)
+        ):
+            workflows._update_runtime_properties_bulk(
+                self._gen_ctx(),
+                [('a', {'a': 'c'}), ('b', {'f': 'g'}), ('c', {'a': 'h'})],
+                pool_size=2, batch_size=2
+            )
+        client.node_instances.update.assert_has_calls([
+            call(node_instance_id='a',
+                 runtime_properties={'a': 'c', 'd': 'e'},
+                 version=2),
+            call(node_instance_id='b',
+                 runtime_properties={'a': 'b', 'd': 'e', 'f': 'g'},
+                 version=2),
+            call(node_instance_id='c',
+                 runtime_properties={'a': 'h', 'd': 'e'},
+                 version=2)], any_order=True)
+        self.assertEqual(client.node_instances.get.call_count, 3)
+
     def test_cleanup_instances(self):
         client = self._gen_rest_client()
         with patch(
@@ -179,6 +241,132 @@ class TestScaleList(unittest.TestCase):
             runtime_properties={}, version=2)
         client.node_instances.get.assert_called_with('target')
 
+    def test_cleanup_instances_failures(self):
+        _ctx = self._gen_ctx()
+        client = self._gen_rest_client()
+
+        def _update(node_instance_id, **kwargs):
+            if node_instance_id == 'broken':
+                raise workflows.CloudifyClientError('Broken',
+                                                    status_code=500)
+
+        client.node_instances.update = Mock(side_effect=_update)
+        with patch(
+            "cloudify_scalelist.workflows.get_rest_client",
+            Mock(return_value=client)
+        ):
+            with patch(
+                "cloudify_scalelist.workflows._is_debug",
+                Mock(return_value=False)
+            ):
+                failures = workflows._cleanup_instances(
+                    _ctx, ['first', 'broken', 'second'], pool_size=2)
+        self.assertEqual([instance_id for instance_id, _ in failures],
+                         ['broken'])
+        self.assertEqual(failures[0][1].status_code, 500)
+        # all instances processed, without verification requests
+        self.assertEqual(client.node_instances.update.call_count, 3)
+        self.assertEqual(client.node_instances.get.call_count, 3)
+        self.assertEqual(workflows._cleanup_instances(_ctx, []), [])
+
+    def test_transaction_index_updates(self):
+        add = workflows._transaction_index_add(
+            'tx2', [('a_type', 'a2'), ('b_type', 'b2'), ('a_type', 'a1')])
+        properties = {workflows.TRANSACTION_INDEX_PROPERTY: {
+            'tx1': {'a_type': ['a1']}}}
+        properties.update(add(properties))
+        properties.update(add(properties))
+        self.assertEqual(properties[workflows.TRANSACTION_INDEX_PROPERTY], {
+            'tx1': {'a_type': ['a1']},
+            'tx2': {'a_type': ['a2', 'a1'], 'b_type': ['b2']}})
+        remove = workflows._transaction_index_remove(['a1', 'b2'])
+        self.assertEqual(remove(properties), {
+            workflows.TRANSACTION_INDEX_PROPERTY: {
+                'tx2': {'a_type': ['a2']}}})
+        self.assertEqual(remove({}), {
+            workflows.TRANSACTION_INDEX_PROPERTY: {}})
+
+    def test_get_indexed_transaction_instances(self):
+        _ctx = self._gen_ctx()
+        client = self._gen_rest_client()
+        index_instance = Mock()
+        index_instance.runtime_properties = {
+            workflows.TRANSACTION_INDEX_PROPERTY: {
+                '1': {'a_type': ['a_id'], 'b_type': ['b_id']}}}
+        client.node_instances.get = Mock(return_value=index_instance)
+        kwargs = dict(ctx=_ctx, index_instance_id='index',
+                      scale_transaction_field='_transaction',
+                      scale_node_names=None)
+        with patch(
+            "cloudify_scalelist.workflows.get_rest_client",
+            Mock(return_value=client)
+        ):
+            # direct lookup by transaction id
+            self.assertEqual(
+                workflows._get_indexed_transaction_instances(
+                    scale_node_field_path=['_transaction'],
+                    scale_node_field_values=['1'], **kwargs),
+                ({'a_type': ['a_id'], 'b_type': ['b_id']},
+                 ['a_id', 'b_id']))
+            client.node_instances.list.assert_not_called()
+            # unknown transaction requires full scan
+            self.assertIsNone(
+                workflows._get_indexed_transaction_instances(
+                    scale_node_field_path=['_transaction'],
+                    scale_node_field_values=['1', 'unknown'], **kwargs))
+            self.assertIsNone(
+                workflows._get_indexed_transaction_instances(
+                    scale_node_field_path=['_transaction'],
+                    scale_node_field_values=[1], **kwargs))
+            self.assertIsNone(
+                workflows._get_indexed_transaction_instances(
+                    scale_node_field_path=['_transaction'],
+                    scale_node_field_values=[['1']], **kwargs))
+            # duplicated transaction ids
+            self.assertEqual(
+                workflows._get_indexed_transaction_instances(
+                    scale_node_field_path=['_transaction'],
+                    scale_node_field_values=['1', '1'], **kwargs),
+                ({'a_type': ['a_id'], 'b_type': ['b_id']},
+                 ['a_id', 'b_id']))
+            # transaction without instances of selected nodes
+            self.assertEqual(
+                workflows._get_indexed_transaction_instances(
+                    scale_node_field_path=['_transaction'],
+                    scale_node_field_values=['1'],
+                    **dict(kwargs, scale_node_names=set(['c_type']))),
+                ({}, []))
+            self.assertEqual(
+                workflows._get_indexed_transaction_instances(
+                    scale_node_field_path=['_transaction'],
+                    scale_node_field_values=['1'],
+                    **dict(kwargs, scale_node_names=set(['b_type']))),
+                ({'a_type': ['a_id'], 'b_type': ['b_id']},
+                 ['a_id', 'b_id']))
+            client.node_instances.list.assert_not_called()
+            # search without node names requires full scan
+            self.assertIsNone(
+                workflows._get_indexed_transaction_instances(
+                    scale_node_field_path=['name'],
+                    scale_node_field_values=['value'], **kwargs))
+            # list only selected node
+            kwargs['scale_node_names'] = set(['a_type'])
+            self.assertEqual(
+                workflows._get_indexed_transaction_instances(
+                    scale_node_field_path=['name'],
+                    scale_node_field_values=['value'], **kwargs),
+                ({'a_type': ['a_id'], 'b_type': ['b_id']},
+                 ['a_id', 'b_id']))
+            client.node_instances.list.assert_called_with(
+                deployment_id='deployment_id', node_id='a_type',
+                _include=['runtime_properties', 'node_id', 'id'])
+            # transaction created before index
+            index_instance.runtime_properties = {}
+            self.assertIsNone(
+                workflows._get_indexed_transaction_instances(
+                    scale_node_field_path=['name'],
+                    scale_node_field_values=['value'], **kwargs))
+
     def test_empty_scaleup_params(self):
         with self.assertRaises(ValueError):
             workflows.scaleuplist(ctx=Mock(),
@@ -205,7 +393,7 @@ class TestScaleList(unittest.TestCase):
             )
             client.node_instances.list.assert_called_with(
                 _include=['runtime_properties', 'node_id', 'id'],
-                _get_all_results=True,
+                _offset=0, _size=workflows.LIST_PAGE_SIZE,
                 deployment_id='deployment_id')
         # only first page
         client.node_instances.list = Mock(return_value=[])
@@ -332,7 +520,11 @@ class TestScaleList(unittest.TestCase):
                 _ctx, json.loads(json.dumps({'one_scale': {'instances': 11}})),
                 json.loads(json.dumps({'one': [{'name': 'one'}]})),
                 '_transaction',
-                'transaction_value', False, False, node_sequence=None)
+                'transaction_value', False, False, node_sequence=None,
+                node_sequence_by_relationships=False,
+                batch_size=0, max_in_flight=0,
+                timer=ANY, transaction_index_instance='',
+                cleanup_pool_size=10)
             # can downscale without errors, ignore failure
             fake_run_scale = Mock(return_value=None)
             with patch(
@@ -351,7 +543,48 @@ class TestScaleList(unittest.TestCase):
                 _ctx, json.loads(json.dumps({'one_scale': {'instances': 11}})),
                 json.loads(json.dumps({'one': [{'name': 'one'}]})),
                 '_transaction',
-                'transaction_value', False, True, node_sequence=None)
+                'transaction_value', False, True, node_sequence=None,
+                node_sequence_by_relationships=False,
+                batch_size=0, max_in_flight=0,
+                timer=ANY, transaction_index_instance='',
+                cleanup_pool_size=10)
+
+    def test_report_phase_timings(self):
+        _ctx = self._gen_ctx()
+        _ctx.internal = Mock()
+        timer = workflows._PhaseTimer()
+        func = Mock(return_value='result')
+        timed = timer.wrap('graph_execute', func)
+        self.assertEqual(timed(1, a=2), 'result')
+        func.assert_called_with(1, a=2)
+        with timer.phase('graph_execute'):
+            pass
+        with self.assertRaises(ValueError):
+            with timer.phase('install'):
+                raise ValueError()
+        timings_dir = tempfile.mkdtemp()
+        try:
+            timings_file = os.path.join(timings_dir, 'timings.json')
+            summary = workflows._report_phase_timings(_ctx, timer,
+                                                      timings_file)
+            with open(timings_file) as timings:
+                self.assertEqual(json.load(timings), summary)
+        finally:
+            shutil.rmtree(timings_dir)
+        self.assertEqual(list(summary['phases']),
+                         ['graph_execute', 'install'])
+        self.assertEqual(summary['phases']['graph_execute']['count'], 2)
+        self.assertEqual(summary['phases']['install']['count'], 1)
+        _ctx.internal.send_workflow_event.assert_called_with(
+            event_type='workflow_stage', message=ANY,
+            args={'timings': summary})
+        # file write error is only logged
+        with patch.object(_ctx.logger, 'warning') as warning:
+            self.assertEqual(
+                workflows._report_phase_timings(
+                    _ctx, timer, timings_file)['phases'],
+                summary['phases'])
+            warning.assert_called_once_with(ANY)
 
     def test_run_scale_settings(self):
         _ctx = self._gen_ctx()
@@ -490,7 +723,11 @@ class TestScaleList(unittest.TestCase):
                     removed=set([added_instance]),
                     related=set([related_instance]),
                     ignore_failure=False,
-                    node_sequence=None)
+                    node_sequence=None,
+                    node_sequence_by_relationships=False,
+                    batch_size=None,
+                    max_in_flight=None,
+                    cleanup_pool_size=None)
             fake_install_node_instances.assert_called_with(
                 graph=_ctx.graph_mode(),
                 node_instances=set([added_instance]),
@@ -629,6 +866,60 @@ class TestScaleList(unittest.TestCase):
                         # ):
                         self.assertRaises(RuntimeError)
 
+    def test_wait_for_sent_tasks(self):
+        _ctx = self._gen_ctx()
+        graph = TaskDependencyGraph(Mock())
+        sent_task = Mock(id='sent', is_subgraph=False)
+        sent_task.get_state = Mock(return_value='sent')
+        sent_task.handle_task_terminated = Mock(
+            return_value=HandlerResult.cont())
+        pending_task = Mock(id='pending', is_subgraph=False)
+        pending_task.get_state = Mock(return_value='pending')
+        graph.add_task(sent_task)
+        graph.add_task(pending_task)
+        graph._waiting_for.add(sent_task)
+        # response is received by other thread
+        response = threading.Timer(0.1, graph._task_finished,
+                                   [Mock(), sent_task])
+        with patch(
+            "cloudify.workflows.api.has_cancel_request",
+            return_value=False
+        ):
+            response.start()
+            workflows._wait_for_sent_tasks(_ctx, graph)
+
+        sent_task.handle_task_terminated.assert_called_once_with()
+        self.assertEqual(graph._waiting_for, set())
+        self.assertEqual(graph.tasks, [pending_task])
+        # other tasks of graph are not checked
+        pending_task.get_state.assert_not_called()
+
+    def test_wait_for_sent_tasks_tasks_iter(self):
+        _ctx = self._gen_ctx()
+        sent_task = Mock()
+        sent_task.get_state = Mock(side_effect=[
+            'sent', 'sent', 'succeeded', 'succeeded'])
+        pending_task = Mock()
+        pending_task.get_state = Mock(return_value='pending')
+
+        graph = Mock(spec=['tasks_iter', '_finished_tasks',
+                           '_handle_terminated_task'])
+        graph.tasks_iter = Mock(return_value=[sent_task, pending_task])
+        graph._finished_tasks = Mock(return_value=[sent_task])
+        with patch(
+            "cloudify.workflows.api.has_cancel_request",
+            return_value=False
+        ), patch("time.sleep") as sleep:
+            workflows._wait_for_sent_tasks(_ctx, graph)
+
+        # all tasks checked only once
+        graph.tasks_iter.assert_called_once_with()
+        pending_task.get_state.assert_called_once_with()
+        # finished tasks are searched only on task state change
+        graph._finished_tasks.assert_called_once_with()
+        graph._handle_terminated_task.assert_called_once_with(sent_task)
+        sleep.assert_called_once_with(0.1)
+
     def test_run_scale_settings_install(self):
         _ctx = self._gen_ctx()
 
@@ -663,7 +954,7 @@ class TestScaleList(unittest.TestCase):
                     fake_update_instances = Mock(return_value=None)
                     with patch(
                         "cloudify_scalelist.workflows."
-                        "_update_runtime_properties",
+                        "_update_runtime_properties_bulk",
                         fake_update_instances
                     ):
                         workflows._run_scale_settings(
@@ -672,9 +963,8 @@ class TestScaleList(unittest.TestCase):
                             scale_transaction_field='_transaction'
                         )
                     fake_update_instances.assert_called_with(
-                        _ctx, "a",
-                        json.loads(json.dumps(
-                            {'c': 'f', '_transaction': 'transaction_id'})))
+                        _ctx, [("a", json.loads(json.dumps(
+                            {'c': 'f', '_transaction': 'transaction_id'})))])
                 fake_uninstall_instances.assert_not_called()
             fake_install_node_instances.assert_called_with(
                 graph=_ctx.graph_mode(),
@@ -721,7 +1011,7 @@ class TestScaleList(unittest.TestCase):
                     fake_update_instances = Mock(return_value=None)
                     with patch(
                         "cloudify_scalelist.workflows."
-                        "_update_runtime_properties",
+                        "_update_runtime_properties_bulk",
                         fake_update_instances
                     ):
                         workflows._run_scale_settings(
@@ -731,9 +1021,8 @@ class TestScaleList(unittest.TestCase):
                             scale_transaction_value='value'
                         )
                     fake_update_instances.assert_called_with(
-                        _ctx, "a",
-                        json.loads(json.dumps(
-                            {'c': 'f', '_transaction': 'value'})))
+                        _ctx, [("a", json.loads(json.dumps(
+                            {'c': 'f', '_transaction': 'value'})))])
                 fake_uninstall_instances.assert_not_called()
             fake_install_node_instances.assert_called_with(
                 graph=_ctx.graph_mode(),
@@ -779,7 +1068,7 @@ class TestScaleList(unittest.TestCase):
                     fake_update_instances = Mock(return_value=None)
                     with patch(
                         "cloudify_scalelist.workflows."
-                        "_update_runtime_properties",
+                        "_update_runtime_properties_bulk",
                         fake_update_instances
                     ):
                         workflows._run_scale_settings(
@@ -790,7 +1079,7 @@ class TestScaleList(unittest.TestCase):
                             node_sequence=[u'a', u'b']
                         )
                     fake_update_instances.assert_called_with(
-                        _ctx, "a", {'c': 'f', '_transaction': 'value'})
+                        _ctx, [("a", {'c': 'f', '_transaction': 'value'})])
                 fake_uninstall_instances.assert_not_called()
 
             call_func = workflows.lifecycle.install_node_instance_subgraph
@@ -800,7 +1089,9 @@ class TestScaleList(unittest.TestCase):
                 ignore_failure=False,
                 node_instance_subgraph_func=call_func,
                 node_instances=set([added_instance]),
-                node_sequence=['a', 'b']
+                node_sequence=['a', 'b'],
+                by_relationships=False,
+                max_in_flight=None
             )
         _ctx.deployment.start_modification.assert_called_with(
             scale_settings
@@ -835,6 +1126,234 @@ class TestScaleList(unittest.TestCase):
             call(added_instance, graph, ignore_failure=False),
             call(related_instance, graph, ignore_failure=False)])
 
+    def test_process_node_instances_barrier(self):
+        _ctx = self._gen_ctx()
+
+        def _gen_instance(node_id):
+            instance = Mock()
+            instance._node_instance.node_id = node_id
+            return instance
+
+        level_a = [_gen_instance("type_a") for _ in range(3)]
+        level_f = [_gen_instance("type_f") for _ in range(4)]
+        subgraphs = {}
+
+        def _call_func(node_instance, graph, ignore_failure):
+            subgraphs[node_instance.id] = Mock()
+            return subgraphs[node_instance.id]
+
+        graph = _ctx.graph_mode()
+        workflows._process_node_instances(
+            ctx=_ctx,
+            graph=graph,
+            ignore_failure=False,
+            node_instances=level_a + level_f,
+            node_instance_subgraph_func=_call_func,
+            node_sequence=["type_a", "type_f"])
+
+        # 3 + 4 dependencies instead of 3 * 4
+        self.assertEqual(graph.add_dependency.call_count, 7)
+        barrier = _ctx._subgraph[0]
+        self.assertEqual(barrier.instance_id, "subgraphtype_a->type_f")
+        graph.add_dependency.assert_has_calls(
+            [call(barrier, subgraphs[i.id]) for i in level_f] +
+            [call(subgraphs[i.id], barrier) for i in level_a])
+        graph.execute.assert_called_with()
+
+    def _gen_related_instance(self, instance_id, node_id, targets):
+        instance = Mock()
+        instance.id = instance_id
+        instance._node_instance.id = instance_id
+        instance._node_instance.node_id = node_id
+        instance.relationships = []
+        for target_id in targets:
+            relationship = Mock()
+            relationship.target_id = target_id
+            instance.relationships.append(relationship)
+        return instance
+
+    def test_install_instances_waves(self):
+        _ctx = self._gen_ctx()
+        leaf = self._gen_related_instance("leaf", "leaf", ["branch"])
+        branch = self._gen_related_instance("branch", "branch", ["tree"])
+        tree = self._gen_related_instance("tree", "tree", [])
+        related = set([Mock()])
+
+        fake_install_node_instances = Mock()
+        with patch(
+            "cloudify_scalelist.workflows.lifecycle.install_node_instances",
+            fake_install_node_instances
+        ):
+            workflows._install_instances(
+                ctx=_ctx, graph=_ctx.graph_mode(),
+                added=set([leaf, branch, tree]),
+                related=related, ignore_failure=False,
+                node_sequence=None, batch_size=2)
+
+        # relationship targets installed in previous waves
+        fake_install_node_instances.assert_has_calls([
+            call(graph=_ctx.graph_mode(), node_instances=[tree, branch],
+                 related_nodes=related, name_prefix='wave_0_'),
+            call(graph=_ctx.graph_mode(), node_instances=[leaf],
+                 related_nodes=related, name_prefix='wave_1_')])
+        # graph cleaned up between waves
+        _ctx.graph_mode().remove_task.assert_called_with(
+            _ctx.graph_mode().tasks_iter()[0])
+
+    def test_instances_waves_graph_names(self):
+        _ctx = self._gen_ctx()
+        leaf = self._gen_related_instance("leaf", "leaf", ["branch"])
+        branch = self._gen_related_instance("branch", "branch", ["tree"])
+        tree = self._gen_related_instance("tree", "tree", [])
+
+        # stored graphs are restored by name, so each wave has own graph
+        fake_process = Mock()
+        with patch(
+            "cloudify_scalelist.workflows.lifecycle.LifecycleProcessor."
+            "_process_node_instances",
+            fake_process
+        ), patch("cloudify_scalelist.workflows.lifecycle.workflow_ctx",
+                 Mock(resume=False)):
+            workflows._install_instances(
+                ctx=_ctx, graph=_ctx.graph_mode(),
+                added=set([leaf, branch, tree]),
+                related=set(), ignore_failure=False,
+                node_sequence=None, batch_size=2, max_in_flight=1)
+            with patch("cloudify_scalelist.workflows._cleanup_instances",
+                       Mock(return_value=[])):
+                workflows._uninstall_instances(
+                    _ctx, _ctx.graph_mode(), [tree, leaf, branch], [], True,
+                    node_sequence=None, batch_size=2, max_in_flight=1)
+        self.assertEqual(
+            [kwargs['name'] for _, kwargs in fake_process.call_args_list],
+            ['wave_0_install', 'wave_1_install',
+             'wave_0_uninstall', 'wave_1_uninstall'])
+
+    def test_uninstall_instances_waves(self):
+        _ctx = self._gen_ctx()
+        leaf = self._gen_related_instance("leaf", "leaf", ["branch"])
+        branch = self._gen_related_instance("branch", "branch", ["tree"])
+        tree = self._gen_related_instance("tree", "tree", [])
+
+        fake_process_node_instances = Mock()
+        with patch(
+            "cloudify_scalelist.workflows._process_node_instances",
+            fake_process_node_instances
+        ):
+            fake_cleanup_instances = Mock(return_value=[])
+            with patch(
+                "cloudify_scalelist.workflows._cleanup_instances",
+                fake_cleanup_instances
+            ):
+                workflows._uninstall_instances(
+                    _ctx, _ctx.graph_mode(), [tree, leaf, branch], [], True,
+                    node_sequence=["tree", "branch", "leaf"],
+                    batch_size=2, max_in_flight=1)
+            fake_cleanup_instances.assert_has_calls([
+                call(_ctx, ["tree", "branch"], workflows.CLEANUP_POOL_SIZE),
+                call(_ctx, ["leaf"], workflows.CLEANUP_POOL_SIZE)])
+
+        # uninstall sequence is reversed
+        self.assertEqual(
+            [kwargs['node_instances'] for _, kwargs in
+             fake_process_node_instances.call_args_list],
+            [[tree, branch], [leaf]])
+        fake_process_node_instances.assert_called_with(
+            ctx=_ctx,
+            graph=_ctx.graph_mode(),
+            ignore_failure=True,
+            node_instance_subgraph_func=(
+                workflows.lifecycle.uninstall_node_instance_subgraph),
+            node_instances=[leaf],
+            node_sequence=["leaf", "branch", "tree"],
+            by_relationships=False,
+            max_in_flight=1)
+
+    def test_uninstall_instances_cleanup_failed(self):
+        _ctx = self._gen_ctx()
+        leaf = self._gen_related_instance("leaf", "leaf", [])
+        tree = self._gen_related_instance("tree", "tree", [])
+        fake_cleanup_instances = Mock(
+            return_value=[("leaf", workflows.CloudifyClientError("Broken"))])
+        with patch(
+            "cloudify_scalelist.workflows.lifecycle.uninstall_node_instances"
+        ):
+            with patch(
+                "cloudify_scalelist.workflows._cleanup_instances",
+                fake_cleanup_instances
+            ):
+                with self.assertRaisesRegex(NonRecoverableError,
+                                            "Cleanup failed for instances: "
+                                            "leaf"):
+                    workflows._uninstall_instances(
+                        _ctx, _ctx.graph_mode(), [leaf, tree], [], False,
+                        node_sequence=None, batch_size=1,
+                        cleanup_pool_size=3)
+        # next waves are not processed
+        fake_cleanup_instances.assert_called_once_with(_ctx, ["leaf"], 3)
+
+    def test_instances_order_and_lanes(self):
+        leaf = self._gen_related_instance("leaf", "leaf", ["branch"])
+        branch = self._gen_related_instance("branch", "branch", ["tree"])
+        tree = self._gen_related_instance("tree", "tree", [])
+        other = self._gen_related_instance("other", "other", [])
+        self.assertEqual(
+            workflows._instances_order([leaf, other, branch, tree]),
+            [other, tree, branch, leaf])
+        self.assertEqual(
+            workflows._instances_order([leaf, other, branch, tree],
+                                       reverse=True),
+            [leaf, branch, other, tree])
+        self.assertEqual(
+            workflows._instances_order(
+                [leaf, other, branch, tree],
+                node_sequence=["leaf", "branch", "tree"]),
+            [other, tree, branch, leaf])
+
+        graph = Mock()
+        workflows._add_lane_dependencies(
+            graph, {"a": "sa", "b": "sb", "c": "sc", "d": "sd"},
+            ["a", "b", "c", "d"], 2)
+        self.assertEqual(graph.add_dependency.call_args_list, [
+            call("sc", "sa"), call("sd", "sb")])
+
+    def test_process_node_instances_by_relationships(self):
+        _ctx = self._gen_ctx()
+
+        def _gen_instance(instance_id, node_id, targets):
+            instance = Mock()
+            instance.id = instance_id
+            instance._node_instance.node_id = node_id
+            instance.relationships = []
+            for target_id in targets:
+                relationship = Mock()
+                relationship.target_id = target_id
+                instance.relationships.append(relationship)
+            return instance
+
+        branch_a = _gen_instance("branch_a", "branch", [])
+        branch_b = _gen_instance("branch_b", "branch", [])
+        leaf_a = _gen_instance("leaf_a", "leaf", ["branch_a"])
+        leaf_b = _gen_instance("leaf_b", "leaf", ["branch_b"])
+        leaf_c = _gen_instance("leaf_c", "leaf", ["branch_b"])
+
+        graph = _ctx.graph_mode()
+        workflows._process_node_instances(
+            ctx=_ctx,
+            graph=graph,
+            ignore_failure=False,
+            node_instances=[branch_a, branch_b, leaf_a, leaf_b, leaf_c],
+            node_instance_subgraph_func=lambda instance, graph, **_: (
+                instance.id),
+            node_sequence=["leaf", "branch"],
+            by_relationships=True)
+
+        self.assertEqual(graph.add_dependency.call_args_list, [
+            call("leaf_a", "branch_a"),
+            call("leaf_b", "branch_b"),
+            call("leaf_c", "branch_b")])
+        graph.execute.assert_called_with()
+
     def test_scaledownlist_with_anytype_and_without_transaction(self):
         _ctx = self._gen_ctx()
 
@@ -864,7 +1383,12 @@ class TestScaleList(unittest.TestCase):
                 {},
                 instances_remove_ids=[u'a_id'],
                 ignore_failure=False,
-                node_sequence=None)
+                node_sequence=None,
+                node_sequence_by_relationships=False,
+                batch_size=0,
+                max_in_flight=0,
+                timer=ANY, transaction_index_instance='',
+                cleanup_pool_size=10)
 
     def test_scaledownlist(self):
         _ctx = self._gen_ctx()
@@ -926,7 +1450,10 @@ class TestScaleList(unittest.TestCase):
                     graph=_ctx.graph_mode(),
                     removed=[a_instance, b_instance],
                     related=[],
-                    ignore_failure=False, node_sequence=None)
+                    ignore_failure=False, node_sequence=None,
+                    node_sequence_by_relationships=False,
+                    batch_size=0, max_in_flight=0,
+                    cleanup_pool_size=10)
             # function params can be different between python versions,
             # check only count of calls
             self.assertTrue(fake_run_scale.call_count == 1)
@@ -1112,7 +1639,7 @@ class TestScaleList(unittest.TestCase):
             )
             client.node_instances.list.assert_called_with(
                 _include=['runtime_properties', 'node_id', 'id'],
-                _get_all_results=True,
+                _offset=0, _size=workflows.LIST_PAGE_SIZE,
                 deployment_id='deployment_id')
         # get only first page
         client.node_instances.list = Mock(return_value=[])
@@ -1160,7 +1687,7 @@ class TestScaleList(unittest.TestCase):
             )
             client.node_instances.list.assert_called_with(
                 _include=['runtime_properties', 'node_id', 'id'],
-                _get_all_results=True,
+                _offset=0, _size=workflows.LIST_PAGE_SIZE,
                 deployment_id='deployment_id')
         # get only first page
         client.node_instances.list = Mock(return_value=[instance_a])
@@ -1207,7 +1734,7 @@ class TestScaleList(unittest.TestCase):
             )
             client.node_instances.list.assert_called_with(
                 _include=[u'runtime_properties', u'node_id', u'id'],
-                _get_all_results=True,
+                _offset=0, _size=workflows.LIST_PAGE_SIZE,
                 deployment_id=u'deployment_id')
         # get only first page
         client.node_instances.list = Mock(return_value=[instance_a])
@@ -1247,6 +1774,42 @@ class TestScaleList(unittest.TestCase):
                     u'b_type': [u'b_id'],
                 }, [u'a_id', u'b_id'])
             )
+        # we have read instances only once
+        self.assertEqual(client.node_instances.list.call_count, 1)
+
+    def test_get_transaction_instances_pages(self):
+        _ctx = self._gen_ctx()
+
+        client = self._gen_rest_client()
+        instances = client.node_instances.list()
+        client.node_instances.list = Mock(side_effect=[
+            instances[:2], instances[2:], []])
+        with patch(
+            u"cloudify_scalelist.workflows.get_rest_client",
+            Mock(return_value=client)
+        ), patch(
+            u"cloudify_scalelist.workflows.LIST_PAGE_SIZE", 2
+        ):
+            self.assertEqual(
+                workflows._get_transaction_instances(
+                    ctx=_ctx,
+                    all_results=True,
+                    scale_transaction_field=u'_transaction',
+                    scale_node_names=[u"a_type"],
+                    scale_node_field_path=[u"name"],
+                    scale_node_field_values=[u"value"]
+                ), ({
+                    u'a_type': [u'a_id'],
+                    u'b_type': [u'b_id'],
+                }, [u'a_id', u'b_id'])
+            )
+        client.node_instances.list.assert_has_calls([
+            call(_include=[u'runtime_properties', u'node_id', u'id'],
+                 _offset=0, _size=2, deployment_id=u'deployment_id'),
+            call(_include=[u'runtime_properties', u'node_id', u'id'],
+                 _offset=2, _size=2, deployment_id=u'deployment_id'),
+            call(_include=[u'runtime_properties', u'node_id', u'id'],
+                 _offset=4, _size=2, deployment_id=u'deployment_id')])
 
     def test_uninstall_instances_relationships(self):
         _ctx = self._gen_ctx()
@@ -1268,7 +1831,7 @@ class TestScaleList(unittest.TestCase):
             u"cloudify_scalelist.workflows.lifecycle.uninstall_node_instances",
             fake_uninstall_node_instances
         ):
-            fake_cleanup_instances = Mock()
+            fake_cleanup_instances = Mock(return_value=[])
             with patch(
                 u"cloudify_scalelist.workflows._cleanup_instances",
                 fake_cleanup_instances
@@ -1278,7 +1841,8 @@ class TestScaleList(unittest.TestCase):
                                                [c_instance],
                                                True,
                                                node_sequence=[])
-            fake_cleanup_instances.assert_called_with(_ctx, [u"a_id", u"b_id"])
+            fake_cleanup_instances.assert_called_with(
+                _ctx, [u"a_id", u"b_id"], workflows.CLEANUP_POOL_SIZE)
         fake_uninstall_node_instances.assert_called_with(
             graph=_ctx.graph_mode(),
             node_instances=[a_instance, b_instance],
@@ -1308,7 +1872,7 @@ class TestScaleList(unittest.TestCase):
             "cloudify_scalelist.workflows._process_node_instances",
             fake_process_node_instances
         ):
-            fake_cleanup_instances = Mock()
+            fake_cleanup_instances = Mock(return_value=[])
             with patch(
                 "cloudify_scalelist.workflows._cleanup_instances",
                 fake_cleanup_instances
@@ -1318,7 +1882,8 @@ class TestScaleList(unittest.TestCase):
                                                [c_instance],
                                                True,
                                                node_sequence=[u'a', u'b'])
-            fake_cleanup_instances.assert_called_with(_ctx, [u"a_id", u"b_id"])
+            fake_cleanup_instances.assert_called_with(
+                _ctx, [u"a_id", u"b_id"], workflows.CLEANUP_POOL_SIZE)
 
         call_func = workflows.lifecycle.uninstall_node_instance_subgraph
         fake_process_node_instances.assert_called_with(
@@ -1327,7 +1892,9 @@ class TestScaleList(unittest.TestCase):
             ignore_failure=True,
             node_instance_subgraph_func=call_func,
             node_instances=[a_instance, b_instance],
-            node_sequence=[u'b', u'a']
+            node_sequence=[u'b', u'a'],
+            by_relationships=False,
+            max_in_flight=None
         )
         _ctx.graph_mode().remove_task.assert_called_with(
             _ctx.graph_mode().tasks_iter()[0])
@@ -1479,6 +2046,54 @@ class TestScaleList(unittest.TestCase):
             []
         )
 
+    def test_filter_node_instances_index(self):
+        _ctx = self._gen_ctx()
+        node = Mock()
+        node.type_hierarchy = [u'root_type', u'a_type']
+        node.operations = [u'a.b.c']
+        node.id = u'a'
+        node.instances = []
+        for instance_id, value in [
+            (u'a', [{u'b': u'c'}]), (u'b', [{u'b': u'd'}]),
+            (u'c', [{u'b': {u'e': u'f'}}]), (u'd', u'c'),
+            (u'e', [{u'b': u'c'}]), (u'f', [])
+        ]:
+            instance = Mock()
+            instance.id = instance_id
+            instance._node_instance.runtime_properties = {u'a': value}
+            node.instances.append(instance)
+        _ctx.nodes = [node]
+        # same as get_field_value_recursive
+        get_value = workflows._field_value_getter([u'a', u'0', u'b'])
+        for instance in node.instances:
+            properties = instance._node_instance.runtime_properties
+            self.assertEqual(
+                get_value(properties),
+                filters.get_field_value_recursive(
+                    _ctx.logger, properties, [u'a', u'0', u'b']))
+        # hashable and unhashable values, order of instances is kept
+        filtered = workflows._filter_node_instances(
+            ctx=_ctx,
+            node_ids=[u'a'],
+            node_instance_ids=[u'e', u'c', u'a', u'b'],
+            type_names=[u'a_type', u'b_type'],
+            operation=u'a.b.c',
+            node_field_path=[u'a', u'0', u'b'],
+            node_field_value=[u'c', {u'e': u'f'}])
+        self.assertEqual([instance.id for instance in filtered],
+                         [u'a', u'c', u'e'])
+        # without field filter
+        filtered = workflows._filter_node_instances(
+            ctx=_ctx,
+            node_ids=[],
+            node_instance_ids=[u'f', u'd'],
+            type_names=[],
+            operation=u'a.b.c',
+            node_field_path=[],
+            node_field_value=[])
+        self.assertEqual([instance.id for instance in filtered],
+                         [u'd', u'f'])
+
     def test_execute_operation(self):
         _ctx = self._gen_ctx()
         # fake instance
@@ -1523,6 +2138,222 @@ class TestScaleList(unittest.TestCase):
         _ctx._graph.add_dependency.assert_called_with(_ctx._subgraph[1],
                                                       _ctx._subgraph[0])
 
+    def _gen_operation_ctx(self, count):
+        _ctx = self._gen_ctx()
+        node = Mock()
+        node.type_hierarchy = [u'root_type', u'a_type']
+        node.operations = [u"a.b.c"]
+        node.id = u'a'
+        node.instances = []
+        for index in range(count):
+            instance = Mock()
+            instance.id = u'a{}'.format(index)
+            instance.node = node
+            instance.relationships = []
+            node.instances.append(instance)
+        _ctx.node_instances = node.instances
+        _ctx.nodes = [node]
+        return _ctx
+
+    def test_execute_operation_batches(self):
+        _ctx = self._gen_operation_ctx(5)
+        workflows.execute_operation(
+            ctx=_ctx,
+            operation=u'a.b.c',
+            operation_kwargs={},
+            allow_kwargs_override=None,
+            run_by_dependency_order=False,
+            type_names=[],
+            node_ids=[],
+            node_instance_ids=[],
+            node_field=[],
+            node_field_value=[],
+            max_concurrency={u'a_type': 2, u'b_type': 1},
+            batch_size=3)
+        graph = _ctx._graph
+        self.assertEqual(graph.execute.call_count, 2)
+        self.assertEqual(graph.remove_task.call_count, 1)
+        # a2 waits for a0 in first batch, nothing to wait in second
+        subgraphs = dict((subgraph.instance_id, subgraph)
+                         for subgraph in _ctx._subgraph)
+        graph.add_dependency.assert_called_once_with(subgraphs['subgrapha2'],
+                                                     subgraphs['subgrapha0'])
+
+    def test_execute_operation_failure_rate(self):
+        _ctx = self._gen_operation_ctx(4)
+
+        def _fail_first():
+            # first instance in batch failed
+            subgraph = _ctx._subgraph[-2]
+            failed_task = Mock()
+            failed_task.get_state = Mock(return_value='failed')
+            finished_event = Mock()
+            finished_event.get_state = Mock(return_value='pending')
+            subgraph.tasks = {'operation': failed_task,
+                              'finished': finished_event}
+            self.assertEqual(subgraph.on_failure(subgraph).action,
+                             workflows.tasks.HandlerResult.HANDLER_IGNORE)
+            # finished event of failed operation is not sent
+            subgraph.remove_task.assert_called_once_with(finished_event)
+
+        _ctx._graph.execute = Mock(side_effect=_fail_first)
+        kwargs = dict(
+            ctx=_ctx,
+            operation=u'a.b.c',
+            operation_kwargs={},
+            allow_kwargs_override=None,
+            run_by_dependency_order=False,
+            type_names=[],
+            node_ids=[],
+            node_instance_ids=[],
+            node_field=[],
+            node_field_value=[],
+            batch_size=2)
+        # half of instances failed
+        workflows.execute_operation(max_failure_rate=0.5, **kwargs)
+        self.assertEqual(_ctx._graph.execute.call_count, 2)
+        # stop after first batch
+        _ctx._graph.execute.reset_mock()
+        with self.assertRaisesRegexp(
+            RuntimeError, "Failure rate 0.500 is more than 0.3"
+        ):
+            workflows.execute_operation(max_failure_rate=0.3, **kwargs)
+        self.assertEqual(_ctx._graph.execute.call_count, 1)
+
+    def _gen_plan_node(self, node_id, number_of_instances, operations,
+                       targets=None):
+        node = Mock()
+        node.id = node_id
+        node.number_of_instances = number_of_instances
+        node.operations = dict((operation, {}) for operation in operations)
+        node.relationships = []
+        for target_id in targets or []:
+            relationship = Mock()
+            relationship.target_id = target_id
+            relationship.is_derived_from = Mock(return_value=True)
+            relationship.source_operations = {
+                'cloudify.interfaces.relationship_lifecycle.establish': {}}
+            relationship.target_operations = {}
+            node.relationships.append(relationship)
+        return node
+
+    def test_scale_plan(self):
+        _ctx = self._gen_ctx()
+        one = self._gen_plan_node('one', 10, [
+            'cloudify.interfaces.lifecycle.create',
+            'cloudify.interfaces.lifecycle.delete'])
+        two = self._gen_plan_node('two', 20, [
+            'cloudify.interfaces.lifecycle.create',
+            'cloudify.interfaces.lifecycle.start'], ['one'])
+        nodes = {'one': one, 'two': two}
+        _ctx.nodes = [one, two]
+        _ctx.get_node = Mock(side_effect=nodes.get)
+
+        timings = {'cloudify.interfaces.lifecycle.create': 2.0,
+                   'cloudify.interfaces.lifecycle.start': 4.0}
+        plan = workflows._scale_plan(
+            _ctx, {'one_scale': {'instances': 12}}, timings=timings)
+        # 2 new 'one', 4 contained 'two'
+        self.assertEqual(plan['instances'], {'one': 2, 'two': 4})
+        self.assertEqual(plan['tasks'], 2 * 1 + 4 * 3)
+        self.assertEqual(plan['dependencies'], 4)
+        self.assertEqual(plan['levels'], 2)
+        self.assertEqual(plan['waves'], 1)
+        # create(2) + create(2) + start(4) + establish(avg=3)
+        self.assertEqual(plan['estimated_duration'], 11.0)
+
+        # uninstall in waves with limited lanes
+        plan = workflows._scale_plan(
+            _ctx, {'one_scale': {'instances': 9}}, install=False,
+            node_sequence=['two', 'one'], batch_size=2, max_in_flight=1)
+        self.assertEqual(plan['instances'], {'one': 1, 'two': 2})
+        self.assertEqual(plan['tasks'], 1)
+        self.assertEqual(plan['waves'], 2)
+        self.assertEqual(plan['dependencies'], 2 + 1 * 2)
+        # waves * delete
+        self.assertEqual(
+            plan['estimated_duration'],
+            2 * workflows.PLAN_DEFAULT_OPERATION_DURATION)
+
+    def test_scaleuplist_dry_run(self):
+        _ctx = self._gen_ctx()
+        one = self._gen_plan_node('one', 10, [
+            'cloudify.interfaces.lifecycle.create'])
+        _ctx.nodes = [one]
+        _ctx.get_node = Mock(return_value=one)
+        client = self._gen_rest_client()
+        # newest events first
+        client.events.list = Mock(return_value=[{
+            'execution_id': 'e', 'node_instance_id': 'one_1',
+            'operation': 'cloudify.interfaces.lifecycle.create',
+            'event_type': 'task_succeeded',
+            'reported_timestamp': '2020-01-01T00:00:05.500Z'
+        }, {
+            'execution_id': 'e', 'node_instance_id': 'one_1',
+            'operation': 'cloudify.interfaces.lifecycle.create',
+            'event_type': 'task_started',
+            'reported_timestamp': '2020-01-01T00:00:00.000Z'
+        }])
+        with patch(
+            "cloudify_scalelist.workflows.get_rest_client",
+            Mock(return_value=client)
+        ):
+            workflows.scaleuplist(
+                ctx=_ctx, scalable_entity_properties={
+                    'one': [{'name': 'one'}]},
+                dry_run=True)
+            self.assertEqual(
+                workflows._get_operation_timings(_ctx),
+                {'cloudify.interfaces.lifecycle.create': 5.5})
+            client.events.list.assert_called_with(
+                deployment_id='deployment_id',
+                event_type=['task_started', 'task_succeeded'],
+                include_logs=False, sort='-reported_timestamp',
+                _offset=0, _size=workflows.LIST_PAGE_SIZE)
+        _ctx.deployment.start_modification.assert_not_called()
+
+    def test_get_operation_timings_pages(self):
+        _ctx = self._gen_ctx()
+        client = self._gen_rest_client()
+        events = []
+        for index in range(3):
+            events.append({
+                'execution_id': 'e', 'node_instance_id': 'i{}'.format(index),
+                'operation': 'op', 'event_type': 'task_succeeded',
+                'reported_timestamp': '2020-01-01T00:00:0{}.000Z'.format(
+                    index + 2)})
+            events.append({
+                'execution_id': 'e', 'node_instance_id': 'i{}'.format(index),
+                'operation': 'op', 'event_type': 'task_started',
+                'reported_timestamp': '2020-01-01T00:00:00.000Z'})
+
+        def list_events(_offset, _size, **_):
+            return events[_offset:_offset + _size]
+
+        client.events.list = Mock(side_effect=list_events)
+        with patch(
+            "cloudify_scalelist.workflows.get_rest_client",
+            Mock(return_value=client)
+        ), patch("cloudify_scalelist.workflows.LIST_PAGE_SIZE", 2), \
+                patch("cloudify_scalelist.workflows.PLAN_EVENTS_LIMIT", 4):
+            # only the most recent events up to limit
+            self.assertEqual(workflows._get_operation_timings(_ctx),
+                             {'op': 2.5})
+        self.assertEqual(
+            [kwargs['_offset'] for _, kwargs in
+             client.events.list.call_args_list], [0, 2])
+
+    def test_benchmark(self):
+        # benchmark harness works with current workflows code
+        for scenario in benchmark.SCENARIOS:
+            result = benchmark.run_benchmark(
+                120, scenario, groups=2, depth=3, scale=2,
+                batch_size=4, max_in_flight=2)
+            self.assertEqual(result['instances'], 120)
+            self.assertTrue(result['duration'] >= 0)
+        self.assertTrue(result['subgraphs'] >= 120)
+        self.assertTrue(result['dependencies'] > 0)
+
 
 if __name__ == '__main__':
     unittest.main()
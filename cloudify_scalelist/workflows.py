@@ -12,51 +12,278 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
 import time
+import logging
+import datetime
+import functools
+import contextlib
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 
 from cloudify.workflows import api
 from cloudify.workflows import tasks
 from cloudify.plugins import lifecycle
 from cloudify.decorators import workflow
 from cloudify.manager import get_rest_client
+from cloudify.exceptions import NonRecoverableError
+from cloudify_rest_client.exceptions import CloudifyClientError
 
 from cloudify_common_sdk._compat import text_type
 from cloudify_common_sdk.filters import (get_field_value_recursive,
                                          obfuscate_passwords, )
 
+# page size for read node instances with all_results
+LIST_PAGE_SIZE = 1000
+# parallel runtime properties updates
+UPDATE_POOL_SIZE = 10
+# instances in one batch of updates
+UPDATE_BATCH_SIZE = 100
+# retries of update on version conflict
+UPDATE_CONFLICT_RETRIES = 5
+# runtime property of bookkeeping instance with transaction index:
+# {transaction_id: {node_id: [instance_id]}}
+TRANSACTION_INDEX_PROPERTY = '_scalelist_transactions'
+# parallel requests for reset instances state after uninstall
+CLEANUP_POOL_SIZE = 10
+# dry run: default duration of operation without history, seconds
+PLAN_DEFAULT_OPERATION_DURATION = 10
+# dry run: events used for calculate operation durations
+PLAN_EVENTS_LIMIT = 10000
+# dry run: warn about graphs with more dependencies
+PLAN_MAX_DEPENDENCIES = 100000
+PLAN_INSTALL_OPERATIONS = [
+    'cloudify.interfaces.lifecycle.precreate',
+    'cloudify.interfaces.lifecycle.create',
+    'cloudify.interfaces.lifecycle.configure',
+    'cloudify.interfaces.lifecycle.start',
+    'cloudify.interfaces.lifecycle.poststart']
+PLAN_INSTALL_RELATIONSHIP_OPERATIONS = [
+    'cloudify.interfaces.relationship_lifecycle.preconfigure',
+    'cloudify.interfaces.relationship_lifecycle.postconfigure',
+    'cloudify.interfaces.relationship_lifecycle.establish']
+PLAN_UNINSTALL_OPERATIONS = [
+    'cloudify.interfaces.lifecycle.prestop',
+    'cloudify.interfaces.lifecycle.stop',
+    'cloudify.interfaces.lifecycle.delete',
+    'cloudify.interfaces.lifecycle.postdelete']
+PLAN_UNINSTALL_RELATIONSHIP_OPERATIONS = [
+    'cloudify.interfaces.relationship_lifecycle.unlink']
+
+
+class _PhaseTimer(object):
+    # duration of workflow phases, phase can be measured several times
+    # (waves, rollback)
+
+    def __init__(self):
+        self.started = time.time()
+        self.phases = OrderedDict()
+
+    def add(self, name, duration):
+        phase = self.phases.setdefault(name, {'duration': 0.0, 'count': 0})
+        phase['duration'] += duration
+        phase['count'] += 1
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - started)
+
+    def wrap(self, name, func):
+        @functools.wraps(func)
+        def _timed(*args, **kwargs):
+            with self.phase(name):
+                return func(*args, **kwargs)
+        return _timed
+
+    def summary(self):
+        return {
+            'duration': round(time.time() - self.started, 3),
+            'phases': OrderedDict(
+                (name, {'duration': round(phase['duration'], 3),
+                        'count': phase['count']})
+                for name, phase in self.phases.items())
+        }
+
+
+def _report_phase_timings(ctx, timer, timings_file=None):
+    summary = timer.summary()
+    message = 'Phase timings: {}'.format(json.dumps(summary))
+    ctx.logger.info(message)
+    # structured event, mock contexts have no workflow handler
+    internal = getattr(ctx, 'internal', None)
+    if internal:
+        internal.send_workflow_event(event_type='workflow_stage',
+                                     message=message,
+                                     args={'timings': summary})
+    if timings_file:
+        # called on failure also, so must not replace workflow error
+        try:
+            with open(timings_file, 'w') as timings:
+                json.dump(summary, timings, indent=2)
+        except (IOError, OSError) as ex:
+            ctx.logger.warning("Can't write phase timings to {}: {}"
+                               .format(timings_file, repr(ex)))
+    return summary
+
+
+def _is_debug(ctx):
+    try:
+        return ctx.logger.isEnabledFor(logging.DEBUG)
+    except AttributeError:
+        return True
+
+
+def _update_instance_properties(manager, instance_id, properties_updates,
+                                verify=False):
+    # update runtime properties with retry on version conflict,
+    # returns states before and after update, state after update is
+    # requested only with verify. properties_updates can be function which
+    # calculates updates from current runtime properties.
+    for attempt in range(UPDATE_CONFLICT_RETRIES):
+        resulted_state = manager.node_instances.get(instance_id)
+        runtime_properties = dict(resulted_state.runtime_properties or {})
+        if callable(properties_updates):
+            runtime_properties.update(properties_updates(runtime_properties))
+        else:
+            runtime_properties.update(properties_updates)
+        try:
+            manager.node_instances.update(
+                node_instance_id=instance_id,
+                runtime_properties=runtime_properties,
+                version=resulted_state.version + 1)
+        except CloudifyClientError as ex:
+            # someone else has updated instance, reread and try again
+            if ex.status_code != 409 or \
+                    attempt + 1 >= UPDATE_CONFLICT_RETRIES:
+                raise
+        else:
+            break
+    updated_state = None
+    if verify:
+        updated_state = manager.node_instances.get(instance_id)
+    return resulted_state, updated_state
+
+
+def _update_instance_properties_args(manager, verify, instance_update):
+    instance_id, properties_updates = instance_update
+    return _update_instance_properties(manager, instance_id,
+                                       properties_updates, verify=verify)
+
 
 def _update_runtime_properties(ctx, instance_id, properties_updates):
     manager = get_rest_client()
 
-    resulted_state = manager.node_instances.get(instance_id)
-    ctx.logger.debug('State before update: {}'
-                     .format(repr(obfuscate_passwords(resulted_state))))
     ctx.logger.info("Update node: {}".format(instance_id))
-    runtime_properties = resulted_state.runtime_properties or {}
-    runtime_properties.update(properties_updates)
-    manager.node_instances.update(node_instance_id=instance_id,
-                                  runtime_properties=runtime_properties,
-                                  version=resulted_state.version + 1)
-    resulted_state = manager.node_instances.get(instance_id)
-    ctx.logger.debug('State after update: {}'
+    resulted_state, updated_state = _update_instance_properties(
+        manager, instance_id, properties_updates, verify=_is_debug(ctx))
+    ctx.logger.debug('State before update: {}'
                      .format(repr(obfuscate_passwords(resulted_state))))
+    if updated_state:
+        ctx.logger.debug('State after update: {}'
+                         .format(repr(obfuscate_passwords(updated_state))))
 
 
-def _cleanup_instances(ctx, instance_ids):
+def _update_runtime_properties_bulk(ctx, instances_updates,
+                                    pool_size=UPDATE_POOL_SIZE,
+                                    batch_size=UPDATE_BATCH_SIZE):
+    # instances_updates - list of (instance_id, properties_updates)
+    if not instances_updates:
+        return
     manager = get_rest_client()
+    verify = _is_debug(ctx)
+    update_func = functools.partial(_update_instance_properties_args,
+                                    manager, verify)
+    pool = ThreadPool(max(1, min(pool_size, len(instances_updates))))
+    try:
+        for offset in range(0, len(instances_updates), batch_size):
+            batch = instances_updates[offset:offset + batch_size]
+            for instance_id, _ in batch:
+                ctx.logger.info("Update node: {}".format(instance_id))
+            started = time.time()
+            # logger is not thread safe, so log results in this thread
+            states = pool.map(update_func, batch)
+            ctx.logger.info(
+                "Updated {} instances in {:.3f} seconds."
+                .format(len(batch), time.time() - started))
+            for resulted_state, updated_state in states:
+                ctx.logger.debug(
+                    'State before update: {}'
+                    .format(repr(obfuscate_passwords(resulted_state))))
+                if updated_state:
+                    ctx.logger.debug(
+                        'State after update: {}'
+                        .format(repr(obfuscate_passwords(updated_state))))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _cleanup_instance(manager, verify, instance_id):
+    # reset instance to uninitialized state with retry on version conflict,
+    # returns instance id, states before/after cleanup and error
+    try:
+        for attempt in range(UPDATE_CONFLICT_RETRIES):
+            resulted_state = manager.node_instances.get(instance_id)
+            try:
+                manager.node_instances.update(
+                    node_instance_id=instance_id,
+                    runtime_properties={},
+                    state='uninitialized',
+                    version=resulted_state.version + 1)
+            except CloudifyClientError as ex:
+                if ex.status_code != 409 or \
+                        attempt + 1 >= UPDATE_CONFLICT_RETRIES:
+                    raise
+            else:
+                break
+        updated_state = None
+        if verify:
+            updated_state = manager.node_instances.get(instance_id)
+        return instance_id, resulted_state, updated_state, None
+    except Exception as ex:
+        return instance_id, None, None, ex
+
 
+def _cleanup_instances(ctx, instance_ids, pool_size=CLEANUP_POOL_SIZE):
+    # returns list of (instance_id, error) for instances without cleanup
+    if not instance_ids:
+        return []
+    manager = get_rest_client()
+    cleanup_func = functools.partial(_cleanup_instance, manager,
+                                     _is_debug(ctx))
     for instance_id in instance_ids:
-        resulted_state = manager.node_instances.get(instance_id)
-        ctx.logger.debug('State before update: {}'
-                         .format(repr(obfuscate_passwords(resulted_state))))
         ctx.logger.info("Cleanup node: {}".format(instance_id))
-        manager.node_instances.update(node_instance_id=instance_id,
-                                      runtime_properties={},
-                                      state='uninitialized',
-                                      version=resulted_state.version + 1)
-        resulted_state = manager.node_instances.get(instance_id)
-        ctx.logger.debug('State after update: {}'
+    started = time.time()
+    pool = ThreadPool(max(1, min(pool_size, len(instance_ids))))
+    try:
+        results = pool.map(cleanup_func, instance_ids)
+    finally:
+        pool.close()
+        pool.join()
+    ctx.logger.info("Cleaned up {} instances in {:.3f} seconds."
+                    .format(len(instance_ids), time.time() - started))
+
+    # logger is not thread safe, so log results in this thread
+    failures = []
+    for instance_id, resulted_state, updated_state, error in results:
+        if error:
+            failures.append((instance_id, error))
+            continue
+        ctx.logger.debug('State before update: {}'
                          .format(repr(obfuscate_passwords(resulted_state))))
+        if updated_state:
+            ctx.logger.debug(
+                'State after update: {}'
+                .format(repr(obfuscate_passwords(updated_state))))
+    if failures:
+        ctx.logger.warning("Cleanup failed for instances: {}".format(
+            repr([(instance_id, repr(error))
+                  for instance_id, error in failures])))
+    return failures
 
 
 def _deployments_get_groups(ctx):
@@ -66,6 +293,39 @@ def _deployments_get_groups(ctx):
     return deployment['groups']
 
 
+def _list_node_instances(client, list_kwargs, all_results=False):
+    # generator over deployment node instances, with all_results we read
+    # instances page by page instead of loading full list to memory
+    if not all_results:
+        for instance in client.node_instances.list(**list_kwargs):
+            yield instance
+        return
+
+    offset = 0
+    while True:
+        instances = client.node_instances.list(_offset=offset,
+                                               _size=LIST_PAGE_SIZE,
+                                               **list_kwargs)
+        for instance in instances:
+            yield instance
+        offset += len(instances)
+        if len(instances) < LIST_PAGE_SIZE:
+            break
+
+
+def _add_instance_to_index(node_instances, instance_ids,
+                           seen_node_instances, seen_instances,
+                           node_id, instance_id):
+    # save node type (instances without transaction)
+    if (node_id, instance_id) not in seen_node_instances:
+        seen_node_instances.add((node_id, instance_id))
+        node_instances.setdefault(node_id, []).append(instance_id)
+    # save exact instance id (instances without transaction)
+    if instance_id not in seen_instances:
+        seen_instances.add(instance_id)
+        instance_ids.append(instance_id)
+
+
 def _get_transaction_instances(ctx, scale_transaction_field,
                                scale_node_names, scale_node_field_path,
                                scale_node_field_values, all_results=False):
@@ -75,15 +335,35 @@ def _get_transaction_instances(ctx, scale_transaction_field,
         'deployment_id': ctx.deployment.id,
         '_include': ['runtime_properties', 'node_id', 'id']
     }
-    if all_results:
-        list_kwargs['_get_all_results'] = True
-    instances = client.node_instances.list(**list_kwargs)
-    transaction_ids = []
+    if isinstance(scale_node_names, list):
+        scale_node_names = set(scale_node_names)
+
+    # node_id -> instance ids
     node_instances = {}
     instance_ids = []
+    # indexes for check duplicates
+    seen_instances = set()
+    seen_node_instances = set()
+    # transaction -> [(node_id, instance id)]
+    transaction_instances = {}
+    # transactions of filtered instances
+    transaction_ids = []
+    seen_transactions = set()
 
-    for instance in instances:
+    # one pass over all instances
+    for instance in _list_node_instances(client, list_kwargs, all_results):
         runtime_properties = instance.runtime_properties
+        transaction_id = None
+        if scale_transaction_field:
+            transaction_id = runtime_properties.get(scale_transaction_field)
+        # save instance to transaction index
+        if transaction_id:
+            try:
+                transaction_instances.setdefault(transaction_id, []).append(
+                    (instance.node_id, instance.id))
+            except TypeError:
+                # unhashable transaction value
+                transaction_id = None
         # check that we have correct node name
         if scale_node_names and instance.node_id not in scale_node_names:
             continue
@@ -95,23 +375,13 @@ def _get_transaction_instances(ctx, scale_transaction_field,
             continue
         # save instances to scale "settings", for case when instances created
         # without transaction
-        if not node_instances.get(instance.node_id):
-            node_instances[instance.node_id] = []
-        # save node type (instances without transaction)
-        if instance.id not in node_instances[instance.node_id]:
-            node_instances[instance.node_id].append(instance.id)
-        # save exact instance id (instances without transaction)
-        if instance.id not in instance_ids:
-            instance_ids.append(instance.id)
-        # ignore transaction
-        if not scale_transaction_field:
-            continue
-        # check transactions
-        if not runtime_properties.get(scale_transaction_field):
-            continue
+        _add_instance_to_index(node_instances, instance_ids,
+                               seen_node_instances, seen_instances,
+                               instance.node_id, instance.id)
         # save transaction to list
-        transaction_ids.append(
-            runtime_properties.get(scale_transaction_field))
+        if transaction_id and transaction_id not in seen_transactions:
+            seen_transactions.add(transaction_id)
+            transaction_ids.append(transaction_id)
 
     # list will be empty if no scale_transaction_field
     if not transaction_ids:
@@ -122,24 +392,155 @@ def _get_transaction_instances(ctx, scale_transaction_field,
     ctx.logger.debug("Transaction ids: {}".format(repr(transaction_ids)))
 
     # search instances for remove
-    instances = client.node_instances.list(**list_kwargs)
+    for transaction_id in transaction_ids:
+        for node_id, instance_id in transaction_instances[transaction_id]:
+            _add_instance_to_index(node_instances, instance_ids,
+                                   seen_node_instances, seen_instances,
+                                   node_id, instance_id)
 
-    for instance in instances:
-        runtime_properties = instance.runtime_properties
-        transaction_id = runtime_properties.get(scale_transaction_field)
-        # not our transaction, skip
-        if transaction_id not in transaction_ids:
+    ctx.logger.debug("List nodes: {}".format(repr(node_instances)))
+    ctx.logger.debug("List instances: {}".format(repr(instance_ids)))
+    return node_instances, instance_ids
+
+
+def _transaction_index_add(transaction_id, node_instances):
+    # returns function for add instances ((node_id, instance_id)) to
+    # transaction in index
+    def _updates(runtime_properties):
+        index = dict(runtime_properties.get(TRANSACTION_INDEX_PROPERTY) or {})
+        transaction = dict(index.get(transaction_id) or {})
+        for node_id, instance_id in node_instances:
+            instance_ids = list(transaction.get(node_id, []))
+            if instance_id not in instance_ids:
+                instance_ids.append(instance_id)
+            transaction[node_id] = instance_ids
+        index[transaction_id] = transaction
+        return {TRANSACTION_INDEX_PROPERTY: index}
+    return _updates
+
+
+def _transaction_index_remove(instance_ids):
+    # returns function for remove instances from index, transactions without
+    # instances are removed also
+    instance_ids = set(instance_ids)
+
+    def _updates(runtime_properties):
+        index = {}
+        current = runtime_properties.get(TRANSACTION_INDEX_PROPERTY) or {}
+        for transaction_id, transaction in current.items():
+            transaction = dict(
+                (node_id, [instance_id for instance_id in node_instance_ids
+                           if instance_id not in instance_ids])
+                for node_id, node_instance_ids in transaction.items())
+            transaction = dict((node_id, node_instance_ids)
+                               for node_id, node_instance_ids
+                               in transaction.items() if node_instance_ids)
+            if transaction:
+                index[transaction_id] = transaction
+        return {TRANSACTION_INDEX_PROPERTY: index}
+    return _updates
+
+
+def _update_transaction_index(ctx, index_instance_id, properties_updates):
+    if not index_instance_id:
+        return
+    ctx.logger.info("Update transaction index in {}."
+                    .format(repr(index_instance_id)))
+    try:
+        _update_instance_properties(get_rest_client(), index_instance_id,
+                                    properties_updates)
+    except CloudifyClientError as ex:
+        # index is only optimization, scale down can scan instances
+        ctx.logger.warning("Can't update transaction index: {}"
+                           .format(repr(ex)))
+
+
+def _get_indexed_transaction_instances(ctx, index_instance_id,
+                                       scale_transaction_field,
+                                       scale_node_names,
+                                       scale_node_field_path,
+                                       scale_node_field_values):
+    # search instances by transaction index, returns None if we can't
+    # resolve instances without scan of all deployment instances
+    if not index_instance_id or not scale_transaction_field:
+        return None
+    by_transaction = scale_node_field_path == [scale_transaction_field]
+    if not by_transaction and not scale_node_names:
+        return None
+
+    client = get_rest_client()
+    try:
+        index = client.node_instances.get(
+            index_instance_id, _include=['runtime_properties']
+        ).runtime_properties.get(TRANSACTION_INDEX_PROPERTY) or {}
+    except CloudifyClientError as ex:
+        ctx.logger.warning("Can't read transaction index: {}"
+                           .format(repr(ex)))
+        return None
+
+    node_instances = {}
+    instance_ids = []
+    seen_instances = set()
+    seen_node_instances = set()
+    transaction_ids = []
+    seen_transactions = set()
+
+    def _add_transaction(transaction_id):
+        try:
+            if transaction_id in seen_transactions:
+                return True
+            seen_transactions.add(transaction_id)
+        except TypeError:
+            # unhashable transaction value, can't be indexed
+            ctx.logger.info("Transaction {} is not indexed."
+                            .format(repr(transaction_id)))
+            return False
+        transaction_ids.append(transaction_id)
+        return True
+
+    if by_transaction:
+        # field value is transaction id
+        for transaction_id in scale_node_field_values:
+            if not _add_transaction(transaction_id):
+                return None
+    else:
+        # read only instances of selected nodes
+        for node_id in sorted(scale_node_names):
+            for instance in client.node_instances.list(
+                deployment_id=ctx.deployment.id, node_id=node_id,
+                _include=['runtime_properties', 'node_id', 'id']
+            ):
+                value = get_field_value_recursive(ctx.logger,
+                                                  instance.runtime_properties,
+                                                  scale_node_field_path)
+                if value not in scale_node_field_values:
+                    continue
+                _add_instance_to_index(node_instances, instance_ids,
+                                       seen_node_instances, seen_instances,
+                                       instance.node_id, instance.id)
+                transaction_id = instance.runtime_properties.get(
+                    scale_transaction_field)
+                if transaction_id and not _add_transaction(transaction_id):
+                    return None
+
+    for transaction_id in transaction_ids:
+        transaction = index.get(transaction_id)
+        if transaction is None:
+            # created before index or index update failed
+            ctx.logger.info("Transaction {} is not indexed."
+                            .format(repr(transaction_id)))
+            return None
+        if by_transaction and scale_node_names and \
+                not set(transaction).intersection(scale_node_names):
+            # same as scan, no instances of selected nodes in transaction
             continue
-        # no such group yet
-        if not node_instances.get(instance.node_id):
-            node_instances[instance.node_id] = []
-        # maybe we already have such type
-        if instance.id not in node_instances[instance.node_id]:
-            node_instances[instance.node_id].append(instance.id)
-        # maybe we already have such instance
-        if instance.id not in instance_ids:
-            instance_ids.append(instance.id)
+        for node_id in sorted(transaction):
+            for instance_id in transaction[node_id]:
+                _add_instance_to_index(node_instances, instance_ids,
+                                       seen_node_instances, seen_instances,
+                                       node_id, instance_id)
 
+    ctx.logger.debug("Transaction ids: {}".format(repr(transaction_ids)))
     ctx.logger.debug("List nodes: {}".format(repr(node_instances)))
     ctx.logger.debug("List instances: {}".format(repr(instance_ids)))
     return node_instances, instance_ids
@@ -216,7 +617,8 @@ def _get_scale_list(ctx, scalable_entity_properties, property_type):
 
 
 def _process_node_instances(ctx, graph, node_instances, ignore_failure,
-                            node_instance_subgraph_func, node_sequence):
+                            node_instance_subgraph_func, node_sequence,
+                            by_relationships=False, max_in_flight=None):
     ctx.logger.info("Scale sequence: {}".format(repr(node_sequence)))
     subgraphs = {}
     node_graphs = {}
@@ -230,51 +632,288 @@ def _process_node_instances(ctx, graph, node_instances, ignore_failure,
 
     ctx.logger.info("Scale levels: {}".format(repr(node_graphs)))
     previous_level = []
+    previous_node_id = None
     for node_id in node_sequence:
         # use get for skip instances with unknow type
         if not node_graphs.get(node_id, []):
             continue
         current_level_instances = node_graphs[node_id]
-        for target_instance in current_level_instances:
-            for source_instance in previous_level:
+        if by_relationships:
+            _add_related_dependencies(ctx, graph, subgraphs,
+                                      previous_level, current_level_instances)
+        else:
+            _add_level_dependencies(ctx, graph, subgraphs,
+                                    previous_node_id, previous_level,
+                                    node_id, current_level_instances)
+        # replace previous with current instances
+        previous_level = current_level_instances
+        previous_node_id = node_id
+    if max_in_flight:
+        _add_lane_dependencies(
+            graph, subgraphs,
+            [instance.id for instance in
+             _instances_order(node_instances, node_sequence=node_sequence)],
+            max_in_flight)
+    graph.execute()
+
+
+def _add_level_dependencies(ctx, graph, subgraphs,
+                            source_node_id, source_instances,
+                            target_node_id, target_instances):
+    # each source instance depends on each target instance, for levels with
+    # several instances on both sides we add stub subgraph between levels,
+    # so we have N + M dependencies instead of N * M.
+    sources_count = len(source_instances)
+    targets_count = len(target_instances)
+    if sources_count * targets_count <= sources_count + targets_count:
+        for target_instance in target_instances:
+            for source_instance in source_instances:
                 ctx.logger.info("Scale dependency: {}->{}"
                                 .format(source_instance.id,
                                         target_instance.id))
                 graph.add_dependency(subgraphs[source_instance.id],
                                      subgraphs[target_instance.id])
-        # replace previous with current instances
-        previous_level = current_level_instances
-    graph.execute()
+        return
+
+    barrier_name = "{}->{}".format(source_node_id, target_node_id)
+    ctx.logger.info("Scale dependency: {} instances->{}->{} instances"
+                    .format(sources_count, barrier_name, targets_count))
+    barrier = graph.subgraph(barrier_name)
+    for target_instance in target_instances:
+        graph.add_dependency(barrier, subgraphs[target_instance.id])
+    for source_instance in source_instances:
+        graph.add_dependency(subgraphs[source_instance.id], barrier)
+
+
+def _add_related_dependencies(ctx, graph, subgraphs,
+                              source_instances, target_instances):
+    # source instance depends only on target instances with relationship
+    # between them, so independent branches are processed in parallel
+    sources = dict((instance.id, instance) for instance in source_instances)
+    targets = dict((instance.id, instance) for instance in target_instances)
+    dependencies = set()
+    for source_instance in source_instances:
+        for rel in source_instance.relationships:
+            if rel.target_id in targets:
+                dependencies.add((source_instance.id, rel.target_id))
+    for target_instance in target_instances:
+        for rel in target_instance.relationships:
+            if rel.target_id in sources:
+                dependencies.add((rel.target_id, target_instance.id))
+    for source_id, target_id in sorted(dependencies):
+        ctx.logger.info("Scale dependency: {}->{}"
+                        .format(source_id, target_id))
+        graph.add_dependency(subgraphs[source_id], subgraphs[target_id])
+
+
+def _relationship_depths(node_instances):
+    # length of longest relationships chain from instance to other instances
+    # in same list, instances without relationships have 0
+    instances = dict((instance.id, instance) for instance in node_instances)
+    depths = {}
+    for instance_id in instances:
+        stack = [(instance_id, False)]
+        while stack:
+            current_id, expanded = stack.pop()
+            if current_id in depths:
+                continue
+            targets = [rel.target_id
+                       for rel in instances[current_id].relationships
+                       if rel.target_id in instances]
+            if expanded:
+                depths[current_id] = max(
+                    [depths.get(target_id, 0) + 1 for target_id in targets] or
+                    [0])
+            else:
+                stack.append((current_id, True))
+                stack += [(target_id, False) for target_id in targets
+                          if target_id not in depths]
+    return depths
+
+
+def _instances_order(node_instances, node_sequence=None, reverse=False):
+    # sort instances in run order, so instance never waits for instances
+    # placed after it in list
+    node_instances = list(node_instances)
+    if node_sequence:
+        # instances from sequence level wait for next levels
+        positions = dict((node_id, len(node_sequence) - index)
+                         for index, node_id in enumerate(node_sequence))
+        return sorted(node_instances, key=lambda instance: positions.get(
+            instance._node_instance.node_id, 0))
+    # relationship targets are installed before sources and
+    # uninstalled after sources
+    depths = _relationship_depths(node_instances)
+    return sorted(node_instances, reverse=reverse,
+                  key=lambda instance: depths[instance.id])
+
+
+def _split_waves(node_instances, batch_size):
+    if not batch_size or batch_size <= 0:
+        return [node_instances]
+    return [node_instances[offset:offset + batch_size]
+            for offset in range(0, len(node_instances), batch_size)]
+
+
+def _add_lane_dependencies(graph, subgraphs, ordered_ids, max_in_flight):
+    # instance waits for instance placed max_in_flight positions before it,
+    # so we have no more than max_in_flight instances in progress
+    for index in range(max_in_flight, len(ordered_ids)):
+        graph.add_dependency(subgraphs[ordered_ids[index]],
+                             subgraphs[ordered_ids[index - max_in_flight]])
+
+
+class _LimitedLifecycleProcessor(lifecycle.LifecycleProcessor):
+    # lifecycle processor with limited count of instances processed in
+    # parallel, node_instances should be sorted in run order
+
+    def __init__(self, graph, node_instances, max_in_flight, **kwargs):
+        super(_LimitedLifecycleProcessor, self).__init__(
+            graph=graph, node_instances=set(node_instances), **kwargs)
+        self._ordered_ids = [instance.id for instance in node_instances]
+        self._max_in_flight = max_in_flight
+
+    def _finish_install(self, graph, subgraphs):
+        super(_LimitedLifecycleProcessor, self)._finish_install(
+            graph, subgraphs)
+        _add_lane_dependencies(graph, subgraphs, self._ordered_ids,
+                               self._max_in_flight)
+
+    def _finish_uninstall(self, graph, subgraphs):
+        super(_LimitedLifecycleProcessor, self)._finish_uninstall(
+            graph, subgraphs)
+        _add_lane_dependencies(graph, subgraphs, self._ordered_ids,
+                               self._max_in_flight)
+
+
+def _clear_graph(graph):
+    for task in list(graph.tasks_iter()):
+        graph.remove_task(task)
+
+
+def _wave_graph_name(index, waves):
+    # lifecycle restores stored graph with the same name, so each wave
+    # needs own graph name, single wave uses default name
+    if len(waves) > 1:
+        return {'name_prefix': 'wave_{}_'.format(index)}
+    return {}
+
+
+def _install_instances(ctx, graph, added, related, ignore_failure,
+                       node_sequence, node_sequence_by_relationships=False,
+                       batch_size=None, max_in_flight=None):
+    if batch_size or max_in_flight:
+        waves = _split_waves(
+            _instances_order(added, node_sequence=node_sequence),
+            batch_size)
+    else:
+        waves = [added]
+
+    installed = 0
+    for index, wave in enumerate(waves):
+        if index:
+            _clear_graph(graph)
+        name_kwargs = _wave_graph_name(index, waves)
+        if node_sequence:
+            subgraph_func = lifecycle.install_node_instance_subgraph
+            _process_node_instances(
+                ctx=ctx,
+                graph=graph,
+                node_instances=wave,
+                ignore_failure=ignore_failure,
+                node_instance_subgraph_func=subgraph_func,
+                node_sequence=node_sequence,
+                by_relationships=node_sequence_by_relationships,
+                max_in_flight=max_in_flight)
+        elif max_in_flight:
+            _LimitedLifecycleProcessor(
+                graph=graph,
+                node_instances=wave,
+                max_in_flight=max_in_flight,
+                related_nodes=related,
+                **name_kwargs).install()
+        else:
+            lifecycle.install_node_instances(
+                graph=graph,
+                node_instances=wave,
+                related_nodes=related,
+                **name_kwargs)
+        installed += len(wave)
+        if len(waves) > 1:
+            ctx.logger.info('Install wave {}/{} finished, installed {} of {} '
+                            'instances.'.format(index + 1, len(waves),
+                                                installed, len(added)))
 
 
 def _uninstall_instances(ctx, graph, removed, related, ignore_failure,
-                         node_sequence):
+                         node_sequence, node_sequence_by_relationships=False,
+                         batch_size=None, max_in_flight=None,
+                         cleanup_pool_size=None):
 
     # cleanup tasks
-    for task in graph.tasks_iter():
-        graph.remove_task(task)
+    _clear_graph(graph)
+
+    if not removed:
+        return
+
+    if node_sequence:
+        node_sequence = node_sequence[::-1]
 
-    if removed:
+    if batch_size or max_in_flight:
+        waves = _split_waves(
+            _instances_order(removed, node_sequence=node_sequence,
+                             reverse=True),
+            batch_size)
+    else:
+        waves = [removed]
+
+    uninstalled = 0
+    for index, wave in enumerate(waves):
+        if index:
+            _clear_graph(graph)
+        name_kwargs = _wave_graph_name(index, waves)
         if node_sequence:
             subgraph_func = lifecycle.uninstall_node_instance_subgraph
             _process_node_instances(
                 ctx=ctx,
                 graph=graph,
-                node_instances=removed,
+                node_instances=wave,
                 ignore_failure=ignore_failure,
                 node_instance_subgraph_func=subgraph_func,
-                node_sequence=node_sequence[::-1])
+                node_sequence=node_sequence,
+                by_relationships=node_sequence_by_relationships,
+                max_in_flight=max_in_flight)
+        elif max_in_flight:
+            _LimitedLifecycleProcessor(
+                graph=graph,
+                node_instances=wave,
+                max_in_flight=max_in_flight,
+                related_nodes=related,
+                ignore_failure=ignore_failure,
+                **name_kwargs).uninstall()
         else:
             lifecycle.uninstall_node_instances(
                 graph=graph,
-                node_instances=removed,
+                node_instances=wave,
                 related_nodes=related,
-                ignore_failure=ignore_failure)
+                ignore_failure=ignore_failure,
+                **name_kwargs)
 
         # clean up properties
         instance_ids = [node_instance._node_instance.id
-                        for node_instance in removed]
-        _cleanup_instances(ctx, instance_ids)
+                        for node_instance in wave]
+        failures = _cleanup_instances(
+            ctx, instance_ids, cleanup_pool_size or CLEANUP_POOL_SIZE)
+        if failures:
+            # stop before other waves and modification finish
+            raise NonRecoverableError(
+                "Cleanup failed for instances: {}".format(
+                    ", ".join(instance_id for instance_id, _ in failures)))
+        uninstalled += len(wave)
+        if len(waves) > 1:
+            ctx.logger.info('Uninstall wave {}/{} finished, uninstalled {} of '
+                            '{} instances.'.format(index + 1, len(waves),
+                                                   uninstalled, len(removed)))
 
 
 def _run_scale_settings(ctx, scale_settings, scalable_entity_properties,
@@ -283,10 +922,21 @@ def _run_scale_settings(ctx, scale_settings, scalable_entity_properties,
                         ignore_failure=False,
                         ignore_rollback_failure=True,
                         instances_remove_ids=None,
-                        node_sequence=None):
-    modification = ctx.deployment.start_modification(scale_settings)
-    ctx.refresh_node_instances()
+                        node_sequence=None,
+                        node_sequence_by_relationships=False,
+                        batch_size=None,
+                        max_in_flight=None,
+                        timer=None,
+                        transaction_index_instance=None,
+                        cleanup_pool_size=None):
+    timer = timer or _PhaseTimer()
+    with timer.phase('start_modification'):
+        modification = ctx.deployment.start_modification(scale_settings)
+    with timer.phase('refresh_node_instances'):
+        ctx.refresh_node_instances()
     graph = ctx.graph_mode()
+    # graph construction time is phase time without graph_execute
+    graph.execute = timer.wrap('graph_execute', graph.execute)
     try:
         ctx.logger.info('Deployment modification started. '
                         '[modification_id={0}]'.format(modification.id))
@@ -301,6 +951,7 @@ def _run_scale_settings(ctx, scale_settings, scalable_entity_properties,
                         if i.modification == 'added')
             related = added_and_related - added
             try:
+                instances_updates = []
                 for node_instance in added:
                     properties_updates = scalable_entity_properties.get(
                         node_instance._node_instance.node_id, {})
@@ -328,32 +979,48 @@ def _run_scale_settings(ctx, scale_settings, scalable_entity_properties,
                                 node_instance._node_instance.node_id,
                                 node_instance._node_instance.id,
                                 repr(obfuscate_passwords(properties))))
-                        _update_runtime_properties(
-                            ctx, node_instance._node_instance.id, properties)
-                if node_sequence:
-                    subgraph_func = lifecycle.install_node_instance_subgraph
-                    _process_node_instances(
+                        instances_updates.append(
+                            (node_instance._node_instance.id, properties))
+                with timer.phase('update_runtime_properties'):
+                    _update_runtime_properties_bulk(ctx, instances_updates)
+                with timer.phase('install'):
+                    _install_instances(
                         ctx=ctx,
                         graph=graph,
-                        node_instances=added,
+                        added=added,
+                        related=related,
                         ignore_failure=ignore_failure,
-                        node_instance_subgraph_func=subgraph_func,
-                        node_sequence=node_sequence)
-                else:
-                    lifecycle.install_node_instances(
-                        graph=graph,
-                        node_instances=added,
-                        related_nodes=related)
+                        node_sequence=node_sequence,
+                        node_sequence_by_relationships=(
+                            node_sequence_by_relationships),
+                        batch_size=batch_size,
+                        max_in_flight=max_in_flight)
+                if scale_transaction_field:
+                    with timer.phase('update_transaction_index'):
+                        _update_transaction_index(
+                            ctx, transaction_index_instance,
+                            _transaction_index_add(
+                                scale_transaction_value or modification.id,
+                                [(node_instance._node_instance.node_id,
+                                  node_instance._node_instance.id)
+                                 for node_instance in added]))
             except Exception as ex:
                 ctx.logger.error('Scale out failed, scaling back in. {}'
                                  .format(repr(ex)))
-                _wait_for_sent_tasks(ctx, graph)
-                _uninstall_instances(ctx=ctx,
-                                     graph=graph,
-                                     removed=added,
-                                     related=related,
-                                     ignore_failure=ignore_rollback_failure,
-                                     node_sequence=node_sequence)
+                with timer.phase('uninstall'):
+                    _wait_for_sent_tasks(ctx, graph)
+                    _uninstall_instances(
+                        ctx=ctx,
+                        graph=graph,
+                        removed=added,
+                        related=related,
+                        ignore_failure=ignore_rollback_failure,
+                        node_sequence=node_sequence,
+                        node_sequence_by_relationships=(
+                            node_sequence_by_relationships),
+                        batch_size=batch_size,
+                        max_in_flight=max_in_flight,
+                        cleanup_pool_size=cleanup_pool_size)
                 raise ex
 
         if len(set(modification.removed.node_instances)):
@@ -377,55 +1044,335 @@ def _run_scale_settings(ctx, scale_settings, scalable_entity_properties,
                             )
                         )
             related = removed_and_related - removed
-            _uninstall_instances(ctx=ctx,
-                                 graph=graph,
-                                 removed=removed,
-                                 ignore_failure=ignore_failure,
-                                 related=related,
-                                 node_sequence=node_sequence)
+            with timer.phase('uninstall'):
+                _uninstall_instances(ctx=ctx,
+                                     graph=graph,
+                                     removed=removed,
+                                     ignore_failure=ignore_failure,
+                                     related=related,
+                                     node_sequence=node_sequence,
+                                     node_sequence_by_relationships=(
+                                         node_sequence_by_relationships),
+                                     batch_size=batch_size,
+                                     max_in_flight=max_in_flight,
+                                     cleanup_pool_size=cleanup_pool_size)
+            with timer.phase('update_transaction_index'):
+                _update_transaction_index(
+                    ctx, transaction_index_instance,
+                    _transaction_index_remove(
+                        [node_instance._node_instance.id
+                         for node_instance in removed]))
     except Exception as ex:
         ctx.logger.warn('Rolling back deployment modification. '
                         '[modification_id={0}]: {1}'
                         .format(modification.id, repr(ex)))
-        _wait_for_sent_tasks(ctx, graph)
-        modification.rollback()
+        with timer.phase('rollback_modification'):
+            _wait_for_sent_tasks(ctx, graph)
+            modification.rollback()
         raise ex
     else:
-        modification.finish()
+        with timer.phase('finish_modification'):
+            modification.finish()
+
+
+def _wait_deadline(ctx):
+    try:
+        return time.time() + ctx.wait_after_fail
+    except AttributeError:
+        return time.time() + 1800
+
+
+def _check_cancelled(graph):
+    try:
+        cancelled = api.has_cancel_request()
+    except AttributeError:
+        cancelled = graph._is_execution_cancelled()
+    if cancelled:
+        raise api.ExecutionCancelled()
+
+
+def _wait_for_waiting_tasks(ctx, graph):
+    # graph of cloudify-common 5.1+: sent tasks are in _waiting_for,
+    # responses are queued to _finished_tasks and set _tasks_wait
+    sent_tasks = set()
+    for task in graph._waiting_for:
+        state = task.get_state()
+        ctx.logger.debug(
+            'Parallel task to failed task: {0}. State: {1}'.format(
+                task.id, state))
+        if state == tasks.TASK_SENT:
+            sent_tasks.add(task)
+    deadline = _wait_deadline(ctx)
+    while deadline > time.time():
+        graph._tasks_wait.clear()
+        _check_cancelled(graph)
+        # only responses received since last wakeup
+        while graph._finished_tasks:
+            task, result = graph._finished_tasks.popitem()
+            sent_tasks.discard(task)
+            try:
+                graph._handle_terminated_task(result, task)
+            except RuntimeError:
+                ctx.logger.error('Unhandled Failed task: {0}'.format(task))
+        if not sent_tasks:
+            break
+        graph._tasks_wait.wait(min(1, max(0, deadline - time.time())))
 
 
 def _wait_for_sent_tasks(ctx, graph):
     """Wait for tasks that are in the SENT state to return"""
+    if isinstance(getattr(graph, '_waiting_for', None), set):
+        _wait_for_waiting_tasks(ctx, graph)
+        return
+    # older graph, finished tasks are found by scan of whole graph
+    sent_tasks = set()
     for task in graph.tasks_iter():
         # Check type.
+        state = task.get_state()
         ctx.logger.debug(
             'Parallel task to failed task: {0}. State: {1}'.format(
-                task.id, task.get_state()))
-    try:
-        deadline = time.time() + ctx.wait_after_fail
-    except AttributeError:
-        deadline = time.time() + 1800
+                task.id, state))
+        if state == tasks.TASK_SENT:
+            sent_tasks.add(task)
+    deadline = _wait_deadline(ctx)
     while deadline > time.time():
-        try:
-            cancelled = api.has_cancel_request()
-        except AttributeError:
-            cancelled = graph._is_execution_cancelled()
-        if cancelled:
-            raise api.ExecutionCancelled()
-        try:
-            finished_tasks = graph._finished_tasks()
-        except AttributeError:
-            finished_tasks = graph._terminated_tasks()
-        for task in finished_tasks:
+        _check_cancelled(graph)
+        # scan graph only when one of sent tasks changed state
+        if any(task.get_state() != tasks.TASK_SENT for task in sent_tasks):
             try:
-                graph._handle_terminated_task(task)
-            except RuntimeError:
-                ctx.logger.error('Unhandled Failed task: {0}'.format(task))
-        if not any(task.get_state() == tasks.TASK_SENT
-                   for task in graph.tasks_iter()):
+                finished_tasks = graph._finished_tasks()
+            except AttributeError:
+                finished_tasks = graph._terminated_tasks()
+            for task in finished_tasks:
+                try:
+                    graph._handle_terminated_task(task)
+                except RuntimeError:
+                    ctx.logger.error(
+                        'Unhandled Failed task: {0}'.format(task))
+            sent_tasks = set(task for task in sent_tasks
+                             if task.get_state() == tasks.TASK_SENT)
+        if not sent_tasks:
             break
+        time.sleep(0.1)
+
+
+def _parse_timestamp(value):
+    # manager returns timestamps with or without timezone/milliseconds
+    value = text_type(value or '').replace('T', ' ').rstrip('Z')
+    value = value.split('+')[0]
+    for time_format in ('%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S'):
+        try:
+            return datetime.datetime.strptime(value, time_format)
+        except ValueError:
+            continue
+    return None
+
+
+def _get_operation_timings(ctx):
+    # average duration of operations in previous executions on deployment
+    client = get_rest_client()
+    # the most recent events, page by page
+    events = []
+    try:
+        while len(events) < PLAN_EVENTS_LIMIT:
+            page_size = min(LIST_PAGE_SIZE, PLAN_EVENTS_LIMIT - len(events))
+            page = client.events.list(
+                deployment_id=ctx.deployment.id,
+                event_type=['task_started', 'task_succeeded'],
+                include_logs=False,
+                sort='-reported_timestamp',
+                _offset=len(events),
+                _size=page_size)
+            events.extend(page)
+            if len(page) < page_size:
+                break
+    except CloudifyClientError as ex:
+        ctx.logger.info("Can't get operation timings: {}".format(repr(ex)))
+        return {}
+    started = {}
+    durations = {}
+    # task started before succeeded
+    for event in reversed(events):
+        operation = event.get('operation')
+        if not operation:
+            continue
+        key = (event.get('execution_id'), event.get('node_instance_id'),
+               operation)
+        timestamp = _parse_timestamp(
+            event.get('reported_timestamp') or event.get('timestamp'))
+        if not timestamp:
+            continue
+        if event.get('event_type') == 'task_started':
+            started[key] = timestamp
+        elif key in started:
+            duration = timestamp - started.pop(key)
+            durations.setdefault(operation, []).append(
+                duration.days * 86400 + duration.seconds +
+                duration.microseconds / 1000000.0)
+    return dict((operation, sum(values) / len(values))
+                for operation, values in durations.items())
+
+
+def _scale_entity_nodes(ctx, scale_id):
+    # nodes scaled with scale entity: group members or node itself with
+    # all contained nodes
+    groups = ctx.deployment.scaling_groups or {}
+    if scale_id in groups:
+        scaled = set()
+        for member in groups[scale_id].get('members', []):
+            scaled |= _scale_entity_nodes(ctx, member)
+        return scaled
+    scaled = set([scale_id])
+    changed = True
+    while changed:
+        changed = False
+        for node in ctx.nodes:
+            if node.id in scaled:
+                continue
+            for rel in node.relationships:
+                if (
+                    rel.target_id in scaled and
+                    rel.is_derived_from('cloudify.relationships.contained_in')
+                ):
+                    scaled.add(node.id)
+                    changed = True
+                    break
+    return scaled
+
+
+def _scale_plan(ctx, scale_settings, install=True, node_sequence=None,
+                node_sequence_by_relationships=False, batch_size=None,
+                max_in_flight=None, timings=None):
+    """Estimate graph size and duration of scale without modification"""
+    timings = timings or {}
+    default_duration = PLAN_DEFAULT_OPERATION_DURATION
+    if timings:
+        default_duration = sum(timings.values()) / len(timings)
+    if install:
+        operations, relationship_operations = (
+            PLAN_INSTALL_OPERATIONS, PLAN_INSTALL_RELATIONSHIP_OPERATIONS)
+    else:
+        operations, relationship_operations = (
+            PLAN_UNINSTALL_OPERATIONS, PLAN_UNINSTALL_RELATIONSHIP_OPERATIONS)
+
+    # count of new/removed instances per node
+    instances_count = {}
+    groups = ctx.deployment.scaling_groups or {}
+    for scale_id, settings in scale_settings.items():
+        if scale_id in groups:
+            current = groups[scale_id]['properties']['current_instances']
         else:
-            time.sleep(0.1)
+            current = ctx.get_node(scale_id).number_of_instances
+        delta = abs(settings['instances'] - current)
+        for node_id in _scale_entity_nodes(ctx, scale_id):
+            node = ctx.get_node(node_id)
+            per_unit = max(1, int(round(
+                float(node.number_of_instances) / max(current, 1))))
+            instances_count[node_id] = (
+                instances_count.get(node_id, 0) + delta * per_unit)
+
+    # tasks, dependencies and duration of one instance per node
+    nodes = dict((node_id, ctx.get_node(node_id))
+                 for node_id in instances_count)
+    tasks_count = 0
+    dependencies_count = 0
+    instance_duration = {}
+    for node_id, count in instances_count.items():
+        node = nodes[node_id]
+        node_operations = [operation for operation in operations
+                           if operation in node.operations]
+        node_tasks = len(node_operations)
+        duration = sum(timings.get(operation, default_duration)
+                       for operation in node_operations)
+        for rel in node.relationships:
+            for operation in relationship_operations:
+                if operation in rel.source_operations:
+                    node_tasks += 1
+                    duration += timings.get(operation, default_duration)
+                if operation in rel.target_operations:
+                    node_tasks += 1
+        tasks_count += node_tasks * count
+        instance_duration[node_id] = duration
+        if not node_sequence or node_sequence_by_relationships:
+            dependencies_count += len(node.relationships) * count
+
+    # levels of instances, each level waits for previous
+    levels = []
+    if node_sequence:
+        for node_id in node_sequence[::1 if install else -1]:
+            if node_id in instances_count:
+                levels.append([node_id])
+        in_sequence = set(node_id for level in levels for node_id in level)
+        not_in_sequence = [node_id for node_id in instances_count
+                           if node_id not in in_sequence]
+        if not_in_sequence and levels:
+            levels[-1] += not_in_sequence
+        elif not_in_sequence:
+            levels.append(not_in_sequence)
+        if not node_sequence_by_relationships:
+            for previous, current in zip(levels, levels[1:]):
+                sources = instances_count[previous[0]]
+                targets = instances_count[current[0]]
+                dependencies_count += min(sources * targets,
+                                          sources + targets)
+    else:
+        depths = {}
+        for node_id in instances_count:
+            depth = 0
+            stack = [(node_id, 0)]
+            # relationships between nodes are acyclic
+            while stack:
+                current_id, current_depth = stack.pop()
+                depth = max(depth, current_depth)
+                for rel in nodes[current_id].relationships:
+                    if rel.target_id in nodes:
+                        stack.append((rel.target_id, current_depth + 1))
+            depths[node_id] = depth
+        for depth in range(max(depths.values() or [0]) + 1):
+            level = [node_id for node_id in depths
+                     if depths[node_id] == depth]
+            if level:
+                levels.append(level)
+        if not install:
+            levels = levels[::-1]
+
+    total_instances = sum(instances_count.values())
+    waves = 1
+    wave_instances = total_instances
+    if batch_size and total_instances:
+        waves = (total_instances + batch_size - 1) // batch_size
+        wave_instances = min(batch_size, total_instances)
+    wave_duration = sum(max(instance_duration[node_id] for node_id in level)
+                        for level in levels)
+    if max_in_flight and wave_instances:
+        average_duration = sum(
+            instance_duration[node_id] * count
+            for node_id, count in instances_count.items()
+        ) / float(total_instances)
+        lanes_length = (wave_instances + max_in_flight - 1) // max_in_flight
+        wave_duration = max(wave_duration, lanes_length * average_duration)
+        dependencies_count += max(0, wave_instances - max_in_flight) * waves
+
+    return {
+        'instances': instances_count,
+        'tasks': tasks_count,
+        'dependencies': dependencies_count,
+        'levels': len(levels),
+        'waves': waves,
+        'estimated_duration': wave_duration * waves,
+    }
+
+
+def _log_scale_plan(ctx, scale_settings, **kwargs):
+    plan = _scale_plan(ctx, scale_settings,
+                       timings=_get_operation_timings(ctx), **kwargs)
+    ctx.logger.info("Scale plan: {}".format(json.dumps(plan, sort_keys=True)))
+    if plan['dependencies'] > PLAN_MAX_DEPENDENCIES:
+        ctx.logger.warning(
+            "Scale plan has {} dependencies, please use node_sequence or "
+            "batch_size for decrease graph size.".format(
+                plan['dependencies']))
+    return plan
 
 
 def _scaledown_group_to_settings(ctx, list_scale_groups, scale_compute):
@@ -479,6 +1426,13 @@ def scaledownlist(ctx, scale_compute=False,
                   scale_node_field_value=u'',
                   all_results=False,
                   node_sequence=None,
+                  node_sequence_by_relationships=False,
+                  batch_size=0,
+                  max_in_flight=0,
+                  dry_run=False,
+                  timings_file=u'',
+                  transaction_index_instance=u'',
+                  cleanup_pool_size=CLEANUP_POOL_SIZE,
                   **_):
     if not scale_node_field:
         raise ValueError('You should provide `scale_node_field` for correct'
@@ -500,27 +1454,57 @@ def scaledownlist(ctx, scale_compute=False,
     if isinstance(scale_node_field, text_type):
         scale_node_field = [scale_node_field]
 
-    instances, instance_ids = _get_transaction_instances(
-        ctx=ctx,
-        scale_transaction_field=scale_transaction_field,
-        scale_node_names=scale_node_name,
-        scale_node_field_path=scale_node_field,
-        scale_node_field_values=scale_node_field_value,
-        all_results=all_results)
+    timer = _PhaseTimer()
+    with timer.phase('transaction_instances'):
+        indexed = _get_indexed_transaction_instances(
+            ctx=ctx,
+            index_instance_id=transaction_index_instance,
+            scale_transaction_field=scale_transaction_field,
+            scale_node_names=scale_node_name,
+            scale_node_field_path=scale_node_field,
+            scale_node_field_values=scale_node_field_value)
+        if indexed is not None:
+            instances, instance_ids = indexed
+        else:
+            instances, instance_ids = _get_transaction_instances(
+                ctx=ctx,
+                scale_transaction_field=scale_transaction_field,
+                scale_node_names=scale_node_name,
+                scale_node_field_path=scale_node_field,
+                scale_node_field_values=scale_node_field_value,
+                all_results=all_results)
 
     if not instance_ids:
         ctx.logger.info("Empty list for instances for remove.")
         return
 
     # we have list of instances_id(string) as part of scale dictionary
-    scale_settings = _scaledown_group_to_settings(
-        ctx, _get_scale_list(ctx, instances, text_type), scale_compute)
+    with timer.phase('scale_settings'):
+        scale_settings = _scaledown_group_to_settings(
+            ctx, _get_scale_list(ctx, instances, text_type), scale_compute)
+
+    if dry_run:
+        _log_scale_plan(ctx, scale_settings, install=False,
+                        node_sequence=node_sequence,
+                        node_sequence_by_relationships=(
+                            node_sequence_by_relationships),
+                        batch_size=batch_size,
+                        max_in_flight=max_in_flight)
+        return
 
     try:
         _run_scale_settings(ctx, scale_settings, {},
                             instances_remove_ids=instance_ids,
                             ignore_failure=ignore_failure,
-                            node_sequence=node_sequence)
+                            node_sequence=node_sequence,
+                            node_sequence_by_relationships=(
+                                node_sequence_by_relationships),
+                            batch_size=batch_size,
+                            max_in_flight=max_in_flight,
+                            timer=timer,
+                            transaction_index_instance=(
+                                transaction_index_instance),
+                            cleanup_pool_size=cleanup_pool_size)
     except Exception as e:
         ctx.logger.info('Scale down based on transaction failed: {}'
                         .format(repr(e)))
@@ -530,16 +1514,27 @@ def scaledownlist(ctx, scale_compute=False,
             for instance in node.instances:
                 if instance.id in instance_ids:
                     removed.append(instance)
-        _uninstall_instances(ctx=ctx,
-                             graph=ctx.graph_mode(),
-                             removed=removed,
-                             related=[],
-                             ignore_failure=ignore_failure,
-                             node_sequence=node_sequence)
+        with timer.phase('forced_uninstall'):
+            _uninstall_instances(ctx=ctx,
+                                 graph=ctx.graph_mode(),
+                                 removed=removed,
+                                 related=[],
+                                 ignore_failure=ignore_failure,
+                                 node_sequence=node_sequence,
+                                 node_sequence_by_relationships=(
+                                     node_sequence_by_relationships),
+                                 batch_size=batch_size,
+                                 max_in_flight=max_in_flight,
+                                 cleanup_pool_size=cleanup_pool_size)
+        _update_transaction_index(
+            ctx, transaction_index_instance,
+            _transaction_index_remove([instance.id for instance in removed]))
 
         # remove from DB
         if force_db_cleanup:
             ctx.logger.warn('Ignoring force_db_cleanup. Deprecated feature.')
+    finally:
+        _report_phase_timings(ctx, timer, timings_file)
 
 
 def _scaleup_group_to_settings(ctx, scalable_entity_dict, scale_compute):
@@ -589,6 +1584,13 @@ def scaleuplist(ctx, scalable_entity_properties,
                 scale_transaction_field="",
                 scale_transaction_value="",
                 node_sequence=None,
+                node_sequence_by_relationships=False,
+                batch_size=0,
+                max_in_flight=0,
+                dry_run=False,
+                timings_file="",
+                transaction_index_instance="",
+                cleanup_pool_size=CLEANUP_POOL_SIZE,
                 **kwargs):
 
     if not scalable_entity_properties:
@@ -596,18 +1598,111 @@ def scaleuplist(ctx, scalable_entity_properties,
 
     # we have list of dictionaries with runtime properties for new instances as
     # part of scale dictionary
-    scale_settings = _scaleup_group_to_settings(
-        ctx, _get_scale_list(ctx, scalable_entity_properties, dict),
-        scale_compute)
+    timer = _PhaseTimer()
+    with timer.phase('scale_settings'):
+        scale_settings = _scaleup_group_to_settings(
+            ctx, _get_scale_list(ctx, scalable_entity_properties, dict),
+            scale_compute)
+
+    if dry_run:
+        _log_scale_plan(ctx, scale_settings, install=True,
+                        node_sequence=node_sequence,
+                        node_sequence_by_relationships=(
+                            node_sequence_by_relationships),
+                        batch_size=batch_size,
+                        max_in_flight=max_in_flight)
+        return
+
+    try:
+        _run_scale_settings(ctx, scale_settings, scalable_entity_properties,
+                            scale_transaction_field, scale_transaction_value,
+                            ignore_failure, ignore_rollback_failure,
+                            node_sequence=node_sequence,
+                            node_sequence_by_relationships=(
+                                node_sequence_by_relationships),
+                            batch_size=batch_size,
+                            max_in_flight=max_in_flight,
+                            timer=timer,
+                            transaction_index_instance=(
+                                transaction_index_instance),
+                            cleanup_pool_size=cleanup_pool_size)
+    finally:
+        _report_phase_timings(ctx, timer, timings_file)
+
+
+def _field_value_getter(node_field_path):
+    # precompiled version of get_field_value_recursive, path keys with
+    # list indexes are converted to int only once
+    steps = []
+    for key in node_field_path or []:
+        try:
+            index = int(key)
+        except (TypeError, ValueError):
+            index = None
+        steps.append((key, index))
+
+    def _get_value(properties):
+        for key, index in steps:
+            if isinstance(properties, list):
+                if index is None:
+                    return None
+                try:
+                    properties = properties[index]
+                except IndexError:
+                    return None
+            elif isinstance(properties, dict):
+                if key not in properties:
+                    return None
+                properties = properties[key]
+            else:
+                return None
+        return properties
+
+    return _get_value
+
+
+def _values_checker(values):
+    # set lookup for hashable values, list lookup for dicts and lists
+    hashable_values = set()
+    unhashable_values = []
+    for value in values or []:
+        try:
+            hashable_values.add(value)
+        except TypeError:
+            unhashable_values.append(value)
+
+    def _check_value(value):
+        try:
+            if value in hashable_values:
+                return True
+        except TypeError:
+            pass
+        return value in unhashable_values
 
-    _run_scale_settings(ctx, scale_settings, scalable_entity_properties,
-                        scale_transaction_field, scale_transaction_value,
-                        ignore_failure, ignore_rollback_failure,
-                        node_sequence=node_sequence)
+    return _check_value
+
+
+def _bucket_node_instances(instances, get_value):
+    # group instances by field value, value calculated once per instance
+    buckets = {}
+    unhashable_buckets = []
+    for instance in instances:
+        value = get_value(instance._node_instance.runtime_properties)
+        try:
+            buckets.setdefault(value, []).append(instance)
+        except TypeError:
+            unhashable_buckets.append((value, [instance]))
+    return list(buckets.items()) + unhashable_buckets
 
 
 def _filter_node_instances(ctx, node_ids, node_instance_ids, type_names,
                            operation, node_field_path, node_field_value):
+    node_ids = set(node_ids or [])
+    node_instance_ids = set(node_instance_ids or [])
+    type_names = set(type_names or [])
+    get_value = _field_value_getter(node_field_path)
+    check_value = _values_checker(node_field_value)
+
     filtered_node_instances = []
     for node in ctx.nodes:
         # no such action skip it
@@ -617,58 +1712,68 @@ def _filter_node_instances(ctx, node_ids, node_instance_ids, type_names,
         if node_ids and node.id not in node_ids:
             continue
         # no such node type, skip it
-        if type_names and not next((type_name for type_name in type_names if
-                                    type_name in node.type_hierarchy), None):
+        if type_names and type_names.isdisjoint(node.type_hierarchy):
             continue
 
         # look more deeply, what about instance id's and properties
-        for instance in node.instances:
+        instances = node.instances
+        if node_instance_ids:
             # sorry no such id in list
-            if node_instance_ids and instance.id not in node_instance_ids:
-                continue
-            # look to field value
-            if node_field_path:
-                # check that we have such values in properties
-                runtime_properties = instance._node_instance.runtime_properties
-                value = get_field_value_recursive(ctx.logger,
-                                                  runtime_properties,
-                                                  node_field_path)
-                if value not in node_field_value:
-                    continue
-            # looks as good instance
-            filtered_node_instances.append(instance)
+            instances = [instance for instance in instances
+                         if instance.id in node_instance_ids]
+        if not node_field_path:
+            filtered_node_instances += instances
+            continue
+        # look to field value, check once for each different value
+        selected = set()
+        for value, bucket in _bucket_node_instances(instances, get_value):
+            if check_value(value):
+                selected.update(id(instance) for instance in bucket)
+        # looks as good instances, keep original order
+        filtered_node_instances += [instance for instance in instances
+                                    if id(instance) in selected]
     return filtered_node_instances
 
 
-@workflow
-def execute_operation(ctx, operation, operation_kwargs, allow_kwargs_override,
-                      run_by_dependency_order, type_names, node_ids,
-                      node_instance_ids, node_field, node_field_value,
-                      **kwargs):
-    """ A generic workflow for executing arbitrary operations on nodes """
-
-    if isinstance(node_field_value, text_type):
-        node_field_value = [node_field_value]
-
-    ctx.logger.debug("Filter by values list: {}."
-                     .format(repr(obfuscate_passwords(node_field_value))))
-
-    graph = ctx.graph_mode()
+def _concurrency_lanes(node_instances, max_concurrency):
+    # split ordered instance ids to groups with own concurrency limit,
+    # integer limit is shared by all instances, dictionary has limit for
+    # each node type
+    if not isinstance(max_concurrency, dict):
+        return [(max_concurrency,
+                 [instance.id for instance in node_instances])]
+    lanes = {}
+    for instance in node_instances:
+        # most specific type from hierarchy
+        type_name = next((type_name for type_name in
+                          instance.node.type_hierarchy[::-1]
+                          if max_concurrency.get(type_name)), None)
+        if type_name:
+            lanes.setdefault(type_name, []).append(instance.id)
+    return [(max_concurrency[type_name], instance_ids)
+            for type_name, instance_ids in lanes.items()]
+
+
+def _ignore_operation_failure(ctx, failed_ids, instance_id, operation):
+    # remember failed instance and continue with other instances
+    def _on_failure(subgraph):
+        failed_ids.add(instance_id)
+        ctx.logger.error('Failed operation {0} on {1}'.format(
+            operation, instance_id))
+        # same as lifecycle: skip rest of sequence, without finished event
+        for task in list(subgraph.tasks.values()):
+            if task.get_state() == tasks.TASK_PENDING:
+                subgraph.remove_task(task)
+        return tasks.HandlerResult.ignore()
+    return _on_failure
+
+
+def _execute_operation_batch(ctx, graph, node_instances, operation,
+                             operation_kwargs, exec_op_params,
+                             run_by_dependency_order, max_concurrency,
+                             failed_ids=None):
     subgraphs = {}
 
-    if isinstance(node_field, text_type):
-        node_field = [node_field]
-
-    # filtering node instances
-    filtered_node_instances = _filter_node_instances(
-        ctx=ctx,
-        node_ids=node_ids,
-        node_instance_ids=node_instance_ids,
-        type_names=type_names,
-        operation=operation,
-        node_field_path=node_field,
-        node_field_value=node_field_value)
-
     if run_by_dependency_order:
         # if run by dependency order is set, then create stub subgraphs for the
         # rest of the instances. This is done to support indirect
@@ -684,26 +1789,21 @@ def execute_operation(ctx, operation, operation_kwargs, allow_kwargs_override,
         # of their respective nodes yet there's a single instance of B -
         # using subgraphs we'll have 2N relationships instead of N^2).
         filtered_node_instances_ids = set(inst.id for inst in
-                                          filtered_node_instances)
+                                          node_instances)
         for instance in ctx.node_instances:
             if instance.id not in filtered_node_instances_ids:
                 subgraphs[instance.id] = graph.subgraph(instance.id)
 
-    # preparing the parameters to the execute_operation call
-    exec_op_params = {
-        'kwargs': operation_kwargs,
-        'operation': operation
-    }
-    if allow_kwargs_override is not None:
-        exec_op_params['allow_kwargs_override'] = allow_kwargs_override
-
     # registering actual tasks to sequences
-    for instance in filtered_node_instances:
+    for instance in node_instances:
         start_event_message = 'Starting operation {0}'.format(operation)
         if operation_kwargs:
             start_event_message += ' (Operation parameters: {0})'.format(
                 repr(operation_kwargs))
         subgraph = graph.subgraph(instance.id)
+        if failed_ids is not None:
+            subgraph.on_failure = _ignore_operation_failure(
+                ctx, failed_ids, instance.id, operation)
         sequence = subgraph.sequence()
         sequence.add(
             instance.send_event(start_event_message),
@@ -718,4 +1818,91 @@ def execute_operation(ctx, operation, operation_kwargs, allow_kwargs_override,
                 graph.add_dependency(subgraphs[instance.id],
                                      subgraphs[rel.target_id])
 
+    # limit count of operations in progress
+    if max_concurrency:
+        for limit, instance_ids in _concurrency_lanes(node_instances,
+                                                      max_concurrency):
+            _add_lane_dependencies(graph, subgraphs, instance_ids, limit)
+
     graph.execute()
+
+
+@workflow
+def execute_operation(ctx, operation, operation_kwargs, allow_kwargs_override,
+                      run_by_dependency_order, type_names, node_ids,
+                      node_instance_ids, node_field, node_field_value,
+                      max_concurrency=0, batch_size=0, max_failure_rate=0,
+                      **kwargs):
+    """ A generic workflow for executing arbitrary operations on nodes """
+
+    if isinstance(node_field_value, text_type):
+        node_field_value = [node_field_value]
+
+    ctx.logger.debug("Filter by values list: {}."
+                     .format(repr(obfuscate_passwords(node_field_value))))
+
+    graph = ctx.graph_mode()
+
+    if isinstance(node_field, text_type):
+        node_field = [node_field]
+
+    # filtering node instances
+    filtered_node_instances = _filter_node_instances(
+        ctx=ctx,
+        node_ids=node_ids,
+        node_instance_ids=node_instance_ids,
+        type_names=type_names,
+        operation=operation,
+        node_field_path=node_field,
+        node_field_value=node_field_value)
+
+    if run_by_dependency_order and (max_concurrency or batch_size):
+        # relationship targets before sources, so lanes and batches never
+        # wait for instances placed later, depth is calculated for all
+        # instances for support indirect dependencies
+        depths = _relationship_depths(ctx.node_instances)
+        filtered_node_instances = sorted(
+            filtered_node_instances,
+            key=lambda instance: depths.get(instance.id, 0))
+
+    # preparing the parameters to the execute_operation call
+    exec_op_params = {
+        'kwargs': operation_kwargs,
+        'operation': operation
+    }
+    if allow_kwargs_override is not None:
+        exec_op_params['allow_kwargs_override'] = allow_kwargs_override
+
+    failed_ids = set() if max_failure_rate else None
+    batches = _split_waves(filtered_node_instances, batch_size)
+    processed = 0
+    for index, batch in enumerate(batches):
+        if index:
+            _clear_graph(graph)
+        _execute_operation_batch(
+            ctx=ctx,
+            graph=graph,
+            node_instances=batch,
+            operation=operation,
+            operation_kwargs=operation_kwargs,
+            exec_op_params=exec_op_params,
+            run_by_dependency_order=run_by_dependency_order,
+            max_concurrency=max_concurrency,
+            failed_ids=failed_ids)
+        processed += len(batch)
+        if len(batches) > 1:
+            ctx.logger.info('Batch {}/{} finished, processed {} of {} '
+                            'instances.'.format(index + 1, len(batches),
+                                                processed,
+                                                len(filtered_node_instances)))
+        if failed_ids:
+            failure_rate = float(len(failed_ids)) / processed
+            if failure_rate > max_failure_rate:
+                raise RuntimeError(
+                    "Failure rate {:.3f} is more than {}, failed instances: "
+                    "{}.".format(failure_rate, max_failure_rate,
+                                 repr(sorted(failed_ids))))
+
+    if failed_ids:
+        ctx.logger.warning('Operation failed on instances: {}.'
+                           .format(repr(sorted(failed_ids))))